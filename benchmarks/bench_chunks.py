@@ -0,0 +1,88 @@
+'''
+Benchmark building bulk filter chunk requests: deepcopy + json.dumps per chunk against payload templates.
+
+Usage: python benchmarks/bench_chunks.py [--values 50000] [--chunk-size 500] [--parameters 20]
+'''
+import argparse
+import copy
+import json
+import os
+import sys
+import time
+import tracemalloc
+from urllib import parse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metabase_query.chunking import ChunkPlan, placeholder, template_builder
+
+
+def make_card_data(parameters, values):
+    # A card with one bulk filter and other filters with long value lists.
+    params = [{'type': 'category', 'value': [f'value {i} {j}' for j in range(200)], 'target': ['dimension', ['template-tag', f'tag_{i}']]} for i in range(parameters)]
+    params.append({'type': 'category', 'value': values, 'target': ['dimension', ['template-tag', 'order_id']]})
+    return {'domain': 'https://your-domain.com', 'question': 1, 'parameters': params, 'column_sort': None, 'column_types': None}
+
+
+def card_request(card_data):
+    url = f"{card_data['domain']}/api/card/{card_data['question']}/query/json"
+    return {'url': url, 'form_data': {'parameters': json.dumps(card_data['parameters'])}, 'column_sort': None, 'column_types': None}
+
+
+def legacy_requests(card_data, values, chunk_size):
+    requests = []
+    for i in range(0, len(values), chunk_size):
+        new_card_data = copy.deepcopy(card_data)
+        for parameter in new_card_data['parameters']:
+            if parameter['target'][-1][-1] == 'order_id':
+                parameter['value'] = values[i:i + chunk_size]
+        request = card_request(new_card_data)
+        # aiohttp encodes the form data before sending.
+        request['form_data'] = parse.urlencode(request['form_data']).encode('utf-8')
+        requests.append(request)
+    return requests
+
+
+def template_requests(card_data, values, chunk_size):
+    def template_request(keys):
+        new_card_data = copy.deepcopy(card_data)
+        for parameter in new_card_data['parameters']:
+            if parameter['target'][-1][-1] in keys:
+                parameter['value'] = [placeholder(parameter['target'][-1][-1])]
+        return card_request(new_card_data)
+
+    request = card_request(card_data)
+    build = template_builder(request=request, template_request=template_request)
+    return ChunkPlan(request=request, build=build, values={'order_id': values}, chunk_size=chunk_size).requests()
+
+
+def measure(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    seconds = time.perf_counter() - start
+
+    tracemalloc.start()
+    fn(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--values', type=int, default=50000)
+    parser.add_argument('--chunk-size', type=int, default=500)
+    parser.add_argument('--parameters', type=int, default=20)
+    args = parser.parse_args()
+
+    values = list(range(args.values))
+    card_data = make_card_data(args.parameters, values)
+    print(f'{args.values} values, {-(-args.values // args.chunk_size)} chunks, {args.parameters} other filters')
+
+    for name, fn in [('legacy', legacy_requests), ('template', template_requests)]:
+        seconds, peak = measure(fn, card_data, values, args.chunk_size)
+        print(f'{name:<10} {seconds:8.3f}s  peak {peak / 2 ** 20:8.1f} MB')
+
+
+if __name__ == '__main__':
+    main()
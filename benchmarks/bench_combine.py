@@ -0,0 +1,86 @@
+'''
+Benchmark combine_results against the previous implementation.
+
+Usage: python benchmarks/bench_combine.py [--chunks 200] [--rows 20000] [--json-chunks 2000] [--json-rows 1000]
+'''
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metabase_query.utils import combine_results
+
+
+def legacy_combine_csv(results):
+    combined_data = []
+    for i, data in enumerate(results):
+        lines = data.decode('utf-8').splitlines()
+        if i == 0:
+            combined_data.extend(lines)
+        else:
+            combined_data.extend(lines[1:])
+    return "\n".join(combined_data).encode('utf-8')
+
+
+def legacy_combine_json(results):
+    return sum(results, [])
+
+
+def make_json_chunks(chunks, rows):
+    return [[{'ID': i, 'Name': f'Customer {i}'} for i in range(c * rows, (c + 1) * rows)] for c in range(chunks)]
+
+
+def make_csv_chunks(chunks, rows):
+    header = b'ID,Name,Created At,Amount\n'
+    body = b''.join(b'%d,Customer %d,2024-08-01T00:00:00Z,%d.50\n' % (i, i, i) for i in range(rows))
+    return [header + body for _ in range(chunks)]
+
+
+def measure(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    seconds = time.perf_counter() - start
+
+    tracemalloc.start()
+    fn(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak
+
+
+def report(name, seconds, peak, size):
+    print(f'{name:<10} {seconds:8.3f}s {size / seconds / 2 ** 20:10.1f} MB/s  peak {peak / 2 ** 20:8.1f} MB')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chunks', type=int, default=200)
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--json-chunks', type=int, default=2000)
+    parser.add_argument('--json-rows', type=int, default=1000)
+    args = parser.parse_args()
+
+    results = make_json_chunks(args.json_chunks, args.json_rows)
+    print(f'JSON: {args.json_chunks} chunks, {args.json_chunks * args.json_rows} rows')
+    for name, fn in [('legacy', legacy_combine_json), ('current', lambda r: combine_results(r, format='json', verbose=False))]:
+        start = time.perf_counter()
+        fn(results)
+        print(f'{name:<10} {time.perf_counter() - start:8.3f}s')
+    del results
+
+    results = make_csv_chunks(args.chunks, args.rows)
+    size = sum(len(r) for r in results)
+    print(f'CSV: {args.chunks} chunks, {size / 2 ** 20:.1f} MB')
+
+    report('legacy', *measure(legacy_combine_csv, results), size)
+    report('current', *measure(lambda r: combine_results(r, format='csv', verbose=False), results), size)
+
+    with open(os.devnull, 'wb') as f:
+        report('file', *measure(lambda r: combine_results(r, format='csv', verbose=False, file=f), results), size)
+
+
+if __name__ == '__main__':
+    main()
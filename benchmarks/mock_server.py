@@ -0,0 +1,212 @@
+'''
+Local stand-in for the Metabase API endpoints used by metabase_query, for benchmarks.
+
+Endpoints: GET /api/card/{id}, POST /api/card/{id}/query/{format}, GET /api/table/{id}/query_metadata, POST /api/dataset/{format}.
+Rows are generated from the order_id filter values (field 10 for datasets), rows_per_value rows per value.
+
+Usage: python benchmarks/mock_server.py [--port 8765] [--latency 0.05] [--error-rate 0.01] [--text-columns 4] [--compress]
+'''
+import argparse
+import asyncio
+import csv
+import io
+import json
+import random
+import threading
+
+from aiohttp import web
+
+CARD_ID = 1
+TABLE_ID = 5
+ORDER_FIELD_ID = 10
+
+
+class MockMetabase:
+    def __init__(self, latency=0.0, latency_per_row=0.0, error_rate=0.0, error_status=503, text_columns=2, text_size=16, rows_per_value=1, default_values=1000, seed=0, compress=False):
+        '''
+        :param latency: Seconds before each export response.
+        :param latency_per_row: Extra seconds per row of each export response.
+        :param error_rate: Share of export requests that fail with error_status.
+        :param error_status: HTTP status of injected errors, 429 and 503 come with Retry-After: 0.
+        :param text_columns: Number of text columns after ID.
+        :param text_size: Characters per text value.
+        :param rows_per_value: Rows generated per filter value.
+        :param default_values: Values used when the request has no order_id filter.
+        :param seed: Seed of error injection.
+        :param compress: Compress export responses with an encoding from Accept-Encoding. gzip request bodies are always accepted.
+        '''
+        self.latency = latency
+        self.latency_per_row = latency_per_row
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.text_columns = text_columns
+        self.text_size = text_size
+        self.rows_per_value = rows_per_value
+        self.default_values = default_values
+        self.random = random.Random(seed)
+        self.compress = compress
+        self.columns = ['ID'] + [f'Text {i}' for i in range(text_columns)]
+        self.stats = {'metadata': 0, 'export': 0, 'errors': 0, 'in_flight': 0, 'max_in_flight': 0}
+
+    def card(self):
+        return {
+            'id': CARD_ID,
+            'result_metadata': [{'display_name': c, 'base_type': 'type/Integer' if c == 'ID' else 'type/Text'} for c in self.columns],
+            'parameters': [
+                {'slug': 'order_id', 'type': 'category', 'target': ['dimension', ['template-tag', 'order_id']]},
+                {'slug': 'status', 'type': 'category', 'target': ['dimension', ['template-tag', 'status']]}
+            ],
+            'dataset_query': {'type': 'native', 'native': {'template-tags': {}}}
+        }
+
+    def table(self):
+        fields = [{'id': ORDER_FIELD_ID, 'name': 'order_id', 'display_name': 'ID', 'base_type': 'type/Integer'}]
+        fields += [{'id': 100 + i, 'name': f'text_{i}', 'display_name': f'Text {i}', 'base_type': 'type/Text'} for i in range(self.text_columns)]
+        return {'fields': fields}
+
+    def rows(self, values):
+        text = 'x' * self.text_size
+        for value in values:
+            for _ in range(self.rows_per_value):
+                yield [value] + [text] * self.text_columns
+
+    def render(self, values, format):
+        rows = self.rows(values)
+        if format == 'json':
+            return json.dumps([dict(zip(self.columns, row)) for row in rows]).encode('utf-8'), 'application/json'
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator='\n')
+        writer.writerow(self.columns)
+        writer.writerows(rows)
+        return buffer.getvalue().encode('utf-8'), 'text/csv'
+
+    async def export(self, request, values):
+        self.stats['export'] += 1
+        self.stats['in_flight'] += 1
+        self.stats['max_in_flight'] = max(self.stats['max_in_flight'], self.stats['in_flight'])
+        try:
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.stats['errors'] += 1
+                headers = {'Retry-After': '0'} if self.error_status in [429, 503] else {}
+                return web.Response(status=self.error_status, headers=headers)
+
+            values = values if values is not None else list(range(self.default_values))
+            await asyncio.sleep(self.latency + self.latency_per_row * len(values) * self.rows_per_value)
+            body, content_type = self.render(values, request.match_info['format'])
+            response = web.Response(body=body, content_type=content_type)
+            if self.compress:
+                response.enable_compression()
+            return response
+        finally:
+            self.stats['in_flight'] -= 1
+
+    async def handle_card(self, request):
+        self.stats['metadata'] += 1
+        return web.json_response(self.card())
+
+    async def handle_table(self, request):
+        self.stats['metadata'] += 1
+        return web.json_response(self.table())
+
+    async def handle_card_query(self, request):
+        form = await request.post()
+        values = None
+        for parameter in json.loads(form.get('parameters', '[]')):
+            if parameter['target'][-1][-1] == 'order_id':
+                values = parameter['value']
+        return await self.export(request, values)
+
+    async def handle_dataset(self, request):
+        form = await request.post()
+        query = json.loads(form['query'])
+        values = None
+        if query.get('type') == 'query':
+            for clause in (query['query'].get('filter') or [])[1:]:
+                if clause[0] == '=' and clause[1][1] == ORDER_FIELD_ID:
+                    values = clause[2:]
+        else:
+            for parameter in query.get('parameters', []):
+                if parameter['target'][-1][-1] == 'order_id' and 'value' in parameter:
+                    values = parameter['value']
+        return await self.export(request, values)
+
+    async def handle_stats(self, request):
+        return web.json_response(self.stats)
+
+    def app(self):
+        app = web.Application(client_max_size=2 ** 30)
+        app.add_routes([
+            web.get('/api/card/{id}', self.handle_card),
+            web.post('/api/card/{id}/query/{format}', self.handle_card_query),
+            web.get('/api/table/{id}/query_metadata', self.handle_table),
+            web.post('/api/dataset/{format}', self.handle_dataset),
+            web.get('/stats', self.handle_stats)
+        ])
+        return app
+
+
+class MockServer:
+    def __init__(self, mock, port=0):
+        '''
+        Run a MockMetabase on a background thread: with MockServer(MockMetabase()) as url: ...
+
+        :param mock: MockMetabase.
+        :param port: Port, 0 for any free port.
+        '''
+        self.mock = mock
+        self.port = port
+        self.url = None
+        self._loop = None
+        self._thread = None
+        self._runner = None
+
+    def __enter__(self):
+        ready = threading.Event()
+
+        async def start():
+            self._runner = web.AppRunner(self.mock.app())
+            await self._runner.setup()
+            site = web.TCPSite(self._runner, '127.0.0.1', self.port)
+            await site.start()
+            port = self._runner.addresses[0][1]
+            self.url = f'http://127.0.0.1:{port}'
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(start())
+            ready.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self.url
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--latency-per-row', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--text-columns', type=int, default=2)
+    parser.add_argument('--text-size', type=int, default=16)
+    parser.add_argument('--rows-per-value', type=int, default=1)
+    parser.add_argument('--default-values', type=int, default=1000)
+    parser.add_argument('--compress', action='store_true')
+    args = parser.parse_args()
+
+    mock = MockMetabase(latency=args.latency, latency_per_row=args.latency_per_row, error_rate=args.error_rate, error_status=args.error_status,
+                        text_columns=args.text_columns, text_size=args.text_size, rows_per_value=args.rows_per_value, default_values=args.default_values, compress=args.compress)
+    print(f'Mock Metabase on http://127.0.0.1:{args.port}, card URL: http://127.0.0.1:{args.port}/question/{CARD_ID}')
+    web.run_app(mock.app(), host='127.0.0.1', port=args.port, print=None)
+
+
+if __name__ == '__main__':
+    main()
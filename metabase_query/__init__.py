@@ -1,53 +1,369 @@
 import asyncio
+import itertools
+import json
 import aiohttp
 from .card import Card
 from .dataset import Dataset
 from .sql import SQL
 import sys
+import threading
+import time
+from contextlib import AsyncExitStack, asynccontextmanager
 from tenacity import *
-from .utils import raise_retry_errors, combine_results, define_url
+from .utils import combine_results, define_url, check_query_args, check_iter_args, check_file_args
+from .stream import CSVRowParser, JSONArrayParser
+from .columnar import decode_csv
+from .decoder import Decoder, decode_json
+from .codec import JSONCodec, OrjsonCodec, make_codec, use_codec
+from .compression import BodyReader, accept_encoding as make_accept_encoding, compress_body, encode_body
+from .cache import MetadataCache, ResultCache
+from .scheduler import Scheduler, SingleFlight, gather_bounded, hold_in
+from .chunking import AdaptiveChunker, is_split_error, count_rows
+from .metrics import QueryStats, LoggingExporter, PrometheusExporter, OpenTelemetryExporter, current_stats, new_event, trace_config, use_query_stats
+from .breaker import CircuitBreakers
+from .checkpoint import Checkpoint, IncompleteResultError
+from .sink import open_sink
+from .partition import Partition, make_partition
+from .pagination import Pagination, make_pagination, last_key
+from .retries import MetabaseError, RetryBudget, metabase_error, should_retry, stop_retrying, wait_backoff, use_retry_budget
 
 if 'ipykernel' in sys.modules:
     import nest_asyncio
     nest_asyncio.apply()
 
 class Metabase(object):
-    def __init__(self, metabase_session, retry_errors=None, retry_attempts=3, limit_per_host=5, timeout=600, verbose=True, domain=None):
+    def __init__(self, metabase_session, retry_errors=None, retry_attempts=3, limit_per_host=5, timeout=600, verbose=True, domain=None, metadata_cache=True, max_in_flight=20, adaptive_chunking=False, chunk_target_seconds=30, retry_backoff=1, retry_max_wait=60, retry_jitter=1, retry_budget=None, circuit_breaker=True, result_cache=False, single_flight=True, max_filter_values=None, max_body_size=None, on_request=None, export_row_limit=1048575, decoder=False, json_codec='auto', accept_encoding='auto', compress_request_size=None):
         '''
         Setting Metabase object.
 
         :param metabase_session: Your Metabase Session.
-        :param retry_errors: None to retry with any error, a list of errors to retry with these errors only, contain matching. Default is None.
-        :param retry_attempts: 0 will not retry. Default is 3.
+        :param retry_errors: None to retry with any error, a list of errors to retry with these errors only, contain matching. Used when the error is not classified by HTTP status or Metabase error_type. Default is None.
+        :param retry_attempts: Total attempts per request, 0 or 1 will not retry. Default is 3.
         :param limit_per_host: The limit of connections per host. Default is 5.
         :param timeout: Timeout in seconds for each connection. Default is 600.
         :param verbose: Print log or not. Default is True.
         :param domain: Not required for queries with URL, SQL queries is required. Default is None.
+        :param metadata_cache: True to cache card and table metadata in memory, False to fetch it for every URL, or a MetadataCache object to set TTL, size and disk directory. Default is True.
+        :param max_in_flight: The limit of requests in flight across all URLs, chunks and retries, limit_per_host applies per domain. Default is 20.
+        :param adaptive_chunking: Tune the bulk filter chunk size to the server's response time, filter_chunk_size is the first guess. Failed chunks with timeout or too large errors are split in half and retried. Default is False.
+        :param chunk_target_seconds: Wanted response time per chunk for adaptive_chunking. Default is 30.
+        :param retry_backoff: First wait in seconds before a retry, it doubles on each retry. Default is 1.
+        :param retry_max_wait: Longest wait in seconds before a retry, also caps Retry-After. Default is 60.
+        :param retry_jitter: Random seconds added to each wait, so failed requests do not retry at once. Default is 1.
+        :param retry_budget: Total retries shared by all requests of one query() or sql() call, None for no limit. Default is None.
+        :param circuit_breaker: True to pause requests to a domain while its error rate is high and resume gradually, False to disable, or a CircuitBreakers object for custom thresholds. Default is True.
+        :param result_cache: True to cache export results in memory and skip the network for repeated queries, False to disable, or a ResultCache object to set TTL, size and disk directory. Default is False.
+        :param single_flight: Identical export requests and metadata requests in flight share one HTTP call and one result. Default is True.
+        :param max_filter_values: The limit of filter values per request across all filters, bulk filters are split further to fit it, None for no limit. Default is None.
+        :param max_body_size: The limit of URL-encoded request body bytes, bulk filters are split by the bytes of their values to fit it, e.g. the proxy's body size limit. None for no limit. Default is None.
+        :param on_request: A function or a list of functions called with an event dict after each request: timings, status, bytes, rows, retries, chunk and URL. See LoggingExporter, PrometheusExporter, OpenTelemetryExporter. Default is None.
+        :param export_row_limit: The export row limit of the Metabase server (MB_DOWNLOAD_ROW_LIMIT). Exports with this many rows are reported as truncated, and paginate_by pages stay under it. None to disable. Default is 1048575.
+        :param decoder: True to decode, reorder and merge large results in worker processes and threads so the event loop keeps downloading, False to do it on the event loop, or a Decoder object to set the mode and pool size. Default is False.
+        :param json_codec: JSON decoder and encoder of responses and request payloads: auto for orjson if installed else the standard library, json, orjson, or an object with loads(bytes) and dumps(obj). Default is auto.
+        :param accept_encoding: Compressed export responses, decompressed while they download: auto for zstd, br, gzip and deflate as far as installed, None for uncompressed, or a list like ['gzip']. Default is auto.
+        :param compress_request_size: gzip export request bodies from this many bytes, e.g. large bulk filters, if your server or proxy accepts Content-Encoding: gzip. None to never compress. Default is None.
         '''
         # Settings
         self.metabase_session = metabase_session
         self.retry_errors = retry_errors
         self.retry_attempts = retry_attempts
+        self.retry_backoff = retry_backoff
+        self.retry_max_wait = retry_max_wait
+        self.retry_jitter = retry_jitter
+        self.retry_budget = retry_budget
         self.limit_per_host = limit_per_host
         self.timeout = timeout
         self.verbose = verbose
         self.domain = domain
+        self.adaptive_chunking = adaptive_chunking
+        self.chunk_target_seconds = chunk_target_seconds
+        self.max_filter_values = max_filter_values
+        self.max_body_size = max_body_size
+        self.export_row_limit = export_row_limit
+        self.scheduler = Scheduler(max_in_flight=max_in_flight, limit_per_domain=limit_per_host)
+
+        if metadata_cache is True:
+            metadata_cache = MetadataCache()
+        elif metadata_cache is False:
+            metadata_cache = None
+        self.metadata_cache = metadata_cache
+        self.single_flight = SingleFlight() if single_flight else None
+
+        if circuit_breaker is True:
+            circuit_breaker = CircuitBreakers()
+        elif circuit_breaker is False:
+            circuit_breaker = None
+        if circuit_breaker is not None and 'on_state_change' not in circuit_breaker.settings:
+            circuit_breaker.settings['on_state_change'] = lambda domain, state: self.print_if_verbose(f'Circuit breaker of {domain} is {state}')
+        self.circuit_breakers = circuit_breaker
+
+        if result_cache is True:
+            result_cache = ResultCache()
+        elif result_cache is False:
+            result_cache = None
+        self.result_cache = result_cache
+
+        if decoder is True:
+            decoder = Decoder()
+        elif decoder is False:
+            decoder = None
+        self.decoder = decoder
+        self.json_codec = make_codec(json_codec)
+        self.accept_encoding = make_accept_encoding(accept_encoding)
+        self.compress_request_size = compress_request_size
+
+        # Long-lived client mode, see open()
+        self.session = None
+        self._loop = None
+        self._loop_thread = None
 
         # Child classes
         self.Card = Card(metabase=self)
         self.Dataset = Dataset(metabase=self)
         self.SQL = SQL(metabase=self)
 
-        # For printing log
-        self.query_count = 0
-        self.parse_count = 0
+        # Request events
+        if on_request is None:
+            on_request = []
+        elif not isinstance(on_request, list):
+            on_request = [on_request]
+        self.on_request = on_request
+        self.last_summary = None
+
+        # Numbers for printing log when no call is measured, see next_number()
+        self._stats = QueryStats()
 
     def print_if_verbose(self, *args):
         if self.verbose:
             print(*args)
 
+    def next_number(self, kind):
+        '''
+        Number of the next request of a kind (export, parse) in the current query() call, for printing log.
+        '''
+        stats = current_stats.get() or self._stats
+        return stats.next_number(kind)
+
+    def emit(self, event):
+        '''
+        Add a finished request event to the current call's stats and pass it to the on_request functions.
+        '''
+        stats = current_stats.get()
+        if stats is not None:
+            stats.add(event)
+        for function in self.on_request:
+            try:
+                function(event)
+            except Exception as e:
+                self.print_if_verbose(f'on_request failed: {type(e).__name__} {e}')
+
+    async def measure(self, coroutine):
+        '''
+        Run a coroutine with its own QueryStats.
+
+        :return: (result, summary), the summary is also kept in last_summary.
+        '''
+        stats = QueryStats()
+        with use_query_stats(stats):
+            result = await coroutine
+        self.last_summary = stats.summary()
+        return result, self.last_summary
+
+    def retry_policy(self, query_number=None, event=None, split_errors=False):
+        '''
+        Tenacity settings for export requests: classify errors, back off with jitter, respect Retry-After and the shared retry budget.
+
+        :param split_errors: Do not retry timeout and too large errors, the caller splits the chunk instead.
+        '''
+        def retryable(error):
+            return should_retry(error) and not (split_errors and is_split_error(error))
+
+        def before_sleep(retry_state):
+            error = retry_state.outcome.exception()
+            if event is not None:
+                event['retries'] += 1
+            self.print_if_verbose(f'Retrying {query_number} in {retry_state.next_action.sleep:.1f}s: {type(error).__name__} {error}')
+
+        return {
+            'stop': stop_retrying(max(1, self.retry_attempts)),
+            'wait': wait_backoff(initial=self.retry_backoff, max=self.retry_max_wait, jitter=self.retry_jitter),
+            'retry': retry_if_exception(retryable),
+            'before_sleep': before_sleep,
+            'reraise': True
+        }
+
+    def request_slot(self, url, group=None, stack=None):
+        '''
+        Async context manager to hold while sending a request: wait for the domain's circuit breaker, then a scheduler slot.
+
+        :param stack: An AsyncExitStack to keep the scheduler slot in after the context exits, e.g. to read a stream.
+            The circuit breaker only measures the context, close the stack to free the slot.
+        '''
+        domain = Scheduler.domain_of(url)
+        slot = self.scheduler.slot(domain=domain, group=group)
+        if stack is not None:
+            slot = hold_in(stack, slot)
+        if self.circuit_breakers is None:
+            return slot
+        return self.circuit_breakers.get(domain).guard(slot)
+
+    def create_session(self):
+        '''
+        Create a new aiohttp.ClientSession with this object's connection settings.
+        '''
+        connector = aiohttp.TCPConnector(limit_per_host=self.limit_per_host, ttl_dns_cache=300)
+        return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout), trace_configs=[trace_config()])
+
+    @asynccontextmanager
+    async def session_context(self):
+        '''
+        Yield the long-lived session if the client is open, else a session for this call only.
+        '''
+        if self.session is not None and not self.session.closed:
+            yield self.session
+        else:
+            async with self.create_session() as session:
+                yield session
+
+    @asynccontextmanager
+    async def call_context(self):
+        '''
+        Context of one query() or sql() call: yield the session, share one retry budget and use the JSON codec.
+        '''
+        with use_retry_budget(self.retry_budget), use_codec(self.json_codec):
+            async with self.session_context() as session:
+                yield session
+
+    def open(self):
+        '''
+        Keep one connection pool, DNS cache and keep-alive connections across query() and sql() calls.
+        Requests run on a background event loop thread. Call close() when done, or use the object as a context manager.
+
+        :return: Metabase object.
+        '''
+        if self._loop is not None:
+            return self
+
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self._loop.run_forever, name='metabase-query', daemon=True)
+        self._loop_thread.start()
+
+        async def open_session():
+            return self.create_session()
+
+        self.session = asyncio.run_coroutine_threadsafe(open_session(), self._loop).result()
+        return self
+
+    def close(self):
+        '''
+        Close the long-lived session, stop the background event loop thread and the decoder's workers.
+        '''
+        if self.decoder is not None:
+            self.decoder.close()
+
+        if self._loop is None:
+            return
+
+        if self.session is not None:
+            asyncio.run_coroutine_threadsafe(self.session.close(), self._loop).result()
+            self.session = None
+
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop_thread.join()
+        self._loop.close()
+        self._loop = None
+        self._loop_thread = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def run(self, coroutine):
+        '''
+        Run a coroutine from sync code, on the background event loop if the client is open.
+        '''
+        if self._loop is not None:
+            return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+        return asyncio.run(coroutine)
+
+    def iterate(self, async_generator):
+        '''
+        Iterate an async generator from sync code, on the background event loop if the client is open.
+        '''
+        if self._loop is not None:
+            loop = self._loop
+            step = lambda coroutine: asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+        else:
+            loop = asyncio.new_event_loop()
+            step = loop.run_until_complete
+
+        try:
+            while True:
+                try:
+                    yield step(async_generator.__anext__())
+                except StopAsyncIteration:
+                    break
+        finally:
+            step(async_generator.aclose())
+            if loop is not self._loop:
+                loop.run_until_complete(loop.shutdown_asyncgens())
+                loop.close()
+
+    async def fetch_metadata(self, session, url, cache_key, error_dict):
+        '''
+        Fetch card or table metadata, use the metadata cache if it is enabled.
+
+        :param session: aiohttp.ClientSession.
+        :param url: Metadata API URL.
+        :param cache_key: Key from MetadataCache.make_key.
+        :param error_dict: Map HTTP status to PermissionError message.
+        :return: Metadata as dict.
+        '''
+        async def fetch():
+            data = self.metadata_cache.get(cache_key) if self.metadata_cache is not None else None
+            if data is None:
+                data = await self._get_metadata(session=session, url=url, error_dict=error_dict)
+                if self.metadata_cache is not None:
+                    self.metadata_cache.set(cache_key, data)
+            return data
+
+        # Callers of the same metadata in flight share one request.
+        if self.single_flight is None:
+            return await fetch()
+        return await self.single_flight.do(key=('metadata', url), function=fetch)
+
+    async def _get_metadata(self, session, url, error_dict):
+        headers = {'Content-Type': 'application/json', 'X-Metabase-Session': self.metabase_session}
+        event = new_event(kind='metadata', url=url)
+        event['source'] = 'network'
+        wait_start = time.monotonic()
+        try:
+            async with self.scheduler.slot(domain=Scheduler.domain_of(url), group='metadata'):
+                start = time.monotonic()
+                event['wait'] = start - wait_start
+                response = await session.get(url=url, headers=headers, trace_request_ctx=event)
+                event.update(status=response.status, ttfb=time.monotonic() - start)
+
+                # Raise if error
+                if not response.ok:
+                    if response.status in error_dict:
+                        raise PermissionError(error_dict[response.status])
+                    else:
+                        response.raise_for_status()
+
+                body = await response.read()
+                event.update(bytes=len(body), download=time.monotonic() - start - event['ttfb'], seconds=time.monotonic() - start)
+                return self.json_codec.loads(body)
+        except Exception as e:
+            event['error'] = f'{type(e).__name__}: {e}'
+            raise
+        finally:
+            self.emit(event)
+
     # Main 1
-    def query(self, url, format='json', filter=None, filter_chunk_size=5000):
+    def query(self, url, format='json', filter=None, filter_chunk_size=5000, output=None, checkpoint=None, with_summary=False, partition_by=None, partitions=None, partition_range=None, paginate_by=None, page_size=None):
         '''
         Get data from any question URL, you can use a list of URLs or a list of filters to get data in bulk.
 
@@ -55,39 +371,317 @@ class Metabase(object):
         :param format: json, csv, xlsx.
         :param filter: One dict for a list of dicts.
         :param filter_chunk_size: If you have a bulk value filter, the package will splits your values into chunks to send the requests, and then concat the results into a single data.
+        :param output: None to return data in format, or arrow, pandas, numpy to decode the export into typed columns, format is ignored. Default is None.
+        :param checkpoint: A directory or a Checkpoint object to save completed chunks to. Running the same query again only fetches the missing and failed chunks, IncompleteResultError tells which chunks failed. Default is None.
+        :param with_summary: Return (data, summary) with request counts, retries, bytes, rows and timing percentiles of this call. The summary of the last call is also kept in last_summary. Default is False.
+        :param partition_by: A date or number column to split each URL into slices that run in parallel and are merged in order: a table field name, or a card or SQL filter slug. Default is None.
+        :param partitions: The number of equal slices, or an interval for date columns like '1d', '12h', '1w'. Default is None.
+        :param partition_range: (start, end) of partition_by, both included. None uses the range value of the filter, or the min and max of the field for table URLs. Default is None.
+        :param paginate_by: A unique key column to read table and SQL URLs in pages ordered by it, past the export row limit of Metabase: a table field name or a SQL column name. Default is None.
+        :param page_size: Rows per page for paginate_by, None for just under export_row_limit. Default is None.
         :return: One data or a list of data.
         '''
-        self.query_count = 0
-        self.parse_count = 0
-
-        if filter_chunk_size < 1:
-            raise ValueError('filter_chunk_size must be positive.')
+        check_query_args(format=format, filter_chunk_size=filter_chunk_size, output=output)
+        partition = make_partition(partition_by=partition_by, partitions=partitions, partition_range=partition_range)
+        pagination = make_pagination(paginate_by=paginate_by, page_size=page_size)
 
-        if format.lower() not in ['json', 'csv', 'xlsx']:
-            raise ValueError('Metabase only supports JSON, CSV and XLSX formats.')
+        result, summary = self.run(self.measure(self.handle_urls(urls=url, format=format.lower(), filters=filter, filter_chunk_size=filter_chunk_size, output=output, checkpoint=checkpoint, partition=partition, pagination=pagination)))
 
-        result = asyncio.run(self.handle_urls(urls=url, format=format.lower(), filters=filter, filter_chunk_size=filter_chunk_size))
-
-        return result
+        return (result, summary) if with_summary else result
 
     # Main 2
-    def sql(self, sql, database, format='json'):
+    def sql(self, sql, database, format='json', with_summary=False, paginate_by=None, page_size=None):
         '''
         Get data from SQL queries, you can use a list of SQL queries to get data in bulk.
 
         :param sql: One SQL query or a list of SQL queries.
         :param database: One database ID or a list or database IDs follow SQL list. Look at the database slug on the browser.
         :param format: json, csv, xlsx.
+        :param with_summary: Return (data, summary) with request counts, retries, bytes, rows and timing percentiles of this call. The summary of the last call is also kept in last_summary. Default is False.
+        :param paginate_by: A unique key column of the SQL result to read it in pages ordered by it, past the export row limit of Metabase. The SQL is wrapped as a subquery with WHERE, ORDER BY and LIMIT. Default is None.
+        :param page_size: Rows per page for paginate_by, None for just under export_row_limit. Default is None.
         :return: One data or a list of data.
         '''
-        self.query_count = 0
-        self.parse_count = 0
-        result = asyncio.run(self.SQL.query_sql(sqls=sql, databases=database, format=format.lower()))
-        return result
+        pagination = make_pagination(paginate_by=paginate_by, page_size=page_size)
+        result, summary = self.run(self.measure(self.SQL.query_sql(sqls=sql, databases=database, format=format.lower(), pagination=pagination)))
+        return (result, summary) if with_summary else result
+
+    # Main 3
+    def query_iter(self, url, format='csv', filter=None, filter_chunk_size=5000, partition_by=None, partitions=None, partition_range=None):
+        '''
+        Stream rows from one question URL while the response is downloading, memory stays flat for any export size.
+        Bulk filter chunks are streamed one after another, in order.
+
+        :param url: One URL as string.
+        :param format: json, csv.
+        :param filter: One dict.
+        :param filter_chunk_size: If you have a bulk value filter, the package will splits your values into chunks to send the requests, and then concat the results into a single data.
+        :param partition_by: A date or number column to split the URL into slices streamed one after another: a table field name, or a card or SQL filter slug. Default is None.
+        :param partitions: The number of equal slices, or an interval for date columns like '1d', '12h', '1w'. Default is None.
+        :param partition_range: (start, end) of partition_by, both included. None uses the range value of the filter, or the min and max of the field for table URLs. Default is None.
+        :return: A generator of rows, dicts for JSON, lists for CSV with the header row first.
+        '''
+
+        check_iter_args(url=url, format=format, filter=filter, filter_chunk_size=filter_chunk_size)
+        partition = make_partition(partition_by=partition_by, partitions=partitions, partition_range=partition_range)
+
+        return self.iterate(self.iter_url(url=url, format=format.lower(), filters=filter, filter_chunk_size=filter_chunk_size, partition=partition))
+
+    # Main 4
+    def query_to_file(self, url, path, format='csv', filter=None, filter_chunk_size=5000, with_summary=False, partition_by=None, partitions=None, partition_range=None):
+        '''
+        Write data from one question URL to a file, each bulk filter chunk is written as soon as it finishes.
+        The whole result is never held in memory, only the chunks in flight.
+
+        :param url: One URL as string.
+        :param path: Output file path, replaced when the query completes.
+        :param format: csv, jsonl, parquet. Parquet requires pyarrow.
+        :param filter: One dict.
+        :param filter_chunk_size: If you have a bulk value filter, the package will splits your values into chunks to send the requests, and then concat the results into a single data.
+        :param with_summary: Return (path, summary), see query(). Default is False.
+        :param partition_by: A date or number column to split the URL into slices written as soon as they finish: a table field name, or a card or SQL filter slug. Default is None.
+        :param partitions: The number of equal slices, or an interval for date columns like '1d', '12h', '1w'. Default is None.
+        :param partition_range: (start, end) of partition_by, both included. None uses the range value of the filter, or the min and max of the field for table URLs. Default is None.
+        :return: Output file path.
+        '''
+
+        check_file_args(url=url, format=format, filter=filter, filter_chunk_size=filter_chunk_size)
+        partition = make_partition(partition_by=partition_by, partitions=partitions, partition_range=partition_range)
+
+        result, summary = self.run(self.measure(self.write_url(url=url, path=path, format=format.lower(), filters=filter, filter_chunk_size=filter_chunk_size, partition=partition)))
+        return (result, summary) if with_summary else result
+
+
+    async def prepare_plan(self, session, url, format='json', filters=None, filter_chunk_size=5000, partition=None):
+        '''
+        Build export requests for any URL type.
+
+        :return: ChunkPlan, or PartitionPlan with a partition, of requests for export().
+        '''
+        url_type = define_url(url=url)
+        if url_type == 'sql':
+            return await self.SQL.prepare_url(session=session, url=url, format=format, filters=filters, filter_chunk_size=filter_chunk_size, partition=partition)
+        elif url_type == 'card':
+            return await self.Card.prepare_card(session=session, url=url, format=format, filters=filters, filter_chunk_size=filter_chunk_size, partition=partition)
+        elif url_type == 'dataset':
+            return await self.Dataset.prepare_dataset(session=session, url=url, format=format, filters=filters, filter_chunk_size=filter_chunk_size, partition=partition)
+
+    async def export_plan(self, session, plan, format='json', output=None, checkpoint=None):
+        '''
+        Send the export requests of a plan, combine the results if there are many chunks.
+
+        :param session: aiohttp.ClientSession.
+        :param plan: ChunkPlan from prepare_plan().
+        :param format: json, csv, xlsx.
+        :param output: None, arrow, pandas, numpy.
+        :param checkpoint: Checkpoint to save completed chunks to and resume from.
+        :return: Combined data.
+        '''
+        # Chunks of the same URL share one scheduler group.
+        group = id(plan)
+
+        if checkpoint is not None:
+            results = await self.export_checkpoint(session=session, plan=plan, format=format, output=output, group=group, checkpoint=checkpoint)
+            if not plan.is_bulk:
+                return results[0]
+            return await self.combine(results=results, format=output or format)
+
+        if not plan.is_bulk:
+            return await self.export(session=session, format=format, output=output, group=group, **plan.request)
+
+        # Adaptive chunk sizes split one filter only, the cartesian product of several filters uses fixed chunks.
+        if self.adaptive_chunking and len(plan.split_keys) == 1:
+            results = await self.export_adaptive(session=session, plan=plan, format=format, output=output, group=group)
+        else:
+            # Send requests to get data in bulk.
+            async def export(item):
+                i, r = item
+                return await self.export(session=session, format=format, output=output, group=group, chunk=i, **r)
+
+            results = await gather_bounded(function=export, items=list(enumerate(plan.requests())), workers=self.scheduler.max_in_flight)
+
+        return await self.combine(results=results, format=output or format)
+
+    async def export_adaptive(self, session, plan, format='json', output=None, group=None):
+        '''
+        Send the bulk chunks of a plan with adaptive chunk sizes.
+        The chunk size starts from the plan's filter_chunk_size and is tuned to reach chunk_target_seconds per request.
+        A chunk that fails with a timeout or a too large error is split in half right away, without retrying it first.
+
+        :return: A list of results or exceptions, in the order of values.
+        '''
+        key = plan.split_keys[0]
+        # Chunks are cut by the plan's byte cap, values differ in size so a number of values is not enough.
+        chunker = AdaptiveChunker(values=plan.values[key], chunk_size=len(plan.values[key]) / plan.parts[key], target_seconds=self.chunk_target_seconds, sizes=plan.value_sizes.get(key), max_bytes=plan.byte_caps.get(key))
+        if plan.max_values is not None or plan.max_body_size is not None:
+            # Do not grow over the value limit and the largest planned chunk.
+            chunker.max_size = plan.max_chunk_values(key)
+        results = {}
+
+        async def run(offset, values):
+            start = time.monotonic()
+            try:
+                # Split errors of a chunk that can be split are not retried, the halves are sent instead.
+                data = await self.export(session=session, format=format, output=output, group=group, chunk=offset, split_errors=len(values) > 1, **plan.build({key: values}))
+            except Exception as e:
+                if len(values) > 1 and is_split_error(e):
+                    self.print_if_verbose(f'Splitting a chunk of {len(values)} values: {e}')
+                    chunker.shrink(len(values))
+                    half = len(values) // 2
+                    await run(offset, values[:half])
+                    await run(offset + half, values[half:])
+                else:
+                    results[offset] = e
+                return
+            chunker.record(size=len(values), seconds=time.monotonic() - start, rows=count_rows(data, format=output or format))
+            results[offset] = data
+
+        async def worker():
+            chunk = chunker.next_chunk()
+            while chunk is not None:
+                await run(*chunk)
+                chunk = chunker.next_chunk()
+
+        # One worker per connection, so response times are not inflated by waiting for a slot.
+        await asyncio.gather(*[worker() for _ in range(self.scheduler.limit_per_domain)])
+
+        return [results[offset] for offset in sorted(results)]
+
+    async def export_checkpoint(self, session, plan, format='json', output=None, group=None, checkpoint=None):
+        '''
+        Send the chunks of a plan that are not in the checkpoint yet, save each chunk as soon as it completes.
+        Chunk sizes are fixed so a re-run finds the same chunks, adaptive_chunking is not used.
+
+        :return: A list of results, in the order of chunks.
+        :raise IncompleteResultError: If some chunks failed, after all chunks were tried.
+        '''
+        requests = plan.requests()
+        job = checkpoint.job(requests=requests, url=requests[0]['url'], format=format)
+
+        results = [job.load(i) for i in range(len(requests))]
+        missing = [i for i, data in enumerate(results) if data is None]
+        if len(missing) < len(requests):
+            self.print_if_verbose(f'Resuming from checkpoint: {len(requests) - len(missing)} of {len(requests)} chunks done')
+
+        # Spool the raw export, columnar outputs are decoded after loading.
+        async def export(i):
+            data = await self.export(session=session, format=format, group=group, chunk=i, **requests[i])
+            job.save(i, data)
+            return data
+
+        fetched = await gather_bounded(function=export, items=missing, workers=self.scheduler.max_in_flight)
 
+        errors = {}
+        for i, data in zip(missing, fetched):
+            if isinstance(data, Exception):
+                job.fail(i, data)
+                errors[i] = data
+            results[i] = data
+
+        if errors:
+            failed = sorted(errors)
+            raise IncompleteResultError(f'{len(failed)} of {len(requests)} chunks failed: {failed}. Completed chunks are saved in {job.directory}, run the same query again to fetch the failed chunks.', failed=failed, errors=errors, directory=job.directory)
+
+        if output:
+            results = [await self.decode_csv(data=data, output=output, column_types=r.get('column_types')) for data, r in zip(results, requests)]
+        return results
+
+    async def export_pages(self, session, page_request, key_names, limit, ranges, format='json', output=None, key_kind=None):
+        '''
+        Read keyset pages: each key range is read page by page in key order, the ranges run in parallel.
+        A page with fewer rows than limit is the last page of its range.
+
+        :param session: aiohttp.ClientSession.
+        :param page_request: Function of lower, after, upper and closed that returns the export request of a page, see pagination.page_query().
+        :param key_names: Possible names of the key column in the result.
+        :param limit: Rows per page.
+        :param ranges: A list of (lower, upper, closed) key ranges from Pagination.ranges().
+        :param format: json, csv.
+        :param output: None, arrow, pandas, numpy.
+        :param key_kind: Kind of the key to read it from CSV pages, see pagination.last_key().
+        :return: Combined data.
+        :raise IncompleteResultError: If some key ranges failed, after all ranges were tried.
+        '''
+        group = id(page_request)
+        numbers = itertools.count()
+
+        async def read_range(key_range):
+            lower, upper, closed = key_range
+            pages = []
+            after = None
+            while True:
+                data = await self.export(session=session, format=format, output=output, group=group, chunk=next(numbers), **page_request(lower=lower, after=after, upper=upper, closed=closed))
+                pages.append(data)
+                if count_rows(data, format=output or format) < limit:
+                    return pages
+                after = last_key(data, format=output or format, names=key_names, kind=key_kind)
+
+        if len(ranges) > 1:
+            self.print_if_verbose(f'Reading {len(ranges)} key ranges in parallel')
+        results = await gather_bounded(function=read_range, items=ranges, workers=self.scheduler.max_in_flight)
+
+        errors = {i: result for i, result in enumerate(results) if isinstance(result, Exception)}
+        if len(errors) == len(results):
+            raise results[0]
+        if errors:
+            # Rows of a failed range are missing in the middle of the key order, do not return the rest as complete.
+            failed = [ranges[i] for i in sorted(errors)]
+            raise IncompleteResultError(f'{len(failed)} of {len(ranges)} key ranges failed: {failed}.', failed=failed, errors=errors)
+        return await self.combine(results=[page for pages in results for page in pages], format=output or format)
+
+    # Async for streaming query
+    async def iter_url(self, url, format='csv', filters=None, filter_chunk_size=5000, partition=None):
+        '''
+        Async generator of rows for one URL, see query_iter().
+        '''
+        # One retry budget for all chunks, like a query() call.
+        budget = RetryBudget(self.retry_budget) if self.retry_budget is not None else None
+        async with self.session_context() as session:
+            # Set and reset within one step of the generator, steps may run in different contexts.
+            with use_retry_budget(budget), use_codec(self.json_codec):
+                plan = await self.prepare_plan(session=session, url=url, format=format, filters=filters, filter_chunk_size=filter_chunk_size, partition=partition)
+            for i, r in enumerate(plan.requests()):
+                rows = self.export_stream(session=session, format=format, header=i == 0, chunk=i, **r)
+                # Retries only happen before the first row, in the first step of the stream.
+                with use_retry_budget(budget), use_codec(self.json_codec):
+                    try:
+                        row = await rows.__anext__()
+                    except StopAsyncIteration:
+                        continue
+                yield row
+                async for row in rows:
+                    yield row
+
+    # Async for writing a file
+    async def write_url(self, url, path, format='csv', filters=None, filter_chunk_size=5000, partition=None):
+        '''
+        Export one URL chunk by chunk into a file, see query_to_file().
+        '''
+        sink = open_sink(path=path, format=format)
+        try:
+            async with self.call_context() as session:
+                plan = await self.prepare_plan(session=session, url=url, format=sink.export_format, filters=filters, filter_chunk_size=filter_chunk_size, partition=partition)
+                requests = plan.requests()
+
+                async def write(i):
+                    data = await self.export(session=session, format=sink.export_format, group=id(plan), chunk=i, **requests[i])
+                    sink.write_part(index=i, data=data, column_types=requests[i].get('column_types'))
+
+                results = await gather_bounded(function=write, items=list(range(len(requests))), workers=self.scheduler.max_in_flight)
+                for result in results:
+                    if isinstance(result, Exception):
+                        raise result
+
+            path = sink.finish()
+        except BaseException:
+            sink.abort()
+            raise
+
+        self.print_if_verbose(f'Wrote {sink.rows} rows to {path}')
+        return path
 
     # Async for URL query
-    async def handle_urls(self, urls, format='json', filters=None, filter_chunk_size=5000):
+    async def handle_urls(self, urls, format='json', filters=None, filter_chunk_size=5000, output=None, checkpoint=None, partition=None, pagination=None):
         '''
         Async allocation function for handling urls.
 
@@ -95,20 +689,34 @@ class Metabase(object):
         :param format: json, csv, xlsx.
         :param filters: One dict for a list of dicts.
         :param filter_chunk_size: If you have a bulk value filter, the package will splits your values into chunks to send the requests, and then concat the results into a single data.
+        :param output: None, arrow, pandas, numpy.
+        :param checkpoint: None, a directory or a Checkpoint object.
+        :param partition: None or a Partition to split each URL into slices.
+        :param pagination: None or a Pagination to read each URL in keyset pages.
         :return:
         '''
+        if pagination is not None and (partition is not None or checkpoint is not None):
+            raise ValueError('paginate_by can not be used with partition_by or checkpoint.')
 
-        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit_per_host=self.limit_per_host), timeout=aiohttp.ClientTimeout(total=self.timeout)) as session:
+        if checkpoint is not None and not isinstance(checkpoint, Checkpoint):
+            checkpoint = Checkpoint(directory=checkpoint)
+
+        # Columnar outputs are decoded from CSV exports.
+        record_format = output or format
+        if output:
+            format = 'csv'
+
+        async with self.call_context() as session:
 
             # 1 URL 1 filter
             if not isinstance(urls, list) and not isinstance(filters, list):
                 url_type = define_url(url=urls)
                 if url_type == 'sql':
-                    return await self.SQL.query_url(session=session, url=urls, format=format, filters=filters, filter_chunk_size=filter_chunk_size)
+                    return await self.SQL.query_url(session=session, url=urls, format=format, filters=filters, filter_chunk_size=filter_chunk_size, output=output, checkpoint=checkpoint, partition=partition, pagination=pagination)
                 elif url_type == 'card':
-                    return await self.Card.query_card(session=session, url=urls, format=format, filters=filters, filter_chunk_size=filter_chunk_size)
+                    return await self.Card.query_card(session=session, url=urls, format=format, filters=filters, filter_chunk_size=filter_chunk_size, output=output, checkpoint=checkpoint, partition=partition, pagination=pagination)
                 elif url_type == 'dataset':
-                    return await self.Dataset.query_dataset(session=session, url=urls, format=format, filters=filters, filter_chunk_size=filter_chunk_size)
+                    return await self.Dataset.query_dataset(session=session, url=urls, format=format, filters=filters, filter_chunk_size=filter_chunk_size, output=output, checkpoint=checkpoint, partition=partition, pagination=pagination)
 
             # Make sure URL list and Filter list are the same length.
             else:
@@ -123,34 +731,76 @@ class Metabase(object):
                     raise ValueError('Filter list and URL list must be the same length. Supported 1 dict - 1 list, and 1 list - 1 list.')
 
                 # Allocate URLs and Filters to functions.
-                tasks = []
-                for url, f in zip(urls, filters):
+                async def handle(pair):
+                    url, f = pair
                     url_type = define_url(url=url)
                     if url_type == 'sql':
-                        task = asyncio.create_task(self.SQL.query_url(session=session, url=url, format=format, filters=f, filter_chunk_size=filter_chunk_size))
-                        task.url = url
-                        task.filter = f
-                        tasks.append(task)
+                        return await self.SQL.query_url(session=session, url=url, format=format, filters=f, filter_chunk_size=filter_chunk_size, output=output, checkpoint=checkpoint, partition=partition, pagination=pagination)
                     elif url_type == 'card':
-                        task = asyncio.create_task(self.Card.query_card(session=session, url=url, format=format, filters=f, filter_chunk_size=filter_chunk_size))
-                        task.url = url
-                        task.filter = f
-                        tasks.append(task)
+                        return await self.Card.query_card(session=session, url=url, format=format, filters=f, filter_chunk_size=filter_chunk_size, output=output, checkpoint=checkpoint, partition=partition, pagination=pagination)
                     elif url_type == 'dataset':
-                        task = asyncio.create_task(self.Dataset.query_dataset(session=session, url=url, format=format, filters=f, filter_chunk_size=filter_chunk_size))
-                        task.url = url
-                        task.filter = f
-                        tasks.append(task)
+                        return await self.Dataset.query_dataset(session=session, url=url, format=format, filters=f, filter_chunk_size=filter_chunk_size, output=output, checkpoint=checkpoint, partition=partition, pagination=pagination)
 
-                await asyncio.gather(*tasks, return_exceptions=True)
+                pairs = list(zip(urls, filters))
 
-                record_results = [{'url': task.url, 'filter': task.filter, 'format': format, 'data': task.result()} for task in tasks]
+                # Duplicate pairs are queried once.
+                unique_pairs = {}
+                for pair in pairs:
+                    unique_pairs.setdefault(json.dumps(pair, sort_keys=True, default=str), pair)
+                unique_results = await gather_bounded(function=handle, items=list(unique_pairs.values()), workers=self.scheduler.max_in_flight)
+                unique_results = dict(zip(unique_pairs, unique_results))
+                results = [unique_results[json.dumps(pair, sort_keys=True, default=str)] for pair in pairs]
+
+                record_results = []
+                for (url, f), result in zip(pairs, results):
+                    if isinstance(result, Exception):
+                        raise result
+                    record_results.append({'url': url, 'filter': f, 'format': record_format, 'data': result})
 
                 return record_results
 
 
+    async def decode_json(self, body, column_sort=None):
+        '''
+        Decode JSON export bytes, in the decoder's workers if set.
+        '''
+        if self.decoder is None:
+            return decode_json(body=body, column_sort=column_sort, codec=self.json_codec)
+        return await self.decoder.decode_json(body=body, column_sort=column_sort, codec=self.json_codec)
+
+    async def decode_csv(self, data, output, column_types=None):
+        '''
+        Decode CSV export bytes into columns, in the decoder's workers if set.
+        '''
+        if self.decoder is None:
+            return decode_csv(data=data, output=output, column_types=column_types)
+        return await self.decoder.decode_csv(data=data, output=output, column_types=column_types)
+
+    async def combine(self, results, format='json'):
+        '''
+        combine_results() of chunks, in a decoder thread if set.
+        '''
+        if self.decoder is None:
+            return combine_results(results=results, format=format, verbose=self.verbose)
+        return await self.decoder.combine(results=results, format=format, verbose=self.verbose)
+
+    def export_request(self, form_data, event):
+        '''
+        Headers and body of an export request: the accepted response encodings, and a gzip body from compress_request_size bytes.
+        Body sizes before and after compression go to the event.
+
+        :return: (headers, body bytes).
+        '''
+        headers = {'Content-Type': 'application/x-www-form-urlencoded;charset=UTF-8', 'X-Metabase-Session': self.metabase_session, 'Accept-Encoding': self.accept_encoding}
+        body = encode_body(form_data)
+        data, encoding = compress_body(body, min_size=self.compress_request_size)
+        if encoding:
+            headers['Content-Encoding'] = encoding
+        event.update(request_bytes=len(body), request_wire_bytes=len(data))
+        return headers, data
+
     # Fetch data with retry
-    async def export(self, session, url, form_data, format='json', column_sort=None):
+    async def export(self, session, url, form_data, format='json', column_sort=None, column_types=None, output=None, group=None, chunk=None, split_errors=False):
         '''
         This function support fetch data with retry.
 
@@ -159,49 +809,338 @@ class Metabase(object):
         :param form_data: Form data with dumped value.
         :param format: json, csv, xlsx.
         :param column_sort: Column sort order.
+        :param column_types: Map column display name to Metabase base type, for columnar outputs.
+        :param output: None, arrow, pandas, numpy. Columnar outputs decode a CSV export.
+        :param group: Scheduler group, requests of one URL share a group.
+        :param chunk: Chunk index for the request event.
+        :param split_errors: Do not retry timeout and too large errors, see retry_policy().
         :return:
         '''
 
         # Count for log
-        self.query_count += 1
-        query_number = self.query_count
+        query_number = self.next_number('export')
+        event = new_event(kind='export', url=url, chunk=chunk)
+        event['number'] = query_number
 
-        # Default headers of export API endpoint.
-        headers = {'Content-Type': 'application/x-www-form-urlencoded;charset=UTF-8', 'X-Metabase-Session': self.metabase_session}
+        # Encoded once for all attempts and the single-flight key.
+        payload = encode_body(form_data)
 
-        @retry(stop=stop_after_attempt(self.retry_attempts), reraise=True)
+        @retry(**self.retry_policy(query_number=query_number, event=event, split_errors=split_errors))
         async def handler():
-            # Print log
-            self.print_if_verbose(f'Querying {query_number}...')
+            headers, data = self.export_request(form_data=payload, event=event)
+
+            # Wait for a free slot, the timeout starts when the request is sent.
+            wait_start = time.monotonic()
+            async with self.request_slot(url=url, group=group):
+                # Print log
+                self.print_if_verbose(f'Querying {query_number}...')
+
+                start = time.monotonic()
+                event.update(wait=start - wait_start, dns=None, connect=None, status=None)
+                response = await session.post(url, headers=headers, data=data, trace_request_ctx=event, auto_decompress=False)
+                event.update(status=response.status, ttfb=time.monotonic() - start)
+
+                # Raise if error: Connection, Timeout, Metabase server slowdown
+                response.raise_for_status()
 
-            response = await session.post(url, headers=headers, data=form_data)
+                body = await BodyReader(response=response, event=event).read_all()
+                event.update(bytes=len(body), download=time.monotonic() - start - event['ttfb'], seconds=time.monotonic() - start)
 
-            # Raise if error: Connection, Timeout, Metabase server slowdown
-            response.raise_for_status()
+                # Success -> JSON array or content, Error -> JSON object
+                if body[:64].lstrip()[:1] == b'{' and b'"error"' in body:
+                    data = self.json_codec.loads(body)
+                    if isinstance(data, dict) and 'error' in data:
+                        raise metabase_error(data=data, status=response.status, retry_errors=self.retry_errors, retry_after=response.headers.get('Retry-After'))
 
+            # Decode after the slot is freed, another request can download meanwhile.
             # JSON
             if format == 'json':
-                data = await response.json()
-                if 'error' in data:
-                    return raise_retry_errors(error=data['error'], retry_errors=self.retry_errors)
-                elif column_sort:
-                    data = [{col: record[col] for col in column_sort if col in record} for record in data]
+                return await self.decode_json(body=body, column_sort=column_sort)
 
-            # XLSX, CSV: Success -> Content, Error -> JSON
-            else:
-                data = await response.read()
-                if b'"error":' in data:
-                    data = await response.json()
-                    return raise_retry_errors(error=data['error'], retry_errors=self.retry_errors)
+            # XLSX, CSV
+            return body
 
-            return data
+        async def fetch():
+            # Same query in the result cache: skip the network.
+            if self.result_cache is not None:
+                result = self.result_cache.get(cache_key)
+                if result is not None:
+                    event['source'] = 'cache'
+                    self.print_if_verbose(f'Cached data {query_number}')
+                    return result
 
-        # Call handler
-        result = await handler()
-        # Raise for user errors
-        if isinstance(result, Exception):
-            raise result
-        else:
-            # Print log then return
+            event['source'] = 'network'
+            result = await handler()
+            if self.result_cache is not None:
+                self.result_cache.set(cache_key, result)
             self.print_if_verbose(f'Received data {query_number}')
-            return result
\ No newline at end of file
+            return result
+
+        # Normalizing the payload is costly for big filters, only done for the result cache.
+        cache_key = ResultCache.make_key(url=url, form_data=form_data, column_sort=column_sort, metabase_session=self.metabase_session) if self.result_cache is not None else None
+        try:
+            if self.single_flight is None:
+                result = await fetch()
+            else:
+                # Identical requests in flight share one call.
+                result = await self.single_flight.do(key=('export', SingleFlight.make_key(url=url, body=payload, column_sort=column_sort)), function=fetch)
+        except Exception as e:
+            event.update(source=event['source'] or 'shared', error=f'{type(e).__name__}: {e}', status=getattr(e, 'status', None) or event['status'])
+            self.emit(event)
+            raise
+
+        # No fetch() of its own: the result came from an identical request in flight.
+        event['source'] = event['source'] or 'shared'
+        event['rows'] = count_rows(result, format=format)
+        if self.export_row_limit is not None and format in ['json', 'csv'] and event['rows'] >= self.export_row_limit:
+            event['truncated'] = True
+            self.print_if_verbose(f'Data {query_number} has {event["rows"]} rows, the export row limit of Metabase. Rows over the limit are missing, use paginate_by or partition_by to get them.')
+        self.emit(event)
+
+        if output:
+            result = await self.decode_csv(data=result, output=output, column_types=column_types)
+        return result
+
+
+    # Stream data with retry
+    async def export_stream(self, session, url, form_data, format='csv', column_sort=None, column_types=None, header=True, read_size=2 ** 16, chunk=None):
+        '''
+        Like export() but yield rows while the response is downloading.
+        Retry only happens before the first row is yielded.
+
+        :param session: aiohttp.ClientSession
+        :param url: Export URL.
+        :param form_data: Form data with dumped value.
+        :param format: json, csv.
+        :param column_sort: Column sort order.
+        :param column_types: Not used, rows are not typed.
+        :param header: Yield the CSV header row or not.
+        :param read_size: Bytes to read from the response at a time.
+        :param chunk: Chunk index for the request event.
+        :return: Async generator of rows.
+        '''
+
+        # Count for log
+        query_number = self.next_number('export')
+        event = new_event(kind='stream', url=url, chunk=chunk)
+        event.update(number=query_number, source='network', rows=0, bytes=0)
+
+        @retry(**self.retry_policy(query_number=query_number, event=event))
+        async def handler():
+            headers, data = self.export_request(form_data=form_data, event=event)
+
+            # A slot per attempt, not held while waiting to retry. After the first chunk it is kept
+            # in the stack until the response is fully read, the circuit breaker measures up to the first chunk.
+            stack = AsyncExitStack()
+            wait_start = time.monotonic()
+            try:
+                async with self.request_slot(url=url, stack=stack):
+                    # Print log
+                    self.print_if_verbose(f'Querying {query_number}...')
+
+                    event.update(start=time.monotonic(), dns=None, connect=None, status=None)
+                    event['wait'] = event['start'] - wait_start
+                    response = await session.post(url, headers=headers, data=data, trace_request_ctx=event, auto_decompress=False)
+                    event.update(status=response.status, ttfb=time.monotonic() - event['start'])
+
+                    # Raise if error: Connection, Timeout, Metabase server slowdown
+                    response.raise_for_status()
+
+                    # Success -> Content, Error -> JSON object
+                    reader = BodyReader(response=response, event=event)
+                    first_chunk = await reader.read(read_size)
+                    if first_chunk.lstrip().startswith(b'{'):
+                        data = self.json_codec.loads(first_chunk + await reader.read_all())
+                        raise metabase_error(data=data, status=response.status, retry_errors=self.retry_errors, retry_after=response.headers.get('Retry-After'))
+            except BaseException:
+                await stack.aclose()
+                raise
+
+            return reader, first_chunk, stack
+
+        try:
+            async for row in self._read_stream(handler=handler, format=format, column_sort=column_sort, header=header, read_size=read_size, event=event):
+                yield row
+        except Exception as e:
+            event.update(error=f'{type(e).__name__}: {e}', status=getattr(e, 'status', None) or event['status'])
+            raise
+        finally:
+            start = event.pop('start', None)
+            if start is not None:
+                event['seconds'] = time.monotonic() - start
+                if event['ttfb'] is not None:
+                    event['download'] = event['seconds'] - event['ttfb']
+            self.emit(event)
+
+        # Print log
+        self.print_if_verbose(f'Received data {query_number}')
+
+    async def _read_stream(self, handler, format, column_sort, header, read_size, event):
+        # Call handler, the stack holds the scheduler slot until the response is read.
+        reader, chunk, stack = await handler()
+        parser = JSONArrayParser() if format == 'json' else CSVRowParser()
+        is_header = format == 'csv'
+        try:
+            while chunk:
+                event['bytes'] += len(chunk)
+                for row in parser.feed(chunk):
+                    if is_header:
+                        is_header = False
+                        if not header:
+                            continue
+                    else:
+                        event['rows'] += 1
+                        if column_sort and format == 'json':
+                            row = {col: row[col] for col in column_sort if col in row}
+                    yield row
+                chunk = await reader.read(read_size)
+
+            for row in parser.close():
+                if is_header:
+                    is_header = False
+                    if not header:
+                        continue
+                else:
+                    event['rows'] += 1
+                    if column_sort and format == 'json':
+                        row = {col: row[col] for col in column_sort if col in row}
+                yield row
+        finally:
+            reader.response.release()
+            await stack.aclose()
+
+
+class AsyncMetabase(Metabase):
+    def __init__(self, metabase_session, session=None, **kwargs):
+        '''
+        Async-native Metabase object for asyncio applications, it runs on the caller's event loop.
+        Other settings are the same as Metabase.
+
+        :param metabase_session: Your Metabase Session.
+        :param session: An aiohttp.ClientSession to share with your application. Default is None, then open() creates one.
+        '''
+        super().__init__(metabase_session, **kwargs)
+        self.session = session
+        self._owns_session = False
+
+    async def open(self):
+        '''
+        Create a session that is reused by every query() and sql() call until close().
+
+        :return: AsyncMetabase object.
+        '''
+        if self.session is None or self.session.closed:
+            self.session = self.create_session()
+            self._owns_session = True
+        return self
+
+    async def close(self):
+        '''
+        Close the session if it was created by open(), a session passed by the caller is left open.
+        Stop the decoder's workers.
+        '''
+        if self.decoder is not None:
+            self.decoder.close()
+
+        if self._owns_session and self.session is not None:
+            await self.session.close()
+        self.session = None
+        self._owns_session = False
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    def __enter__(self):
+        raise TypeError('Use "async with AsyncMetabase(...)" instead of "with".')
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def iterate(self, async_generator):
+        raise TypeError('AsyncMetabase runs on the caller\'s event loop, use "async for" instead.')
+
+    def run(self, coroutine):
+        raise TypeError('AsyncMetabase runs on the caller\'s event loop, await its methods instead.')
+
+    async def query(self, url, format='json', filter=None, filter_chunk_size=5000, output=None, checkpoint=None, with_summary=False, partition_by=None, partitions=None, partition_range=None, paginate_by=None, page_size=None):
+        '''
+        Get data from any question URL, you can use a list of URLs or a list of filters to get data in bulk.
+
+        :param url: One URL as string for a list of URLs.
+        :param format: json, csv, xlsx.
+        :param filter: One dict for a list of dicts.
+        :param filter_chunk_size: If you have a bulk value filter, the package will splits your values into chunks to send the requests, and then concat the results into a single data.
+        :param output: None to return data in format, or arrow, pandas, numpy to decode the export into typed columns, format is ignored. Default is None.
+        :param checkpoint: A directory or a Checkpoint object to save completed chunks to. Running the same query again only fetches the missing and failed chunks, IncompleteResultError tells which chunks failed. Default is None.
+        :param with_summary: Return (data, summary) with request counts, retries, bytes, rows and timing percentiles of this call. The summary of the last call is also kept in last_summary. Default is False.
+        :param partition_by: A date or number column to split each URL into slices that run in parallel and are merged in order: a table field name, or a card or SQL filter slug. Default is None.
+        :param partitions: The number of equal slices, or an interval for date columns like '1d', '12h', '1w'. Default is None.
+        :param partition_range: (start, end) of partition_by, both included. None uses the range value of the filter, or the min and max of the field for table URLs. Default is None.
+        :param paginate_by: A unique key column to read table and SQL URLs in pages ordered by it, past the export row limit of Metabase: a table field name or a SQL column name. Default is None.
+        :param page_size: Rows per page for paginate_by, None for just under export_row_limit. Default is None.
+        :return: One data or a list of data.
+        '''
+        check_query_args(format=format, filter_chunk_size=filter_chunk_size, output=output)
+        partition = make_partition(partition_by=partition_by, partitions=partitions, partition_range=partition_range)
+        pagination = make_pagination(paginate_by=paginate_by, page_size=page_size)
+        result, summary = await self.measure(self.handle_urls(urls=url, format=format.lower(), filters=filter, filter_chunk_size=filter_chunk_size, output=output, checkpoint=checkpoint, partition=partition, pagination=pagination))
+        return (result, summary) if with_summary else result
+
+    async def sql(self, sql, database, format='json', with_summary=False, paginate_by=None, page_size=None):
+        '''
+        Get data from SQL queries, you can use a list of SQL queries to get data in bulk.
+
+        :param sql: One SQL query or a list of SQL queries.
+        :param database: One database ID or a list or database IDs follow SQL list. Look at the database slug on the browser.
+        :param format: json, csv, xlsx.
+        :param with_summary: Return (data, summary) with request counts, retries, bytes, rows and timing percentiles of this call. The summary of the last call is also kept in last_summary. Default is False.
+        :param paginate_by: A unique key column of the SQL result to read it in pages ordered by it, past the export row limit of Metabase. The SQL is wrapped as a subquery with WHERE, ORDER BY and LIMIT. Default is None.
+        :param page_size: Rows per page for paginate_by, None for just under export_row_limit. Default is None.
+        :return: One data or a list of data.
+        '''
+        pagination = make_pagination(paginate_by=paginate_by, page_size=page_size)
+        result, summary = await self.measure(self.SQL.query_sql(sqls=sql, databases=database, format=format.lower(), pagination=pagination))
+        return (result, summary) if with_summary else result
+
+    async def query_iter(self, url, format='csv', filter=None, filter_chunk_size=5000, partition_by=None, partitions=None, partition_range=None):
+        '''
+        Stream rows from one question URL while the response is downloading, memory stays flat for any export size.
+        Bulk filter chunks are streamed one after another, in order.
+
+        :param url: One URL as string.
+        :param format: json, csv.
+        :param filter: One dict.
+        :param filter_chunk_size: If you have a bulk value filter, the package will splits your values into chunks to send the requests, and then concat the results into a single data.
+        :param partition_by: A date or number column to split the URL into slices streamed one after another: a table field name, or a card or SQL filter slug. Default is None.
+        :param partitions: The number of equal slices, or an interval for date columns like '1d', '12h', '1w'. Default is None.
+        :param partition_range: (start, end) of partition_by, both included. None uses the range value of the filter, or the min and max of the field for table URLs. Default is None.
+        :return: An async generator of rows, dicts for JSON, lists for CSV with the header row first.
+        '''
+        check_iter_args(url=url, format=format, filter=filter, filter_chunk_size=filter_chunk_size)
+        partition = make_partition(partition_by=partition_by, partitions=partitions, partition_range=partition_range)
+
+        async for row in self.iter_url(url=url, format=format.lower(), filters=filter, filter_chunk_size=filter_chunk_size, partition=partition):
+            yield row
+
+    async def query_to_file(self, url, path, format='csv', filter=None, filter_chunk_size=5000, with_summary=False, partition_by=None, partitions=None, partition_range=None):
+        '''
+        Write data from one question URL to a file, each bulk filter chunk is written as soon as it finishes.
+
+        :param url: One URL as string.
+        :param path: Output file path, replaced when the query completes.
+        :param format: csv, jsonl, parquet. Parquet requires pyarrow.
+        :param filter: One dict.
+        :param filter_chunk_size: If you have a bulk value filter, the package will splits your values into chunks to send the requests, and then concat the results into a single data.
+        :param with_summary: Return (path, summary), see query(). Default is False.
+        :param partition_by: A date or number column to split the URL into slices written as soon as they finish: a table field name, or a card or SQL filter slug. Default is None.
+        :param partitions: The number of equal slices, or an interval for date columns like '1d', '12h', '1w'. Default is None.
+        :param partition_range: (start, end) of partition_by, both included. None uses the range value of the filter, or the min and max of the field for table URLs. Default is None.
+        :return: Output file path.
+        '''
+        check_file_args(url=url, format=format, filter=filter, filter_chunk_size=filter_chunk_size)
+        partition = make_partition(partition_by=partition_by, partitions=partitions, partition_range=partition_range)
+        result, summary = await self.measure(self.write_url(url=url, path=path, format=format.lower(), filters=filter, filter_chunk_size=filter_chunk_size, partition=partition))
+        return (result, summary) if with_summary else result
@@ -0,0 +1,183 @@
+import asyncio
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+from .retries import is_retryable
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, math.ceil(p / 100 * len(values)) - 1))
+    return values[index]
+
+
+class CircuitBreaker:
+    def __init__(self, domain, window=50, min_requests=10, error_rate=0.5, latency_threshold=None, open_seconds=30, recovery_requests=8, on_state_change=None):
+        '''
+        Circuit breaker of one Metabase domain.
+        Closed: requests go through. Open: requests wait for open_seconds. Half-open: a few probe requests go through,
+        the number of probes doubles on each success until recovery_requests succeed, then it closes.
+
+        :param domain: Metabase domain.
+        :param window: Number of recent requests to measure.
+        :param min_requests: Do not trip before this number of requests in the window.
+        :param error_rate: Trip when the rate of server errors in the window reaches this value.
+        :param latency_threshold: Trip when the p95 response time in seconds reaches this value, None to ignore latency.
+        :param open_seconds: Seconds to pause requests when tripped.
+        :param recovery_requests: Successful probes needed to close again.
+        :param on_state_change: Function called with domain and new state.
+        '''
+        self.domain = domain
+        self.min_requests = min_requests
+        self.error_rate = error_rate
+        self.latency_threshold = latency_threshold
+        self.open_seconds = open_seconds
+        self.recovery_requests = recovery_requests
+        self.on_state_change = on_state_change
+
+        self.state = CLOSED
+        self.results = deque(maxlen=window)
+        self.open_until = 0
+        self.probe_limit = 1
+        self.probes_in_flight = 0
+        self.probe_successes = 0
+        self.trips = 0
+
+    def _set_state(self, state):
+        if state == self.state:
+            return
+        self.state = state
+        if self.on_state_change:
+            self.on_state_change(self.domain, state)
+
+    def _trip(self):
+        self.trips += 1
+        self.open_until = time.monotonic() + self.open_seconds
+        self.results.clear()
+        self._set_state(OPEN)
+
+    async def wait(self):
+        '''
+        Wait until a request may be sent.
+
+        :return: True if the request is a half-open probe.
+        '''
+        while True:
+            if self.state == CLOSED:
+                return False
+
+            if self.state == OPEN:
+                delay = self.open_until - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+                self.probe_limit = 1
+                self.probe_successes = 0
+                self._set_state(HALF_OPEN)
+
+            if self.probes_in_flight < self.probe_limit:
+                self.probes_in_flight += 1
+                return True
+
+            await asyncio.sleep(min(1, self.open_seconds / 10))
+
+    def record(self, ok, seconds, probe=False):
+        '''
+        Record a finished request.
+
+        :param ok: False for server errors, timeouts and connection errors.
+        :param seconds: Response time.
+        :param probe: Value returned by wait().
+        '''
+        if probe:
+            self.probes_in_flight -= 1
+
+        if self.state == HALF_OPEN:
+            # Requests sent before the breaker opened say nothing about the recovery, only probes count.
+            if not probe:
+                return
+            if not ok:
+                self._trip()
+                return
+            self.probe_successes += 1
+            # Resume gradually: more probes after each success.
+            self.probe_limit *= 2
+            if self.probe_successes >= self.recovery_requests:
+                self._set_state(CLOSED)
+            return
+
+        if self.state == OPEN:
+            return
+
+        self.results.append((ok, seconds))
+        if len(self.results) < self.min_requests:
+            return
+
+        errors = sum(1 for r in self.results if not r[0])
+        if errors / len(self.results) >= self.error_rate:
+            self._trip()
+        elif self.latency_threshold is not None and percentile([r[1] for r in self.results], 95) >= self.latency_threshold:
+            self._trip()
+
+    @asynccontextmanager
+    async def guard(self, slot):
+        '''
+        Wait while the breaker is open, then enter slot and record the result of the request.
+
+        :param slot: Async context manager to enter after the wait, e.g. Scheduler.slot(). Its wait is not measured.
+        '''
+        probe = await self.wait()
+        try:
+            async with slot:
+                start = time.monotonic()
+                try:
+                    yield
+                except Exception as e:
+                    self.record(ok=not is_retryable(e), seconds=time.monotonic() - start, probe=probe)
+                    probe = False
+                    raise
+                self.record(ok=True, seconds=time.monotonic() - start, probe=probe)
+                probe = False
+        finally:
+            # Cancelled before a result, free the probe.
+            if probe:
+                self.probes_in_flight -= 1
+
+    def stats(self):
+        latencies = [r[1] for r in self.results]
+        return {
+            'state': self.state,
+            'requests': len(self.results),
+            'error_rate': sum(1 for r in self.results if not r[0]) / len(self.results) if self.results else 0,
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'trips': self.trips
+        }
+
+
+class CircuitBreakers:
+    def __init__(self, **settings):
+        '''
+        One CircuitBreaker per Metabase domain, created on first use.
+
+        :param settings: CircuitBreaker settings, e.g. error_rate=0.5, latency_threshold=120, open_seconds=30.
+        '''
+        self.settings = settings
+        self.breakers = {}
+
+    def get(self, domain):
+        if domain not in self.breakers:
+            self.breakers[domain] = CircuitBreaker(domain=domain, **self.settings)
+        return self.breakers[domain]
+
+    def stats(self):
+        return {domain: breaker.stats() for domain, breaker in self.breakers.items()}
@@ -0,0 +1,375 @@
+import hashlib
+import json
+import os
+import time
+import zlib
+from collections import OrderedDict
+from urllib import parse
+
+from . import codec
+
+
+def compress_result(data, level=6):
+    '''
+    Compress export data into a blob: bytes (CSV, XLSX) are kept as bytes, JSON data is dumped.
+    '''
+    if isinstance(data, (bytes, bytearray)):
+        return b'b' + zlib.compress(data, level)
+    return b'j' + zlib.compress(codec.dumps(data).encode('utf-8'), level)
+
+
+def decompress_result(blob):
+    data = zlib.decompress(blob[1:])
+    if blob[:1] == b'b':
+        return data
+    return codec.loads(data)
+
+
+def session_hash(metabase_session):
+    '''
+    Short hash of a Metabase session for cache keys, the session itself is not stored.
+    '''
+    return hashlib.sha256(metabase_session.encode('utf-8')).hexdigest()[:16] if metabase_session else None
+
+
+class MetadataCache:
+    def __init__(self, ttl=600, maxsize=256, directory=None):
+        '''
+        Cache for card and table metadata, keyed by domain + object type + object ID + a hash of the Metabase session.
+        Sessions do not share entries, so a session only gets metadata it was allowed to fetch.
+
+        :param ttl: Seconds an entry stays fresh, None to never expire. Default is 600.
+        :param maxsize: Maximum entries kept in memory, the least recently used entry is evicted first. Default is 256.
+        :param directory: Optional directory to also store entries on disk as JSON files, so they survive restarts. Default is None.
+        '''
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.directory = directory
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._entries = OrderedDict()
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def make_key(domain, kind, object_id, metabase_session=None):
+        return (domain.rstrip('/'), kind, str(object_id), session_hash(metabase_session))
+
+    def _path(self, key):
+        name = hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, f'{name}.json')
+
+    def _is_expired(self, expires_at):
+        return expires_at is not None and expires_at <= time.time()
+
+    def _read_disk(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if self._is_expired(entry['expires_at']):
+            self._remove_disk(key)
+            self.expirations += 1
+            return None
+        return entry['expires_at'], entry['value']
+
+    def _write_disk(self, key, expires_at, value):
+        path = self._path(key)
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'key': key, 'expires_at': expires_at, 'value': value}, f)
+        os.replace(tmp_path, path)
+
+    def _remove_disk(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def get(self, key):
+        '''
+        Get a fresh entry, or None when it is missing or expired.
+        Entries are shared between calls, treat them as read-only.
+        '''
+        entry = self._entries.get(key)
+        if entry is not None and self._is_expired(entry[0]):
+            del self._entries[key]
+            self.expirations += 1
+            entry = None
+
+        if entry is None and self.directory:
+            entry = self._read_disk(key)
+            if entry is not None:
+                self._store(key, entry)
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value):
+        expires_at = time.time() + self.ttl if self.ttl is not None else None
+        self._store(key, (expires_at, value))
+        if self.directory:
+            self._write_disk(key, expires_at, value)
+
+    def _store(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while self.maxsize is not None and len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, domain=None, kind=None, object_id=None):
+        '''
+        Remove entries matching all given arguments, e.g. after a question is re-saved.
+
+        :param domain: Metabase domain, e.g. https://your-domain.com.
+        :param kind: card or table.
+        :param object_id: Card ID or table ID.
+        :return: Number of removed entries.
+        '''
+        def match(key):
+            return (domain is None or key[0] == domain.rstrip('/')) and (kind is None or key[1] == kind) and (object_id is None or key[2] == str(object_id))
+
+        keys = [k for k in self._entries if match(k)]
+        for key in keys:
+            del self._entries[key]
+            if self.directory:
+                self._remove_disk(key)
+
+        # Entries only on disk
+        if self.directory:
+            for name in os.listdir(self.directory):
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(self.directory, name)
+                try:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        key = tuple(json.load(f)['key'])
+                except (OSError, ValueError, KeyError):
+                    continue
+                if match(key):
+                    os.remove(path)
+                    if key not in keys:
+                        keys.append(key)
+
+        return len(keys)
+
+    def clear(self):
+        return self.invalidate()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'size': len(self._entries)
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ResultCache:
+    def __init__(self, ttl=300, max_bytes=256 * 2 ** 20, directory=None, compress_level=6):
+        '''
+        Cache for export results, keyed by a hash of the export URL, the normalized payload and the Metabase session.
+        Sessions do not share results, so a result is only returned to a session the server gave it to.
+        Results are stored as compressed blobs, in memory or in a directory.
+
+        :param ttl: Seconds a result stays fresh, None to never expire. Default is 300.
+        :param max_bytes: Maximum compressed bytes to keep, the least recently used result is evicted first. Default is 256 MB.
+        :param directory: Store results in this directory instead of memory. Default is None.
+        :param compress_level: zlib level from 1 (fast) to 9 (small). Default is 6.
+        '''
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.compress_level = compress_level
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._entries = OrderedDict()
+        self._size = 0
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def normalize_payload(form_data):
+        if isinstance(form_data, (bytes, str)):
+            if isinstance(form_data, bytes):
+                form_data = form_data.decode('utf-8')
+            form_data = dict(parse.parse_qsl(form_data, keep_blank_values=True))
+
+        payload = {}
+        for name, value in (form_data or {}).items():
+            try:
+                payload[name] = json.loads(value)
+            except (TypeError, ValueError):
+                payload[name] = value
+        return payload
+
+    @classmethod
+    def make_key(cls, url, form_data, column_sort=None, metabase_session=None):
+        '''
+        Hash of the export URL (domain, endpoint and format), the normalized payload, the column order and the Metabase session.
+        '''
+        parts = [url, cls.normalize_payload(form_data), column_sort]
+        if metabase_session:
+            parts.append(session_hash(metabase_session))
+        key = json.dumps(parts, sort_keys=True, separators=(',', ':'), default=str)
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.z')
+
+    def _is_expired(self, expires_at):
+        return expires_at is not None and expires_at <= time.time()
+
+    def get(self, key):
+        '''
+        Get a fresh result, or None when it is missing or expired.
+        '''
+        blob = self._get_disk(key) if self.directory else self._get_memory(key)
+        if blob is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return decompress_result(blob)
+
+    def _get_memory(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if self._is_expired(entry[0]):
+            self._size -= len(entry[1])
+            del self._entries[key]
+            self.expirations += 1
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def _get_disk(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                header = json.loads(f.readline())
+                blob = f.read()
+        except (OSError, ValueError):
+            return None
+        if self._is_expired(header['expires_at']):
+            self._remove_disk(path)
+            self.expirations += 1
+            return None
+        # Last access time for LRU eviction.
+        os.utime(path)
+        return blob
+
+    def set(self, key, data):
+        blob = compress_result(data, level=self.compress_level)
+        if self.max_bytes is not None and len(blob) > self.max_bytes:
+            return
+        expires_at = time.time() + self.ttl if self.ttl is not None else None
+
+        if self.directory:
+            path = self._path(key)
+            tmp_path = f'{path}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(json.dumps({'expires_at': expires_at}).encode('utf-8') + b'\n')
+                f.write(blob)
+            os.replace(tmp_path, path)
+            self._evict_disk()
+        else:
+            if key in self._entries:
+                self._size -= len(self._entries.pop(key)[1])
+            self._entries[key] = (expires_at, blob)
+            self._size += len(blob)
+            while self.max_bytes is not None and self._size > self.max_bytes:
+                self._size -= len(self._entries.popitem(last=False)[1][1])
+                self.evictions += 1
+
+    def _disk_files(self):
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.z'):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def _remove_disk(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _evict_disk(self):
+        if self.max_bytes is None:
+            return
+        files = sorted(self._disk_files())
+        size = sum(f[1] for f in files)
+        for _, file_size, path in files:
+            if size <= self.max_bytes:
+                break
+            self._remove_disk(path)
+            size -= file_size
+            self.evictions += 1
+
+    def invalidate(self, key=None):
+        '''
+        Remove one result, or all results if key is None.
+
+        :return: Number of removed results.
+        '''
+        if self.directory:
+            paths = [self._path(key)] if key else [f[2] for f in self._disk_files()]
+            paths = [p for p in paths if os.path.exists(p)]
+            for path in paths:
+                self._remove_disk(path)
+            return len(paths)
+
+        keys = [key] if key else list(self._entries)
+        keys = [k for k in keys if k in self._entries]
+        for k in keys:
+            self._size -= len(self._entries.pop(k)[1])
+        return len(keys)
+
+    def clear(self):
+        return self.invalidate()
+
+    def stats(self):
+        if self.directory:
+            files = self._disk_files()
+            size, count = sum(f[1] for f in files), len(files)
+        else:
+            size, count = self._size, len(self._entries)
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'size': count,
+            'bytes': size
+        }
+
+    def __len__(self):
+        return len(self._disk_files()) if self.directory else len(self._entries)
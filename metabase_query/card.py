@@ -1,10 +1,12 @@
-import asyncio
 import copy
-import json
 import re
 from urllib import parse
 
-from .utils import split_list, combine_results, parse_filters
+from .utils import parse_filters
+from . import codec
+from .chunking import ChunkPlan, placeholder, template_builder
+from .partition import partition_plan
+from .cache import MetadataCache
 
 
 class Card:
@@ -22,8 +24,7 @@ class Card:
         :return: Card data as dict.
         '''
         # Print log
-        self.metabase.parse_count += 1
-        parse_number = self.metabase.parse_count
+        parse_number = self.metabase.next_number('parse')
         self.metabase.print_if_verbose(f'Parsing URL and verifying Metabase Session {parse_number}')
 
         # Parse URL
@@ -33,9 +34,7 @@ class Card:
         query = parse.parse_qs(parse_result.query)
 
         # Fetch card information
-        headers = {'Content-Type': 'application/json', 'X-Metabase-Session': self.metabase.metabase_session}
         card_url = f'{domain}/api/card/{question}'
-        response = await session.get(url=card_url, headers=headers)
 
         # Raise if error
         error_dict = {
@@ -43,20 +42,16 @@ class Card:
             404: 'Question is not exist, or you do not have permission',
         }
 
-        if not response.ok:
-            if response.status in error_dict:
-                raise PermissionError(error_dict[response.status])
-            else:
-                response.raise_for_status()
-
-        card_data = await response.json()
+        card_data = await self.metabase.fetch_metadata(session=session, url=card_url, cache_key=MetadataCache.make_key(domain, 'card', question, self.metabase.metabase_session), error_dict=error_dict)
 
         # Find column sort
         result_metadata = card_data.get('result_metadata')
         if result_metadata:
             column_sort = [col['display_name'] for col in result_metadata]
+            column_types = {col['display_name']: col.get('base_type') for col in result_metadata}
         else:
             column_sort = None
+            column_types = None
 
         # Create parameters
         parameters = []
@@ -137,58 +132,96 @@ class Card:
             'domain': domain,
             'question': question,
             'parameters': parameters,
-            'column_sort': column_sort
+            'parameter_slugs': list(query) if parameters else [],
+            'column_sort': column_sort,
+            'column_types': column_types
         }
 
         return data
 
 
-    async def export_card(self, session, card_data, format='json'):
+    def card_request(self, card_data, format='json'):
         url = f"{card_data['domain']}/api/card/{card_data['question']}/query/{format}"
-        form_data = {'parameters': json.dumps(card_data['parameters'])}
-        return await self.metabase.export(session=session, url=url, form_data=form_data, format=format, column_sort=card_data['column_sort'])
+        form_data = {'parameters': codec.dumps(card_data['parameters'])}
+        return {'url': url, 'form_data': form_data, 'column_sort': card_data['column_sort'], 'column_types': card_data['column_types']}
 
 
-    async def query_card(self, session, url, format='json', filters=None, filter_chunk_size=5000):
+    async def export_card(self, session, card_data, format='json'):
+        return await self.metabase.export(session=session, format=format, **self.card_request(card_data=card_data, format=format))
+
+
+    async def prepare_card(self, session, url, format='json', filters=None, filter_chunk_size=5000, partition=None):
         '''
-        Send one request or multiple requests to get data from Metabase.
+        Parse a card and build one export request, or one export request per chunk for a bulk filter.
 
         :param session: aiohttp.ClientSession
         :param url: URL from browser.
         :param format: json, csv, xlsx.
         :param filters: A dict.
         :param filter_chunk_size: If you have a bulk value filter, the package will splits your values into chunks to send the requests, and then concat the results into a single data.
-        :return: Combined data.
+        :param partition: Partition to split the card into slices of a date or number filter.
+        :return: ChunkPlan, or PartitionPlan with one ChunkPlan per slice, of requests for Metabase.export.
         '''
-
-
         filters, max_filter_key, max_filter_value_count = parse_filters(filters)
 
+        bulk_filters = filters
+        if partition is not None:
+            bulk_filters = {k: v for k, v in (filters or {}).items() if k != partition.column}
+            if partition.range is not None and partition.column not in (filters or {}):
+                # Add the partition filter to the parameters, its value is set per slice.
+                # A value of the filter is kept, partition_range still wins when slicing it.
+                filters = dict(filters or {}, **{partition.column: list(partition.range)})
+
         card_data = await self.parse_card(session=session, url=url, filters=filters)
 
-        # Send one request if there are no filter has values > filter_chunk_size
-        if max_filter_value_count <= filter_chunk_size:
-            return await self.export_card(session=session, card_data=card_data, format=format)
-        else:
-            if format not in ['json', 'csv']:
-                raise ValueError(f'Package only supports JSON and CSV formats with bulk filter values due to data combining limitations. Your {max_filter_key} filter is over filter_chunk_size {max_filter_value_count}/{filter_chunk_size}.')
+        def chunk_plan(card_data):
+            request = self.card_request(card_data=card_data, format=format)
 
-            # Slit values to chunks > Create a list of card_data
-            value_list = split_list(input_list=filters[max_filter_key], chunk_size=filter_chunk_size)
-            card_data_list = []
-            for value in value_list:
+            # Payload template of card_data, the values of chunked filters are filled per chunk
+            def template_request(keys):
                 new_card_data = copy.deepcopy(card_data)
                 for parameter in new_card_data['parameters']:
-                    if parameter['target'][-1][-1] == max_filter_key:
-                        parameter['value'] = value
+                    if parameter['target'][-1][-1] in keys:
+                        parameter['value'] = [placeholder(parameter['target'][-1][-1])]
+                return self.card_request(card_data=new_card_data, format=format)
+
+            # One request if no filter needs splitting
+            plan = ChunkPlan(request=request, build=template_builder(request=request, template_request=template_request), values=bulk_filters, chunk_size=filter_chunk_size, max_values=self.metabase.max_filter_values, max_body_size=self.metabase.max_body_size)
+
+            if plan.is_bulk and format not in ['json', 'csv']:
+                raise ValueError(f'Package only supports JSON and CSV formats with bulk filter values due to data combining limitations. Your {", ".join(plan.split_keys)} {"filters are" if len(plan.split_keys) > 1 else "filter is"} over filter_chunk_size, max_filter_values or max_body_size.')
 
-                card_data_list.append(new_card_data)
+            return plan
 
-            # Send requests to get data in bulk.
-            tasks = []
-            for c in card_data_list:
-                task = asyncio.create_task(self.export_card(session=session, card_data=c, format=format))
-                tasks.append(task)
+        if partition is None:
+            return chunk_plan(card_data)
 
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-            return combine_results(results=results, format=format, verbose=self.metabase.verbose)
\ No newline at end of file
+        # One plan per slice of the partition filter
+        if partition.column not in card_data['parameter_slugs']:
+            raise ValueError(f'Set partition_range, or a range value for the {partition.column} filter such as 2024-01-01~2024-01-31.')
+        index = card_data['parameter_slugs'].index(partition.column)
+        parameters = card_data['parameters']
+        plans = [chunk_plan(dict(card_data, parameters=parameters[:index] + [p] + parameters[index + 1:])) for p in partition.parameter_slices(parameters[index])]
+        self.metabase.print_if_verbose(f'Partitioning {partition.column} into {len(plans)} slices')
+        return partition_plan(plans=plans, format=format)
+
+
+    async def query_card(self, session, url, format='json', filters=None, filter_chunk_size=5000, output=None, checkpoint=None, partition=None, pagination=None):
+        '''
+        Send one request or multiple requests to get data from Metabase.
+
+        :param session: aiohttp.ClientSession
+        :param url: URL from browser.
+        :param format: json, csv, xlsx.
+        :param filters: A dict.
+        :param filter_chunk_size: If you have a bulk value filter, the package will splits your values into chunks to send the requests, and then concat the results into a single data.
+        :param output: None, arrow, pandas, numpy. Columnar outputs need format csv.
+        :param checkpoint: Checkpoint to save completed chunks to and resume from.
+        :param partition: Partition to split the card into slices of a date or number filter.
+        :param pagination: Not supported, saved questions can not be ordered and limited.
+        :return: Combined data.
+        '''
+        if pagination is not None:
+            raise ValueError('paginate_by supports table and SQL URLs, saved questions can not be ordered and limited. Use partition_by instead.')
+        plan = await self.prepare_card(session=session, url=url, format=format, filters=filters, filter_chunk_size=filter_chunk_size, partition=partition)
+        return await self.metabase.export_plan(session=session, plan=plan, format=format, output=output, checkpoint=checkpoint)
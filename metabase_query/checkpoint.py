@@ -0,0 +1,142 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from .cache import ResultCache, compress_result, decompress_result
+
+
+class IncompleteResultError(Exception):
+    def __init__(self, message, failed, errors, directory=None):
+        '''
+        Some chunks of a bulk query failed. Completed chunks are kept in the checkpoint directory,
+        run the same query again to fetch the failed chunks only.
+        Also raised when some key ranges of a paged query failed.
+
+        :param message: Error message.
+        :param failed: Indexes of the failed chunks, or the failed (lower, upper, closed) key ranges of a paged query.
+        :param errors: Map chunk or key range index to its exception.
+        :param directory: Spool directory of the job.
+        '''
+        super().__init__(message)
+        self.failed = failed
+        self.errors = errors
+        self.directory = directory
+
+
+class CheckpointJob:
+    def __init__(self, directory, keys, url=None, format=None):
+        '''
+        Spool of one bulk query: one compressed file per completed chunk and a manifest.
+
+        :param directory: Spool directory of the job.
+        :param keys: Chunk keys in order, see ResultCache.make_key().
+        :param url: URL of the query, for the manifest.
+        :param format: Export format, for the manifest.
+        '''
+        self.directory = directory
+        self.keys = keys
+        os.makedirs(directory, exist_ok=True)
+
+        self.manifest = self._read_manifest() or {'url': url, 'format': format, 'created_at': time.time(), 'chunks': len(keys), 'done': [], 'failed': {}}
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.directory, 'manifest.json')
+
+    def _read_manifest(self):
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_manifest(self):
+        tmp_path = f'{self.manifest_path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _path(self, index):
+        return os.path.join(self.directory, f'{index}-{self.keys[index][:16]}.z')
+
+    def load(self, index):
+        '''
+        Get the spooled data of a completed chunk, or None.
+        '''
+        if index not in self.manifest['done']:
+            return None
+        try:
+            with open(self._path(index), 'rb') as f:
+                return decompress_result(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def save(self, index, data):
+        path = self._path(index)
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(compress_result(data))
+        os.replace(tmp_path, path)
+
+        if index not in self.manifest['done']:
+            self.manifest['done'].append(index)
+        self.manifest['failed'].pop(str(index), None)
+        self._write_manifest()
+
+    def fail(self, index, error):
+        self.manifest['failed'][str(index)] = f'{type(error).__name__}: {error}'
+        self._write_manifest()
+
+    @property
+    def failed(self):
+        return sorted(int(i) for i in self.manifest['failed'])
+
+
+class Checkpoint:
+    def __init__(self, directory):
+        '''
+        Resumable bulk queries: each completed chunk is saved to a job directory with a manifest,
+        running the same query again only fetches the missing and failed chunks.
+
+        :param directory: Spool directory, one sub directory per job.
+        '''
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def job(self, requests, url=None, format=None):
+        '''
+        Open the job of a list of export requests, the same requests always open the same job.
+
+        :param requests: Export requests of a ChunkPlan.
+        :return: CheckpointJob.
+        '''
+        keys = [ResultCache.make_key(url=r['url'], form_data=r['form_data'], column_sort=r.get('column_sort')) for r in requests]
+        name = hashlib.sha256(json.dumps(keys).encode('utf-8')).hexdigest()[:32]
+        return CheckpointJob(directory=os.path.join(self.directory, name), keys=keys, url=url, format=format)
+
+    def jobs(self):
+        '''
+        :return: Manifests of all jobs, keyed by job directory.
+        '''
+        manifests = {}
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name, 'manifest.json')
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    manifests[os.path.join(self.directory, name)] = json.load(f)
+            except (OSError, ValueError):
+                continue
+        return manifests
+
+    def clear(self):
+        '''
+        Remove all jobs.
+
+        :return: Number of removed jobs.
+        '''
+        names = [n for n in os.listdir(self.directory) if os.path.isdir(os.path.join(self.directory, n))]
+        for name in names:
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+        return len(names)
@@ -0,0 +1,335 @@
+import asyncio
+import bisect
+import itertools
+import math
+import re
+from urllib import parse
+
+import aiohttp
+
+from . import codec
+
+# Errors that a smaller chunk may avoid.
+SPLIT_STATUSES = [413, 414, 431, 502, 504]
+SPLIT_ERRORS = 'too large|too long|too many|payload|entity|timed? ?out|timeout|memory'
+
+# Separator of values in a compact JSON list, URL-encoded.
+VALUE_SEPARATOR = parse.quote_plus(',')
+
+
+def split_parts(values, parts):
+    '''
+    Split values into a number of parts with sizes differing by at most one, in order.
+    '''
+    size, extra = divmod(len(values), parts)
+    chunks = []
+    start = 0
+    for i in range(parts):
+        end = start + size + (1 if i < extra else 0)
+        chunks.append(values[start:end])
+        start = end
+    return chunks
+
+
+def plan_parts(value_counts, chunk_size, max_values=None):
+    '''
+    Choose the number of chunks per filter key.
+    Each key with more than chunk_size values is split on its own, the requests are the cartesian product of the chunks of all keys.
+    With max_values, keys are split further until the values of all keys in one request fit the budget,
+    each step splits the key that removes the most values for the least extra requests.
+
+    :param value_counts: Map filter key to number of values.
+    :param chunk_size: Maximum values per key per request.
+    :param max_values: Maximum values of all keys per request, None for no limit.
+    :return: Map filter key to number of chunks.
+    '''
+    parts = {key: max(1, math.ceil(count / chunk_size)) for key, count in value_counts.items()}
+
+    def chunk_of(key, n):
+        return math.ceil(value_counts[key] / n) if value_counts[key] else 0
+
+    while max_values is not None and sum(chunk_of(key, n) for key, n in parts.items()) > max_values:
+        candidates = [key for key, n in parts.items() if chunk_of(key, n) > 1]
+        if not candidates:
+            # One value per key is still over the budget.
+            break
+
+        def gain(key):
+            n = parts[key]
+            return (chunk_of(key, n) - chunk_of(key, n + 1)) / math.log((n + 1) / n)
+
+        parts[max(candidates, key=gain)] += 1
+
+    return parts
+
+
+def body_size(form_data):
+    '''
+    Bytes of a URL-encoded request body.
+    '''
+    if isinstance(form_data, (bytes, bytearray)):
+        return len(form_data)
+    return len(parse.urlencode(form_data))
+
+
+def value_size(value):
+    '''
+    Bytes one filter value adds to a URL-encoded body, with its separator in the JSON list.
+    '''
+    return len(parse.quote_plus(codec.dumps(value))) + len(VALUE_SEPARATOR)
+
+
+def byte_caps(totals, budget):
+    '''
+    Share a byte budget between filter keys to get the fewest requests:
+    keys that fit their share are sent whole, the rest of the budget is shared equally by the other keys.
+
+    :param totals: Map filter key to the bytes of all its values.
+    :param budget: Bytes available for filter values in one request.
+    :return: Map filter key to the maximum bytes of one chunk.
+    '''
+    caps = {}
+    keys = sorted(totals, key=lambda k: totals[k])
+    for i, key in enumerate(keys):
+        share = budget / (len(keys) - i)
+        caps[key] = min(totals[key], share)
+        budget -= caps[key]
+    return caps
+
+
+def split_sizes(values, sizes, max_count, max_size):
+    '''
+    Split values in order, a chunk is closed before it goes over max_count values or max_size bytes.
+    A value larger than max_size gets a chunk of its own.
+    '''
+    chunks = []
+    start = 0
+    chunk_size = 0
+    for i, size in enumerate(sizes):
+        if i > start and (i - start >= max_count or chunk_size + size > max_size):
+            chunks.append(values[start:i])
+            start = i
+            chunk_size = 0
+        chunk_size += size
+    if start < len(values):
+        chunks.append(values[start:])
+    return chunks
+
+
+def placeholder(key):
+    '''
+    Stand-in value of a filter key in a payload template.
+    '''
+    return f'__metabase_query_chunk_{key}__'
+
+
+def encode_values(values):
+    '''
+    URL-encoded JSON list items of values, without the brackets.
+    '''
+    return parse.quote_plus(codec.dumps(values)[1:-1]).encode('utf-8')
+
+
+class PayloadTemplate:
+    def __init__(self, form_data, keys):
+        '''
+        URL-encoded request body compiled once, with the values of some filters left out.
+        Rendering a chunk joins the pre-encoded pieces around the encoded values, the rest of the payload is not copied or serialized again.
+
+        :param form_data: Form data where the JSON values of each key are a list holding placeholder(key) only.
+        :param keys: Filter keys of the placeholders.
+        '''
+        encoded = {parse.quote_plus(codec.dumps(placeholder(key))): key for key in keys}
+        pieces = re.split('(' + '|'.join(re.escape(p) for p in encoded) + ')', parse.urlencode(form_data)) if encoded else [parse.urlencode(form_data)]
+        self.literals = [piece.encode('utf-8') for piece in pieces[0::2]]
+        self.keys = [encoded[piece] for piece in pieces[1::2]]
+
+    def render(self, chunk):
+        '''
+        :param chunk: Map filter key to a list of values.
+        :return: Request body as bytes.
+        '''
+        values = {key: encode_values(chunk[key]) for key in set(self.keys)}
+        body = [self.literals[0]]
+        for key, literal in zip(self.keys, self.literals[1:]):
+            body.append(values[key])
+            body.append(literal)
+        return b''.join(body)
+
+
+def template_builder(request, template_request):
+    '''
+    Build chunk requests from payload templates, one template per set of chunked keys.
+
+    :param request: The request with all values, its other fields are shared by the chunk requests.
+    :param template_request: Function of a tuple of filter keys, returns a request with [placeholder(key)] as the values of these keys.
+    :return: build function for ChunkPlan.
+    '''
+    templates = {}
+
+    def build(chunk):
+        keys = tuple(chunk)
+        if keys not in templates:
+            templates[keys] = PayloadTemplate(form_data=template_request(keys)['form_data'], keys=keys)
+        return dict(request, form_data=templates[keys].render(chunk))
+
+    return build
+
+
+class ChunkPlan:
+    def __init__(self, request=None, build=None, values=None, chunk_size=None, max_values=None, max_body_size=None):
+        '''
+        Export requests of one URL: one request, or one request per combination of bulk filter chunks.
+
+        :param request: The request when no filter needs splitting.
+        :param build: Function to build a request from a dict of filter key to a chunk of its values, keys not in the dict keep all values.
+        :param values: Map filter key to its list of values.
+        :param chunk_size: Maximum values per key per request.
+        :param max_values: Maximum values of all keys per request, None for no limit.
+        :param max_body_size: Maximum bytes of a URL-encoded request body, None for no limit.
+        '''
+        self.request = request
+        self.build = build
+        self.values = values or {}
+        self.chunk_size = chunk_size
+        self.max_values = max_values
+        self.max_body_size = max_body_size
+
+        self.chunks = {}
+        # With max_body_size: bytes of each value and the maximum bytes of one chunk, per key.
+        self.value_sizes = {}
+        self.byte_caps = {}
+        if build is not None and self.values:
+            parts = plan_parts(value_counts={key: len(v) for key, v in self.values.items()}, chunk_size=chunk_size, max_values=max_values)
+            if max_body_size is None:
+                chunks = {key: split_parts(self.values[key], n) for key, n in parts.items()}
+            else:
+                chunks = self._split_bytes(parts)
+            self.chunks = {key: c for key, c in chunks.items() if len(c) > 1}
+
+    def _split_bytes(self, parts):
+        # Body bytes without any filter value, then the bytes of each value.
+        empty = body_size(self.build({key: [] for key in self.values})['form_data'])
+        sizes = {key: [value_size(v) for v in values] for key, values in self.values.items()}
+        caps = byte_caps(totals={key: sum(s) for key, s in sizes.items()}, budget=self.max_body_size - empty)
+        self.value_sizes, self.byte_caps = sizes, caps
+
+        chunks = {}
+        for key, values in self.values.items():
+            max_count = math.ceil(len(values) / parts[key]) if values else 1
+            chunks[key] = split_sizes(values, sizes[key], max_count=max_count, max_size=caps[key])
+        return chunks
+
+    @property
+    def parts(self):
+        return {key: len(c) for key, c in self.chunks.items()}
+
+    @property
+    def is_bulk(self):
+        return bool(self.chunks)
+
+    @property
+    def split_keys(self):
+        return list(self.chunks)
+
+    def requests(self):
+        if not self.is_bulk:
+            return [self.request]
+        return [self.build(dict(zip(self.chunks, combination))) for combination in itertools.product(*self.chunks.values())]
+
+    def max_chunk_values(self, key):
+        '''
+        Values of the largest planned chunk of a key, an upper bound for adaptive chunk sizes when limits are set.
+        '''
+        return max(len(c) for c in self.chunks[key])
+
+
+class AdaptiveChunker:
+    def __init__(self, values, chunk_size, target_seconds=30, max_rows=500000, sizes=None, max_bytes=None):
+        '''
+        Hand out chunks of values, the size grows or shrinks to reach target_seconds per request.
+
+        :param values: Bulk filter values.
+        :param chunk_size: The first chunk size.
+        :param target_seconds: Wanted response time per request.
+        :param max_rows: Keep the expected rows per request under this number.
+        :param sizes: Bytes of each value, see value_size(). Needed for max_bytes.
+        :param max_bytes: Maximum bytes of the values of one chunk, None for no limit. A value larger than it gets a chunk of its own.
+        '''
+        self.values = values
+        self.size = float(chunk_size)
+        self.target_seconds = target_seconds
+        self.max_rows = max_rows
+        self.max_size = None
+        self.max_bytes = max_bytes
+        self.position = 0
+
+        # Bytes of the values before each position, to cut chunks by bytes.
+        self._ends = list(itertools.accumulate(sizes)) if max_bytes is not None else None
+
+    def next_chunk(self):
+        '''
+        :return: (offset, values), or None when all values are handed out.
+        '''
+        if self.position >= len(self.values):
+            return None
+        offset = self.position
+        end = min(len(self.values), offset + max(1, int(self.size)))
+        if self.max_bytes is not None:
+            # The last value that fits in max_bytes, one value at least.
+            start_bytes = self._ends[offset - 1] if offset else 0
+            end = max(offset + 1, bisect.bisect_right(self._ends, start_bytes + self.max_bytes, offset, end))
+        self.position = end
+        return offset, self.values[offset:end]
+
+    def record(self, size, seconds, rows=None):
+        '''
+        Tune the next chunk size from a finished request.
+        '''
+        # Grow or shrink at most 2 times per request to avoid jumping on one slow response.
+        new_size = size * self.target_seconds / max(seconds, 0.001)
+        new_size = min(max(new_size, size / 2), size * 2)
+
+        if rows:
+            new_size = min(new_size, self.max_rows / (rows / size))
+        if self.max_size:
+            new_size = min(new_size, self.max_size)
+
+        self.size = max(1.0, new_size)
+
+    def shrink(self, size):
+        '''
+        A request of this size failed, send smaller chunks from now on and do not grow back to this size.
+        '''
+        self.max_size = max(1.0, min(self.max_size or size, size / 2))
+        self.size = min(self.size, self.max_size)
+
+
+def is_split_error(error):
+    '''
+    Return True if a smaller chunk may succeed where this error happened.
+    '''
+    if isinstance(error, asyncio.TimeoutError):
+        return True
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status in SPLIT_STATUSES
+    return bool(re.search(pattern=SPLIT_ERRORS, string=str(error), flags=re.IGNORECASE))
+
+
+def count_rows(data, format):
+    '''
+    Rows of an export result, None for formats without a row count, e.g. xlsx.
+
+    :param data: Result of export().
+    :param format: Export format or columnar output: json, csv, arrow, pandas, numpy.
+    '''
+    if format == 'json' and isinstance(data, list):
+        return len(data)
+    elif format == 'csv' and isinstance(data, bytes):
+        return max(0, data.count(b'\n') - 1)
+    elif format == 'numpy' and isinstance(data, dict):
+        # Dict of numpy arrays
+        return len(next(iter(data.values()), []))
+    elif format in ['arrow', 'pandas']:
+        return len(data)
+    return None
@@ -0,0 +1,107 @@
+import json
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from .columnar import has_module, import_optional
+
+# JSON codec of the query() or sql() call running in this context.
+current_codec = ContextVar('metabase_query_codec', default=None)
+
+
+class JSONCodec:
+    '''
+    Standard library json. Writes compact JSON, the same bytes as OrjsonCodec for request payloads.
+    '''
+    name = 'json'
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def dumps(self, obj):
+        return json.dumps(obj, separators=(',', ':'), ensure_ascii=False)
+
+
+class OrjsonCodec(JSONCodec):
+    '''
+    orjson, decodes bytes without building a str first. Objects orjson can not write
+    (integers over 64 bits, non-string keys) fall back to the standard library.
+    orjson reads integers over 64 bits as floats, use JSONCodec if results hold them.
+    '''
+    name = 'orjson'
+
+    def __init__(self):
+        self._orjson = import_optional('orjson', 'orjson')
+
+    def __getstate__(self):
+        # Modules can not be pickled, process decoders import orjson again.
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    def loads(self, data):
+        try:
+            return self._orjson.loads(data)
+        except self._orjson.JSONDecodeError:
+            return super().loads(data)
+
+    def dumps(self, obj):
+        try:
+            return self._orjson.dumps(obj).decode('utf-8')
+        except self._orjson.JSONEncodeError:
+            return super().dumps(obj)
+
+
+CODECS = {'json': JSONCodec, 'orjson': OrjsonCodec}
+
+
+def make_codec(codec='auto'):
+    '''
+    :param codec: auto for orjson if installed else json, a codec name, or an object with loads(bytes) and dumps(obj) that returns compact JSON text.
+    :return: Codec object.
+    '''
+    if codec == 'auto':
+        codec = 'orjson' if has_module('orjson') else 'json'
+    if isinstance(codec, str):
+        if codec not in CODECS:
+            raise ValueError(f'json_codec must be auto, one of {", ".join(CODECS)}, or an object with loads and dumps.')
+        return CODECS[codec]()
+    if not (hasattr(codec, 'loads') and hasattr(codec, 'dumps')):
+        raise ValueError('json_codec must have loads and dumps methods.')
+    return codec
+
+
+default_codec = make_codec()
+
+
+def get_codec():
+    '''
+    :return: The codec of the current call, or the default codec.
+    '''
+    return current_codec.get() or default_codec
+
+
+@contextmanager
+def use_codec(codec):
+    '''
+    Use a codec for every payload and response handled inside this block.
+    '''
+    token = current_codec.set(codec)
+    try:
+        yield codec
+    finally:
+        current_codec.reset(token)
+
+
+def loads(data):
+    '''
+    Decode JSON bytes or text with the current codec.
+    '''
+    return get_codec().loads(data)
+
+
+def dumps(obj):
+    '''
+    Encode an object to compact JSON text with the current codec.
+    '''
+    return get_codec().dumps(obj)
@@ -0,0 +1,135 @@
+import csv
+import importlib
+import io
+
+OUTPUTS = ['arrow', 'pandas', 'numpy']
+
+# Metabase base types to column types, other types stay as text.
+INTEGER_TYPES = ['type/Integer', 'type/BigInteger']
+FLOAT_TYPES = ['type/Float', 'type/Decimal', 'type/Number']
+BOOLEAN_TYPES = ['type/Boolean']
+
+
+def import_optional(module, output):
+    try:
+        return importlib.import_module(module)
+    except ImportError:
+        package = module.split('.')[0]
+        raise ImportError(f"'{output}' requires {package}, install it with: pip install {package}") from None
+
+
+def has_module(module):
+    try:
+        importlib.import_module(module)
+        return True
+    except ImportError:
+        return False
+
+
+def column_kind(base_type):
+    if base_type in INTEGER_TYPES:
+        return 'int'
+    elif base_type in FLOAT_TYPES:
+        return 'float'
+    elif base_type in BOOLEAN_TYPES:
+        return 'bool'
+    return None
+
+
+def decode_arrow(data, column_types=None):
+    pa = import_optional('pyarrow', 'arrow')
+    pa_csv = import_optional('pyarrow.csv', 'arrow')
+
+    arrow_types = {'int': pa.int64(), 'float': pa.float64(), 'bool': pa.bool_()}
+    types = {}
+    for name, base_type in (column_types or {}).items():
+        kind = column_kind(base_type)
+        types[name] = arrow_types[kind] if kind else pa.string()
+
+    convert_options = pa_csv.ConvertOptions(column_types=types, strings_can_be_null=True)
+    return pa_csv.read_csv(pa.py_buffer(data), convert_options=convert_options)
+
+
+def decode_numpy(data, column_types=None):
+    np = import_optional('numpy', 'numpy')
+
+    if has_module('pyarrow'):
+        table = decode_arrow(data, column_types=column_types)
+        return {name: table.column(name).to_numpy() for name in table.column_names}
+
+    reader = csv.reader(io.TextIOWrapper(io.BytesIO(data), encoding='utf-8', newline=''))
+    header = next(reader, [])
+    columns = [list(values) for values in zip(*reader)] or [[] for _ in header]
+
+    numpy_types = {'int': np.int64, 'float': np.float64}
+    arrays = {}
+    for name, values in zip(header, columns):
+        kind = column_kind((column_types or {}).get(name))
+        if kind in numpy_types and '' in values:
+            # Empty values are nulls, keep them as NaN.
+            arrays[name] = np.array([v if v != '' else 'nan' for v in values], dtype=np.float64)
+        elif kind in numpy_types:
+            arrays[name] = np.array(values, dtype=numpy_types[kind])
+        elif kind == 'bool':
+            arrays[name] = np.array([v.lower() == 'true' for v in values], dtype=bool)
+        else:
+            arrays[name] = np.array(values, dtype=object)
+    return arrays
+
+
+def decode_pandas(data, column_types=None):
+    pd = import_optional('pandas', 'pandas')
+
+    if has_module('pyarrow'):
+        return decode_arrow(data, column_types=column_types).to_pandas()
+
+    pandas_types = {'int': 'Int64', 'float': 'float64', 'bool': 'boolean'}
+    dtype = {}
+    for name, base_type in (column_types or {}).items():
+        kind = column_kind(base_type)
+        dtype[name] = pandas_types[kind] if kind else 'string'
+    return pd.read_csv(io.BytesIO(data), dtype=dtype)
+
+
+def decode_csv(data, output, column_types=None):
+    '''
+    Decode CSV export bytes into columns.
+
+    :param data: CSV bytes.
+    :param output: arrow, pandas, numpy.
+    :param column_types: Map column display name to Metabase base type, e.g. type/Integer.
+    :return: pyarrow.Table, pandas.DataFrame or a dict of numpy arrays.
+    '''
+    if output == 'arrow':
+        return decode_arrow(data, column_types=column_types)
+    elif output == 'pandas':
+        return decode_pandas(data, column_types=column_types)
+    elif output == 'numpy':
+        return decode_numpy(data, column_types=column_types)
+    raise ValueError(f'output must be one of {", ".join(OUTPUTS)}.')
+
+
+def concat(results, output):
+    '''
+    Concatenate chunks by column.
+
+    :param results: A list of pyarrow.Table, pandas.DataFrame or dicts of numpy arrays.
+    :param output: arrow, pandas, numpy.
+    :return: One table.
+    '''
+    if output == 'arrow':
+        pa = import_optional('pyarrow', output)
+        try:
+            return pa.concat_tables(results, promote_options='default')
+        except TypeError:
+            # pyarrow < 14
+            return pa.concat_tables(results, promote=True)
+    elif output == 'pandas':
+        pd = import_optional('pandas', output)
+        return pd.concat(results, ignore_index=True)
+    elif output == 'numpy':
+        np = import_optional('numpy', output)
+        if not results:
+            return {}
+        return {name: np.concatenate([r[name] for r in results]) for name in results[0]}
+    raise ValueError(f'output must be one of {", ".join(OUTPUTS)}.')
@@ -0,0 +1,213 @@
+import gzip
+import zlib
+from urllib import parse
+
+from .columnar import has_module, import_optional
+
+# Response encodings in order of preference: best ratio and speed for large CSV and JSON first.
+ENCODINGS = ['zstd', 'br', 'gzip', 'deflate']
+
+
+def zstd_module():
+    # Python 3.14+ has zstd in the standard library.
+    for module in ['compression.zstd', 'zstandard']:
+        if has_module(module):
+            return module
+    return None
+
+
+def brotli_module():
+    for module in ['brotli', 'brotlicffi']:
+        if has_module(module):
+            return module
+    return None
+
+
+def available_encodings():
+    '''
+    :return: Response encodings that can be decompressed here, in order of preference.
+    '''
+    available = {'zstd': zstd_module() is not None, 'br': brotli_module() is not None, 'gzip': True, 'deflate': True}
+    return [e for e in ENCODINGS if available[e]]
+
+
+def accept_encoding(encodings='auto'):
+    '''
+    Accept-Encoding header of export requests.
+
+    :param encodings: auto for all available encodings, None or False for identity, or a list like ['gzip'].
+    :return: Header value.
+    '''
+    if encodings == 'auto':
+        encodings = available_encodings()
+    elif not encodings:
+        return 'identity'
+    elif isinstance(encodings, str):
+        encodings = [e.strip() for e in encodings.split(',')]
+
+    available = available_encodings()
+    for encoding in encodings:
+        if encoding not in ENCODINGS:
+            raise ValueError(f'accept_encoding must be auto, None, or a list of {", ".join(ENCODINGS)}.')
+        if encoding not in available:
+            package = 'zstandard' if encoding == 'zstd' else 'brotli'
+            raise ImportError(f"'{encoding}' responses require {package}, install it with: pip install {package}")
+    return ', '.join(encodings)
+
+
+class ZlibDecompressor:
+    def __init__(self, encoding):
+        '''
+        gzip or deflate, across gzip members. deflate is zlib-wrapped or raw, told apart by the first byte.
+        '''
+        self.encoding = encoding
+        self._obj = zlib.decompressobj(wbits=47) if encoding == 'gzip' else None
+
+    def feed(self, chunk):
+        if self._obj is None:
+            # zlib header: compression method 8 in the low bits of the first byte.
+            self._obj = zlib.decompressobj(wbits=15 if chunk[0] & 0x0f == 8 else -15)
+        data = self._obj.decompress(chunk)
+        # Concatenated gzip members
+        while self.encoding == 'gzip' and self._obj.eof and self._obj.unused_data:
+            rest = self._obj.unused_data
+            self._obj = zlib.decompressobj(wbits=47)
+            data += self._obj.decompress(rest)
+        return data
+
+    def flush(self):
+        return self._obj.flush() if self._obj is not None else b''
+
+
+class BrotliDecompressor:
+    def __init__(self):
+        self._obj = import_optional(brotli_module() or 'brotli', 'br').Decompressor()
+
+    def feed(self, chunk):
+        # brotli has process(), brotlicffi has decompress().
+        if hasattr(self._obj, 'process'):
+            return self._obj.process(chunk)
+        return self._obj.decompress(chunk)
+
+    def flush(self):
+        return b''
+
+
+class ZstdDecompressor:
+    def __init__(self):
+        '''
+        zstd, across frames.
+        '''
+        self._module = import_optional(zstd_module() or 'zstandard', 'zstd')
+        self._obj = self._new()
+
+    def _new(self):
+        if self._module.__name__ == 'compression.zstd':
+            return self._module.ZstdDecompressor()
+        return self._module.ZstdDecompressor().decompressobj()
+
+    def feed(self, chunk):
+        data = b''
+        # Concatenated frames, a frame may end anywhere in a chunk.
+        while chunk:
+            if self._obj.eof:
+                self._obj = self._new()
+            data += self._obj.decompress(chunk)
+            chunk = self._obj.unused_data if self._obj.eof else b''
+        return data
+
+    def flush(self):
+        return b''
+
+
+def make_decompressor(encoding):
+    '''
+    :param encoding: Content-Encoding of a response.
+    :return: Decompressor with feed(chunk) and flush(), or None for identity.
+    '''
+    encoding = (encoding or 'identity').strip().lower()
+    if encoding == 'identity':
+        return None
+    if encoding in ['gzip', 'x-gzip']:
+        return ZlibDecompressor('gzip')
+    if encoding == 'deflate':
+        return ZlibDecompressor('deflate')
+    if encoding == 'br':
+        return BrotliDecompressor()
+    if encoding == 'zstd':
+        return ZstdDecompressor()
+    raise ValueError(f'Unsupported response Content-Encoding: {encoding}.')
+
+
+class BodyReader:
+    def __init__(self, response, event):
+        '''
+        Read a response that aiohttp does not decompress (auto_decompress=False), decompressing while it downloads.
+        Bytes as received are added to event['wire_bytes'].
+
+        :param response: aiohttp.ClientResponse.
+        :param event: Request event.
+        '''
+        self.response = response
+        self.event = event
+        self.encoding = response.headers.get('Content-Encoding')
+        self.decompressor = make_decompressor(self.encoding)
+        self.done = False
+        event['encoding'] = self.encoding or 'identity'
+        event['wire_bytes'] = 0
+
+    async def read(self, size=2 ** 16):
+        '''
+        :return: Next decompressed bytes, b'' at the end of the body.
+        '''
+        while not self.done:
+            chunk = await self.response.content.read(size)
+            if not chunk:
+                self.done = True
+                return self.decompressor.flush() if self.decompressor is not None else b''
+            self.event['wire_bytes'] += len(chunk)
+            if self.decompressor is None:
+                return chunk
+            data = self.decompressor.feed(chunk)
+            if data:
+                return data
+        return b''
+
+    async def read_all(self):
+        '''
+        :return: The whole decompressed body.
+        '''
+        if self.decompressor is None:
+            body = await self.response.read()
+            self.event['wire_bytes'] += len(body)
+            self.done = True
+            return body
+
+        parts = []
+        data = await self.read(2 ** 20)
+        while data:
+            parts.append(data)
+            data = await self.read(2 ** 20)
+        return b''.join(parts)
+
+
+def encode_body(form_data):
+    '''
+    URL-encoded request body as bytes.
+    '''
+    if isinstance(form_data, bytes):
+        return form_data
+    if isinstance(form_data, bytearray):
+        return bytes(form_data)
+    return parse.urlencode(form_data).encode('utf-8')
+
+
+def compress_body(body, min_size=None, level=6):
+    '''
+    gzip a request body from min_size bytes, for servers or proxies that accept Content-Encoding: gzip.
+
+    :return: (body, Content-Encoding or None).
+    '''
+    if min_size is None or len(body) < min_size:
+        return body, None
+    return gzip.compress(body, compresslevel=level), 'gzip'
@@ -1,8 +1,12 @@
 import json
 import base64
 from urllib import parse
-from .utils import split_list, combine_results, parse_filters
-import asyncio
+from .utils import parse_filters
+from . import codec
+from .chunking import ChunkPlan, placeholder, template_builder
+from .cache import MetadataCache
+from .partition import add_filter, find_range, partition_plan, range_clauses
+from .pagination import check_pagination_args, field_key_kind, page_query
 import copy
 
 
@@ -21,8 +25,7 @@ class Dataset:
         :return: Dataset data as dict.
         '''
         # Print log
-        self.metabase.parse_count += 1
-        parse_number = self.metabase.parse_count
+        parse_number = self.metabase.next_number('parse')
         self.metabase.print_if_verbose(f'Parsing URL and verifying Metabase Session {parse_number}')
 
         # Parse URL
@@ -33,9 +36,7 @@ class Dataset:
         source_table = dataset_query['query']['source-table']  # For parse
 
         # Fetch table information
-        headers = {'Content-Type': 'application/json', 'X-Metabase-Session': self.metabase.metabase_session}
         url = f'{domain}/api/table/{source_table}/query_metadata'
-        response = await session.get(url=url, headers=headers)
 
         # Raise if error
         error_dict = {
@@ -43,13 +44,7 @@ class Dataset:
             404: 'Table does not exist or you do not have permission.',
         }
 
-        if not response.ok:
-            if response.status in error_dict:
-                raise PermissionError(error_dict[response.status])
-            else:
-                response.raise_for_status()
-
-        table_data = await response.json()
+        table_data = await self.metabase.fetch_metadata(session=session, url=url, cache_key=MetadataCache.make_key(domain, 'table', source_table, self.metabase.metabase_session), error_dict=error_dict)
 
         # Find column sort
         query_fields = dataset_query['query'].get('fields') # When we drag columns on browser.
@@ -89,61 +84,175 @@ class Dataset:
             'domain': domain,
             'dataset_query': dataset_query,
             'column_sort': column_sort,
-            'fields': [{'name': f['name'], 'id': f['id'], 'display_name': f['display_name']} for f in fields]
+            'column_types': {f['display_name']: f.get('base_type') for f in fields},
+            'fields': [{'name': f['name'], 'id': f['id'], 'display_name': f['display_name'], 'base_type': f.get('base_type')} for f in fields]
         }
         return data
 
-    async def export_dataset(self, session, dataset_data, format='json'):
+    def dataset_request(self, dataset_data, format='json'):
         url = f"{dataset_data['domain']}/api/dataset/{format}"
-        form_data = {'query': json.dumps(dataset_data['dataset_query'])}
-        return await self.metabase.export(session=session, url=url, form_data=form_data, format=format, column_sort=dataset_data['column_sort'])
+        form_data = {'query': codec.dumps(dataset_data['dataset_query'])}
+        return {'url': url, 'form_data': form_data, 'column_sort': dataset_data['column_sort'], 'column_types': dataset_data['column_types']}
+
+    async def export_dataset(self, session, dataset_data, format='json'):
+        return await self.metabase.export(session=session, format=format, **self.dataset_request(dataset_data=dataset_data, format=format))
 
 
-    async def query_dataset(self, session, url, format='json', filters=None, filter_chunk_size=5000):
+    async def aggregate(self, session, dataset_data, aggregation):
         '''
-        Send one request or multiple requests to get data from Metabase.
+        Aggregate values of the query with its filters.
+
+        :param aggregation: MBQL aggregation clauses.
+        :return: A list of values in the order of aggregation.
+        '''
+        dataset_query = copy.deepcopy(dataset_data['dataset_query'])
+        query = {k: v for k, v in dataset_query['query'].items() if k in ['source-table', 'filter', 'joins', 'expressions']}
+        query['aggregation'] = aggregation
+        dataset_query['query'] = query
+
+        url = f"{dataset_data['domain']}/api/dataset/json"
+        data = await self.metabase.export(session=session, url=url, form_data={'query': codec.dumps(dataset_query)}, format='json')
+        return list(data[0].values()) if data else [None] * len(aggregation)
+
+    async def fetch_range(self, session, dataset_data, field):
+        '''
+        Min and max of a field with the query's filters.
+
+        :return: (min, max), or None if no rows match.
+        '''
+        row = await self.aggregate(session=session, dataset_data=dataset_data, aggregation=[['min', field], ['max', field]])
+        if len(row) != 2 or None in row:
+            return None
+        return row[0], row[1]
+
+    def find_field(self, fields, column):
+        '''
+        :return: The field with this name or display name.
+        '''
+        for f in fields:
+            if column.lower() in [f['name'].lower(), f['display_name'].lower().replace(' ', '_')]:
+                return f
+        raise ValueError(f"The {column} field is not available for this table. These are the available fields: {', '.join(f['name'] for f in fields)}.")
+
+
+    async def prepare_dataset(self, session, url, format='json', filters=None, filter_chunk_size=5000, partition=None):
+        '''
+        Parse a dataset and build one export request, or one export request per chunk for a bulk filter.
 
         :param session: aiohttp.ClientSession.
         :param url: URL to query.
         :param format: json, csv, xlsx.
         :param filters: A dict.
         :param filter_chunk_size: If you have a bulk value filter, the package will splits your values into chunks to send the requests, and then concat the results into a single data.
-        :return: Combined data.
+        :param partition: Partition to split the query into slices of a date or number field.
+        :return: ChunkPlan, or PartitionPlan with one ChunkPlan per slice, of requests for Metabase.export.
         '''
 
         filters, max_filter_key, max_filter_value_count = parse_filters(filters)
 
         dataset_data = await self.parse_dataset(session=session, url=url, filters=filters)
 
-        # Send one request if there are no filter has values > filter_chunk_size
-        if max_filter_value_count <= filter_chunk_size:
-            return await self.export_dataset(session=session, dataset_data=dataset_data, format=format)
-
-        else:
-            if format not in ['json', 'csv']:
-                raise ValueError(f'Package only supports JSON and CSV formats with bulk filter values due to data combining limitations. Your {max_filter_key} filter is over filter_chunk_size {max_filter_value_count}/{filter_chunk_size}.')
-
-            # Slit values to chunks > Create a list of dataset_data
-            value_list = split_list(input_list=filters[max_filter_key], chunk_size=filter_chunk_size)
+        # Get field IDs to filter in loop
+        fields = dataset_data.pop('fields')
+        field_ids = {f['name']: f['id'] for f in fields}
 
-            # Get field ID to filter in loop
-            field_id = [f['id'] for f in dataset_data['fields'] if f['name'] == max_filter_key][0]
-            dataset_data.pop('fields')
+        def chunk_plan(dataset_data):
+            request = self.dataset_request(dataset_data=dataset_data, format=format)
 
-            # List of dataset_data
-            dataset_data_list = []
-            for value in value_list:
-                query_filter = ["=", ["field", field_id, None]] + value
+            # Payload template of dataset_data, the values of chunked filters are filled per chunk
+            def template_request(keys):
+                chunk_field_ids = [field_ids[key] for key in keys]
+                chunk_filters = [["=", ["field", field_ids[key], None], placeholder(key)] for key in keys]
                 new_dataset_data = copy.deepcopy(dataset_data)
                 query_filters = new_dataset_data['dataset_query']['query']['filter']
-                new_dataset_data['dataset_query']['query']['filter'] = ['and'] + [query_filter] + [f for f in query_filters[1:] if f[1][1] != field_id]
-                dataset_data_list.append(new_dataset_data)
+                new_dataset_data['dataset_query']['query']['filter'] = ['and'] + chunk_filters + [f for f in query_filters[1:] if f[1][1] not in chunk_field_ids]
+                return self.dataset_request(dataset_data=new_dataset_data, format=format)
+
+            # One request if no filter needs splitting
+            plan = ChunkPlan(request=request, build=template_builder(request=request, template_request=template_request), values=filters, chunk_size=filter_chunk_size, max_values=self.metabase.max_filter_values, max_body_size=self.metabase.max_body_size)
+
+            if plan.is_bulk and format not in ['json', 'csv']:
+                raise ValueError(f'Package only supports JSON and CSV formats with bulk filter values due to data combining limitations. Your {", ".join(plan.split_keys)} {"filters are" if len(plan.split_keys) > 1 else "filter is"} over filter_chunk_size, max_filter_values or max_body_size.')
+
+            return plan
+
+        if partition is None:
+            return chunk_plan(dataset_data)
+
+        field_id = self.find_field(fields=fields, column=partition.column)['id']
+        field = ['field', field_id, None]
+
+        # Range of the partition field: partition_range, a between filter of the question, or min and max
+        bounds = partition.range or find_range(query=dataset_data['dataset_query']['query'], field_id=field_id)
+        if bounds is None:
+            bounds = await self.fetch_range(session=session, dataset_data=dataset_data, field=field)
+            if bounds is None:
+                # No rows to split
+                return chunk_plan(dataset_data)
+
+        # One plan per slice, with range clauses added to the query filter
+        plans = []
+        for lower, upper, closed in partition.slices(*bounds):
+            slice_data = copy.deepcopy(dataset_data)
+            add_filter(query=slice_data['dataset_query']['query'], clauses=range_clauses(field=field, lower=lower, upper=upper, closed=closed))
+            plans.append(chunk_plan(slice_data))
+        self.metabase.print_if_verbose(f'Partitioning {partition.column} into {len(plans)} slices')
+        return partition_plan(plans=plans, format=format)
+
+
+    async def query_dataset(self, session, url, format='json', filters=None, filter_chunk_size=5000, output=None, checkpoint=None, partition=None, pagination=None):
+        '''
+        Send one request or multiple requests to get data from Metabase.
+
+        :param session: aiohttp.ClientSession.
+        :param url: URL to query.
+        :param format: json, csv, xlsx.
+        :param filters: A dict.
+        :param filter_chunk_size: If you have a bulk value filter, the package will splits your values into chunks to send the requests, and then concat the results into a single data.
+        :param output: None, arrow, pandas, numpy. Columnar outputs need format csv.
+        :param checkpoint: Checkpoint to save completed chunks to and resume from.
+        :param partition: Partition to split the query into slices of a date or number field.
+        :param pagination: Pagination to read the query in keyset pages.
+        :return: Combined data.
+        '''
+        if pagination is not None:
+            return await self.paginate_dataset(session=session, url=url, format=format, filters=filters, filter_chunk_size=filter_chunk_size, output=output, pagination=pagination)
+
+        plan = await self.prepare_dataset(session=session, url=url, format=format, filters=filters, filter_chunk_size=filter_chunk_size, partition=partition)
+        return await self.metabase.export_plan(session=session, plan=plan, format=format, output=output, checkpoint=checkpoint)
+
+
+    async def paginate_dataset(self, session, url, format='json', filters=None, filter_chunk_size=5000, output=None, pagination=None):
+        '''
+        Read a dataset in pages ordered by a unique key field, past the export row limit.
+        The row count, min and max key are fetched first to read key ranges in parallel.
+
+        :param session: aiohttp.ClientSession.
+        :param url: URL to query.
+        :param format: json, csv.
+        :param filters: A dict.
+        :param filter_chunk_size: Filters over this number of values are not supported.
+        :param output: None, arrow, pandas, numpy. Columnar outputs need format csv.
+        :param pagination: Pagination.
+        :return: Combined data.
+        '''
+        filters, max_filter_key, max_filter_value_count = parse_filters(filters)
+        check_pagination_args(format=format, filters=filters, filter_chunk_size=filter_chunk_size)
+
+        dataset_data = await self.parse_dataset(session=session, url=url, filters=filters)
+        key = self.find_field(fields=dataset_data.pop('fields'), column=pagination.column)
+        field = ['field', key['id'], None]
+
+        query = dataset_data['dataset_query']['query']
+        if 'limit' in query or 'aggregation' in query or 'breakout' in query:
+            raise ValueError('paginate_by supports table rows, not questions with a row limit or a summary.')
+
+        limit = pagination.limit(self.metabase.export_row_limit)
+        count, start, end = await self.aggregate(session=session, dataset_data=dataset_data, aggregation=[['count'], ['min', field], ['max', field]])
+        ranges = pagination.ranges(count=count, start=start, end=end, limit=limit)
 
-            # Send requests to get data in bulk.
-            tasks = []
-            for d in dataset_data_list:
-                task = asyncio.create_task(self.export_dataset(session=session, dataset_data=d, format=format))
-                tasks.append(task)
+        def page_request(lower=None, after=None, upper=None, closed=False):
+            dataset_query = dict(dataset_data['dataset_query'], query=page_query(query=query, field=field, limit=limit, lower=lower, after=after, upper=upper, closed=closed))
+            return self.dataset_request(dataset_data=dict(dataset_data, dataset_query=dataset_query), format=format)
 
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-            return combine_results(results=results, format=format, verbose=self.metabase.verbose)
\ No newline at end of file
+        return await self.metabase.export_pages(session=session, page_request=page_request, key_names=[key['display_name'], key['name']], limit=limit, ranges=ranges, format=format, output=output, key_kind=field_key_kind(key))
@@ -0,0 +1,149 @@
+import asyncio
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+from .codec import get_codec
+from .columnar import decode_csv, has_module
+from .utils import combine_results
+
+DECODER_MODES = ['auto', 'process', 'thread']
+
+
+def decode_json(body, column_sort=None, codec=None):
+    '''
+    Decode JSON export bytes into records, with columns in column_sort order.
+
+    :param codec: JSON codec, None for the current codec.
+    '''
+    data = (codec or get_codec()).loads(body)
+    if column_sort:
+        data = [{col: record[col] for col in column_sort if col in record} for record in data]
+    return data
+
+
+def call_in_process(function, kwargs, shared_memory_size):
+    '''
+    Run a decode function in a worker process.
+    Large results are pickled into a shared memory block instead of being sent back through the pipe.
+
+    :return: (None, pickled result) or (shared memory name, pickled size).
+    '''
+    payload = pickle.dumps(function(**kwargs), protocol=pickle.HIGHEST_PROTOCOL)
+    if len(payload) < shared_memory_size:
+        return None, payload
+
+    memory = shared_memory.SharedMemory(create=True, size=len(payload))
+    try:
+        memory.buf[:len(payload)] = payload
+    except BaseException:
+        memory.close()
+        memory.unlink()
+        raise
+    memory.close()
+    return memory.name, len(payload)
+
+
+def load_result(name, payload):
+    '''
+    Unpickle a result of call_in_process(), the shared memory block is freed.
+    '''
+    if name is None:
+        return pickle.loads(payload)
+
+    memory = shared_memory.SharedMemory(name=name)
+    try:
+        with memory.buf[:payload] as view:
+            return pickle.loads(view)
+    finally:
+        memory.close()
+        memory.unlink()
+
+
+class Decoder:
+    def __init__(self, mode='auto', workers=None, min_size=2 ** 16, shared_memory_size=2 ** 20):
+        '''
+        Decode, reorder and merge export results off the event loop, so requests keep downloading while large results are parsed.
+
+        :param mode: process to decode in a process pool, thread in a thread pool, auto for processes for JSON and threads for columnar outputs, pyarrow releases the GIL while it parses CSV. Default is auto.
+        :param workers: Pool size, None for the number of CPUs.
+        :param min_size: Smaller responses are decoded on the event loop, a pool costs more than it saves. Default is 64 KiB.
+        :param shared_memory_size: Process results from this many pickled bytes come back in shared memory instead of the pipe. Default is 1 MiB.
+        '''
+        if mode not in DECODER_MODES:
+            raise ValueError(f'mode must be one of {", ".join(DECODER_MODES)}.')
+        if workers is not None and workers < 1:
+            raise ValueError('workers must be positive.')
+        self.mode = mode
+        self.workers = workers or os.cpu_count() or 1
+        self.min_size = min_size
+        self.shared_memory_size = shared_memory_size
+        self._processes = None
+        self._threads = None
+
+    def processes(self):
+        if self._processes is None:
+            # Workers must share the parent's tracker, else they report the blocks they hand over as leaked.
+            resource_tracker.ensure_running()
+            self._processes = ProcessPoolExecutor(max_workers=self.workers)
+        return self._processes
+
+    def threads(self):
+        if self._threads is None:
+            self._threads = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='metabase-query-decoder')
+        return self._threads
+
+    def use_processes(self, columnar):
+        if self.mode == 'auto':
+            # Without pyarrow, columnar decoding holds the GIL too.
+            return not (columnar and has_module('pyarrow'))
+        return self.mode == 'process'
+
+    async def run(self, function, columnar=False, **kwargs):
+        loop = asyncio.get_running_loop()
+        if self.use_processes(columnar=columnar):
+            name, payload = await loop.run_in_executor(self.processes(), call_in_process, function, kwargs, self.shared_memory_size)
+            return load_result(name, payload)
+        return await loop.run_in_executor(self.threads(), lambda: function(**kwargs))
+
+    async def decode_json(self, body, column_sort=None, codec=None):
+        '''
+        Async decode_json(), in a worker for large bodies. Process workers need a codec that can be pickled.
+        '''
+        codec = codec or get_codec()
+        if len(body) < self.min_size:
+            return decode_json(body=body, column_sort=column_sort, codec=codec)
+        return await self.run(decode_json, body=body, column_sort=column_sort, codec=codec)
+
+    async def decode_csv(self, data, output, column_types=None):
+        '''
+        Async columnar.decode_csv(), in a worker for large bodies.
+        '''
+        if len(data) < self.min_size:
+            return decode_csv(data=data, output=output, column_types=column_types)
+        return await self.run(decode_csv, columnar=True, data=data, output=output, column_types=column_types)
+
+    async def combine(self, results, format='json', verbose=True):
+        '''
+        Async utils.combine_results() in a worker thread, the chunks are already in this process.
+        '''
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.threads(), lambda: combine_results(results=results, format=format, verbose=verbose))
+
+    def close(self):
+        '''
+        Shut down the worker pools, they start again on the next use.
+        '''
+        if self._processes is not None:
+            self._processes.shutdown()
+            self._processes = None
+        if self._threads is not None:
+            self._threads.shutdown()
+            self._threads = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,220 @@
+import itertools
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import aiohttp
+
+from .breaker import percentile
+from .columnar import import_optional
+
+# Stats of the query() or sql() call running in this context.
+current_stats = ContextVar('metabase_query_stats', default=None)
+
+TIMINGS = ['wait', 'dns', 'connect', 'ttfb', 'download', 'seconds']
+
+
+def new_event(kind, url, chunk=None):
+    '''
+    A request event, filled while the request runs.
+
+    kind: export, stream or metadata. source: network, cache (result cache) or shared (single-flight).
+    Timings are seconds: wait for a slot, DNS, connect, time to first byte after sending, download, total from sending.
+    bytes: response body after decompression, wire_bytes: as received, encoding: its Content-Encoding.
+    request_bytes: request body before compression, request_wire_bytes: as sent.
+    truncated: the export has as many rows as the export row limit, rows over the limit are missing.
+    '''
+    return {
+        'kind': kind,
+        'url': url,
+        'chunk': chunk,
+        'number': None,
+        'source': None,
+        'status': None,
+        'wait': None,
+        'dns': None,
+        'connect': None,
+        'ttfb': None,
+        'download': None,
+        'seconds': None,
+        'bytes': None,
+        'wire_bytes': None,
+        'encoding': None,
+        'request_bytes': None,
+        'request_wire_bytes': None,
+        'rows': None,
+        'retries': 0,
+        'truncated': False,
+        'error': None
+    }
+
+
+class QueryStats:
+    def __init__(self):
+        '''
+        Request events of one query(), sql() or query_to_file() call, see summary().
+        '''
+        self.started_at = time.monotonic()
+        self.finished_at = None
+        self.events = []
+        self._numbers = {}
+
+    def next_number(self, kind):
+        if kind not in self._numbers:
+            self._numbers[kind] = itertools.count(1)
+        return next(self._numbers[kind])
+
+    def add(self, event):
+        self.events.append(event)
+
+    def summary(self):
+        '''
+        :return: Totals of the call: requests by source and status, retries, bytes before and after decompression, rows, truncated exports and timing percentiles of network requests.
+        '''
+        events = [e for e in self.events if e['kind'] != 'metadata']
+        network = [e for e in events if e['source'] == 'network']
+        finished_at = self.finished_at or time.monotonic()
+
+        statuses = {}
+        for e in network:
+            statuses[e['status']] = statuses.get(e['status'], 0) + 1
+
+        timings = {}
+        for name in TIMINGS:
+            values = [e[name] for e in network if e[name] is not None]
+            timings[name] = {'total': sum(values), 'p50': percentile(values, 50), 'p95': percentile(values, 95), 'max': max(values) if values else None}
+
+        return {
+            'seconds': finished_at - self.started_at,
+            'requests': len(events),
+            'network': len(network),
+            'cached': sum(1 for e in events if e['source'] == 'cache'),
+            'shared': sum(1 for e in events if e['source'] == 'shared'),
+            'metadata': sum(1 for e in self.events if e['kind'] == 'metadata'),
+            'errors': sum(1 for e in events if e['error']),
+            'retries': sum(e['retries'] for e in events),
+            'bytes': sum(e['bytes'] or 0 for e in network),
+            'wire_bytes': sum(e['wire_bytes'] if e['wire_bytes'] is not None else e['bytes'] or 0 for e in network),
+            'request_wire_bytes': sum(e['request_wire_bytes'] or 0 for e in network),
+            'rows': sum(e['rows'] or 0 for e in events),
+            'truncated': sum(1 for e in events if e['truncated']),
+            'statuses': statuses,
+            'timings': timings
+        }
+
+
+@contextmanager
+def use_query_stats(stats):
+    token = current_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        stats.finished_at = time.monotonic()
+        current_stats.reset(token)
+
+
+def trace_config():
+    '''
+    aiohttp TraceConfig that writes DNS and connect times into the event passed as trace_request_ctx.
+    '''
+    def timer(start, end):
+        async def on_start(session, context, params):
+            if isinstance(context.trace_request_ctx, dict):
+                context.trace_request_ctx[start] = time.monotonic()
+
+        async def on_end(session, context, params):
+            event = context.trace_request_ctx
+            if isinstance(event, dict) and start in event:
+                event[end] = (event[end] or 0) + time.monotonic() - event.pop(start)
+
+        return on_start, on_end
+
+    config = aiohttp.TraceConfig()
+    dns_start, dns_end = timer('_dns_start', 'dns')
+    connect_start, connect_end = timer('_connect_start', 'connect')
+    config.on_dns_resolvehost_start.append(dns_start)
+    config.on_dns_resolvehost_end.append(dns_end)
+    config.on_connection_create_start.append(connect_start)
+    config.on_connection_create_end.append(connect_end)
+    return config
+
+
+class LoggingExporter:
+    def __init__(self, logger=None, level=logging.INFO):
+        '''
+        Log each request event, the event is also passed as extra={'metabase_request': event}.
+
+        :param logger: logging.Logger, default is the metabase_query logger.
+        :param level: Log level.
+        '''
+        self.logger = logger or logging.getLogger('metabase_query')
+        self.level = level
+
+    def __call__(self, event):
+        self.logger.log(
+            self.level,
+            '%s %s chunk=%s source=%s status=%s seconds=%s bytes=%s wire_bytes=%s encoding=%s rows=%s retries=%s error=%s',
+            event['kind'], event['url'], event['chunk'], event['source'], event['status'],
+            None if event['seconds'] is None else round(event['seconds'], 3), event['bytes'], event['wire_bytes'], event['encoding'], event['rows'], event['retries'], event['error'],
+            extra={'metabase_request': event}
+        )
+
+
+class PrometheusExporter:
+    def __init__(self, registry=None, prefix='metabase_query'):
+        '''
+        Record request events as Prometheus metrics, requires prometheus_client.
+
+        :param registry: prometheus_client.CollectorRegistry, default is the global registry.
+        :param prefix: Metric name prefix.
+        '''
+        prometheus = import_optional('prometheus_client', 'prometheus')
+        kwargs = {'registry': registry} if registry is not None else {}
+        labels = ['kind', 'source', 'status']
+        self.requests = prometheus.Counter(f'{prefix}_requests', 'Requests by kind, source and status.', labels, **kwargs)
+        self.retries = prometheus.Counter(f'{prefix}_retries', 'Retries.', ['kind'], **kwargs)
+        self.bytes = prometheus.Counter(f'{prefix}_response_bytes', 'Response bytes after decompression.', ['kind'], **kwargs)
+        self.wire_bytes = prometheus.Counter(f'{prefix}_response_wire_bytes', 'Response bytes as received.', ['kind'], **kwargs)
+        self.rows = prometheus.Counter(f'{prefix}_rows', 'Rows received.', ['kind'], **kwargs)
+        self.seconds = prometheus.Histogram(f'{prefix}_request_seconds', 'Request timings by phase.', ['kind', 'phase'], **kwargs)
+
+    def __call__(self, event):
+        kind = event['kind']
+        self.requests.labels(kind=kind, source=event['source'] or '', status=str(event['status'] or '')).inc()
+        self.retries.labels(kind=kind).inc(event['retries'])
+        self.bytes.labels(kind=kind).inc(event['bytes'] or 0)
+        self.wire_bytes.labels(kind=kind).inc(event['wire_bytes'] or 0)
+        self.rows.labels(kind=kind).inc(event['rows'] or 0)
+        for phase in TIMINGS:
+            if event[phase] is not None:
+                self.seconds.labels(kind=kind, phase=phase).observe(event[phase])
+
+
+class OpenTelemetryExporter:
+    def __init__(self, meter=None, prefix='metabase_query'):
+        '''
+        Record request events as OpenTelemetry metrics, requires opentelemetry-api.
+
+        :param meter: opentelemetry.metrics.Meter, default is the meter of the global MeterProvider.
+        :param prefix: Metric name prefix.
+        '''
+        metrics = import_optional('opentelemetry.metrics', 'opentelemetry')
+        meter = meter or metrics.get_meter('metabase_query')
+        self.requests = meter.create_counter(f'{prefix}.requests', description='Requests by kind, source and status.')
+        self.retries = meter.create_counter(f'{prefix}.retries', description='Retries.')
+        self.bytes = meter.create_counter(f'{prefix}.response_bytes', unit='By', description='Response bytes after decompression.')
+        self.wire_bytes = meter.create_counter(f'{prefix}.response_wire_bytes', unit='By', description='Response bytes as received.')
+        self.rows = meter.create_counter(f'{prefix}.rows', description='Rows received.')
+        self.seconds = meter.create_histogram(f'{prefix}.request_seconds', unit='s', description='Request timings by phase.')
+
+    def __call__(self, event):
+        attributes = {'kind': event['kind'], 'source': event['source'] or '', 'status': str(event['status'] or '')}
+        self.requests.add(1, attributes)
+        self.retries.add(event['retries'], {'kind': event['kind']})
+        self.bytes.add(event['bytes'] or 0, {'kind': event['kind']})
+        self.wire_bytes.add(event['wire_bytes'] or 0, {'kind': event['kind']})
+        self.rows.add(event['rows'] or 0, {'kind': event['kind']})
+        for phase in TIMINGS:
+            if event[phase] is not None:
+                self.seconds.record(event[phase], {'kind': event['kind'], 'phase': phase})
@@ -0,0 +1,228 @@
+import csv
+import io
+import math
+
+from .columnar import column_kind
+from .partition import Partition, add_filter, format_bound
+
+# Alias of the wrapped SQL query.
+SQL_ALIAS = 'metabase_query_page'
+
+
+class Pagination:
+    def __init__(self, column, page_size=None):
+        '''
+        Read a query in pages ordered by a unique key column, each page starts after the last key of the previous page.
+
+        :param column: Unique key column: table field name for table URLs, column name for SQL.
+        :param page_size: Rows per page, None for the export row limit.
+        '''
+        if page_size is not None and page_size < 1:
+            raise ValueError('page_size must be positive.')
+        self.column = column
+        self.page_size = page_size
+
+    def limit(self, export_row_limit=None):
+        '''
+        Rows per page request, one row under the export row limit so a full page is not taken for a cut export.
+        '''
+        if export_row_limit is None:
+            if self.page_size is None:
+                raise ValueError('page_size is required when export_row_limit is None.')
+            return self.page_size
+        return min(self.page_size or export_row_limit, export_row_limit - 1)
+
+    def ranges(self, count, start, end, limit):
+        '''
+        Key ranges to read in parallel, about one page each if keys are spread evenly.
+        A range with more rows than expected is still read in full, page by page.
+
+        :param count: Number of rows.
+        :param start: Smallest key.
+        :param end: Largest key.
+        :param limit: Rows per page.
+        :return: A list of (lower, upper, closed), or one range over all keys if the keys are not numbers or dates.
+        '''
+        everything = [(None, None, False)]
+        pages = math.ceil((count or 0) / limit)
+        if pages <= 1 or start is None or end is None:
+            return everything
+        try:
+            return Partition(column=self.column, partitions=pages).slices(start, end)
+        except (ValueError, TypeError):
+            return everything
+
+
+def check_pagination_args(format, filters, filter_chunk_size):
+    if format not in ['json', 'csv']:
+        raise ValueError('Package only supports JSON and CSV formats with paginate_by due to data combining limitations.')
+    if filters and max(len(v) for v in filters.values()) > filter_chunk_size:
+        raise ValueError('paginate_by does not support bulk filters, use filters under filter_chunk_size values.')
+
+
+def make_pagination(paginate_by=None, page_size=None):
+    '''
+    :return: Pagination, or None if paginate_by is None.
+    '''
+    if paginate_by is None:
+        if page_size is not None:
+            raise ValueError('page_size needs paginate_by.')
+        return None
+    return Pagination(column=paginate_by, page_size=page_size)
+
+
+def page_query(query, field, limit, lower=None, after=None, upper=None, closed=False):
+    '''
+    MBQL query of one page: key range filter, ordered by the key, limited to one page.
+
+    :param query: MBQL inner query, not changed.
+    :param field: Field reference of the key.
+    :param limit: Rows per page.
+    :param lower: Smallest key of the range, included.
+    :param after: Last key of the previous page, excluded.
+    :param upper: Largest key of the range.
+    :param closed: Include upper.
+    :return: New MBQL inner query.
+    '''
+    clauses = []
+    if after is not None:
+        clauses.append(['>', field, format_bound(after)])
+    elif lower is not None:
+        clauses.append(['>=', field, format_bound(lower)])
+    if upper is not None:
+        clauses.append(['<=' if closed else '<', field, format_bound(upper)])
+
+    query = dict(query)
+    if clauses:
+        add_filter(query=query, clauses=clauses)
+    query['order-by'] = [['asc', field]]
+    query['limit'] = limit
+    return query
+
+
+def sql_literal(value):
+    '''
+    SQL literal of a key: numbers as they are, others as quoted strings.
+    '''
+    value = format_bound(value)
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return repr(value)
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def page_sql(sql, column, limit, lower=None, after=None, upper=None, closed=False):
+    '''
+    SQL of one page: the query wrapped with a key range, ordered by the key and limited to one page.
+    See page_query() for the parameters.
+    '''
+    conditions = []
+    if after is not None:
+        conditions.append(f'{column} > {sql_literal(after)}')
+    elif lower is not None:
+        conditions.append(f'{column} >= {sql_literal(lower)}')
+    if upper is not None:
+        conditions.append(f"{column} {'<=' if closed else '<'} {sql_literal(upper)}")
+
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ''
+    return f'SELECT * FROM ({strip_sql(sql)}) {SQL_ALIAS}{where} ORDER BY {column} LIMIT {limit}'
+
+
+def range_sql(sql, column):
+    '''
+    SQL of the row count, smallest and largest key of a query.
+    '''
+    return f'SELECT COUNT(*) AS row_count, MIN({column}) AS min_key, MAX({column}) AS max_key FROM ({strip_sql(sql)}) {SQL_ALIAS}'
+
+
+def strip_sql(sql):
+    return sql.strip().rstrip(';').strip()
+
+
+def parse_key(text, kind=None):
+    '''
+    Key read from CSV, converted by the kind of the key column: int, float, or None for text.
+    The kind comes from the column type, text like 00123 is not taken for a number.
+    '''
+    if kind == 'int':
+        return int(text)
+    if kind == 'float':
+        return float(text)
+    return text
+
+
+def field_key_kind(field):
+    '''
+    Kind of a key field from its Metabase base_type, see columnar.column_kind().
+    '''
+    kind = column_kind(field.get('base_type'))
+    return kind if kind in ['int', 'float'] else None
+
+
+def value_key_kind(value):
+    '''
+    Kind of a key from a value of a JSON result, e.g. the smallest key of range_sql().
+    '''
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return 'int'
+    if isinstance(value, float):
+        return 'float'
+    return None
+
+
+def find_column(columns, names):
+    lower = {str(c).lower(): c for c in columns}
+    for name in names:
+        if name is not None and str(name).lower() in lower:
+            return lower[str(name).lower()]
+    raise LookupError(f'The key column {names[0]} is not in the result, add it to the query columns to paginate on it.')
+
+
+def last_key(data, format, names, kind=None):
+    '''
+    Key of the last row of a page.
+
+    :param data: Page data: JSON records, CSV bytes, or columnar output.
+    :param format: json, csv, arrow, pandas, numpy.
+    :param names: Possible names of the key column in the result, e.g. field name and display name.
+    :param kind: Kind of the key for CSV: int, float, or None for text, see field_key_kind() and value_key_kind().
+    :return: Key value, or None if the page is empty.
+    '''
+    if format == 'json':
+        if not data:
+            return None
+        return data[-1][find_column(data[-1], names)]
+
+    if format == 'csv':
+        header_end = data.find(b'\n')
+        body = data.rstrip(b'\r\n')
+        if header_end == -1 or header_end >= len(body):
+            return None
+        header = next(csv.reader([data[:header_end].decode('utf-8').rstrip('\r')]))
+        index = header.index(find_column(header, names))
+        # The last line is the last row unless a value holds a new line.
+        row = next(csv.reader([body[body.rfind(b'\n') + 1:].decode('utf-8')]), [])
+        if len(row) != len(header):
+            row = list(csv.reader(io.StringIO(body.decode('utf-8'))))[-1]
+        return parse_key(row[index], kind=kind)
+
+    if format == 'arrow':
+        if data.num_rows == 0:
+            return None
+        return data.column(find_column(data.column_names, names))[-1].as_py()
+
+    if format == 'pandas':
+        if len(data) == 0:
+            return None
+        value = data[find_column(data.columns, names)].iloc[-1]
+    else:
+        column = data[find_column(data.keys(), names)]
+        if len(column) == 0:
+            return None
+        value = column[-1]
+    if type(value).__name__ == 'datetime64':
+        return str(value)
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value.item() if hasattr(value, 'item') else value
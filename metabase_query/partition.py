@@ -0,0 +1,277 @@
+import datetime
+import re
+
+INTERVAL_UNITS = {'h': 'hours', 'd': 'days', 'w': 'weeks'}
+
+DAY = datetime.timedelta(days=1)
+
+
+def parse_interval(partitions):
+    '''
+    :param partitions: A timedelta or an interval like '1d', '12h', '2w'.
+    :return: datetime.timedelta.
+    '''
+    if isinstance(partitions, datetime.timedelta):
+        interval = partitions
+    else:
+        match = re.fullmatch(r'(\d+)\s*([hdw])', str(partitions).strip().lower())
+        if not match:
+            raise ValueError("partitions must be a number of slices or an interval like '1d', '12h', '1w'.")
+        interval = datetime.timedelta(**{INTERVAL_UNITS[match.group(2)]: int(match.group(1))})
+
+    if interval <= datetime.timedelta(0):
+        raise ValueError('The partitions interval must be positive.')
+    return interval
+
+
+def parse_bound(value):
+    '''
+    Number, date or datetime of a range bound, ISO strings are parsed.
+    '''
+    if isinstance(value, (int, float, datetime.date)) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        text = value.strip()
+        for parse in [int, float]:
+            try:
+                return parse(text)
+            except ValueError:
+                pass
+        try:
+            if len(text) == 10:
+                return datetime.date.fromisoformat(text)
+            return datetime.datetime.fromisoformat(text.replace('Z', '+00:00'))
+        except ValueError:
+            pass
+    raise ValueError(f'Can not partition on {value!r}, partition bounds must be numbers, dates or ISO date strings.')
+
+
+def format_bound(value):
+    '''
+    Range bound for a Metabase filter: ISO date for dates and datetimes at midnight, else ISO datetime, numbers as they are.
+    '''
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None and value.time() == datetime.time():
+            return value.date().isoformat()
+        return value.isoformat()
+    if is_date(value):
+        return value.isoformat()
+    return value
+
+
+def is_date(value):
+    return isinstance(value, datetime.date) and not isinstance(value, datetime.datetime)
+
+
+class Partition:
+    def __init__(self, column, partitions, range=None):
+        '''
+        Split a query into slices of a date or number column, the slices are sent in parallel and merged in order.
+
+        :param column: Table field name, or card and SQL filter slug.
+        :param partitions: A number of equal slices, or an interval for date columns like '1d', '12h', '1w'.
+        :param range: (start, end) of the column, both included. None to use the filter's range value, or the column's min and max for tables.
+        '''
+        if isinstance(partitions, int) and not isinstance(partitions, bool):
+            if partitions < 1:
+                raise ValueError('The number of partitions must be positive.')
+            self.count = partitions
+            self.interval = None
+        else:
+            self.count = None
+            self.interval = parse_interval(partitions)
+
+        if range is not None:
+            if not isinstance(range, (list, tuple)) or len(range) != 2:
+                raise ValueError('partition_range must be a (start, end) pair.')
+            range = tuple(range)
+            for bound in range:
+                parse_bound(bound)
+
+        # Same naming as filter keys.
+        self.column = str(column).lower().replace(' ', '_')
+        self.range = range
+
+    def slices(self, start, end, whole=False):
+        '''
+        Split the range from start to end, both included, into (lower, upper, closed) bounds, in order.
+        A slice holds lower <= value < upper, or lower <= value <= upper when closed.
+        End dates without a time include their whole day.
+
+        :param start: First value of the range.
+        :param end: Last value of the range.
+        :param whole: Bounds on whole days or integers, for filters that take two included values.
+        :return: A list of (lower, upper, closed).
+        '''
+        start, end = parse_bound(start), parse_bound(end)
+        dates = isinstance(start, datetime.date)
+        if dates != isinstance(end, datetime.date):
+            raise ValueError('partition_range bounds must be both numbers or both dates.')
+        if self.interval is not None and not dates:
+            raise ValueError('An interval of partitions needs a date column, use a number of partitions for number columns.')
+
+        if dates:
+            # Dates are whole days from midnight.
+            end_date = is_date(end)
+            start = datetime.datetime.combine(start, datetime.time()) if is_date(start) else start
+            end = datetime.datetime.combine(end, datetime.time()) if is_date(end) else end
+            if (start.tzinfo is None) != (end.tzinfo is None):
+                raise ValueError('partition_range bounds must both have a time zone or both not.')
+            if whole:
+                start = start.replace(hour=0, minute=0, second=0, microsecond=0)
+                end = end.replace(hour=0, minute=0, second=0, microsecond=0)
+                if self.interval is not None and self.interval % DAY:
+                    raise ValueError('Card and SQL filters take whole days, use partitions in days or weeks.')
+        elif whole:
+            if not (float(start).is_integer() and float(end).is_integer()):
+                raise ValueError('Card and SQL number filters need integer partition bounds.')
+            start, end = int(start), int(end)
+
+        if end < start:
+            raise ValueError('The end of partition_range is before its start.')
+
+        # Exclusive stop after the end when the column is split on whole units.
+        if dates and (whole or end_date):
+            stop, closed = end + DAY, False
+        elif whole:
+            stop, closed = end + 1, False
+        else:
+            stop, closed = end, True
+
+        if self.interval is not None:
+            bounds = []
+            bound = start
+            while bound < stop:
+                bounds.append(bound)
+                bound += self.interval
+            bounds.append(stop)
+        elif dates and whole:
+            days = (stop - start).days
+            bounds = [start + datetime.timedelta(days=days * i // self.count) for i in range(self.count + 1)]
+        elif isinstance(start, int) and isinstance(stop, int):
+            bounds = [start + (stop - start) * i // self.count for i in range(self.count + 1)]
+        else:
+            bounds = [start + (stop - start) * i / self.count for i in range(self.count + 1)]
+
+        # Ranges shorter than the number of partitions give fewer slices.
+        bounds = [b for i, b in enumerate(bounds) if i == 0 or b != bounds[i - 1]]
+        if len(bounds) == 1:
+            return [(start, end, True)]
+        return [(lower, upper, closed and i == len(bounds) - 2) for i, (lower, upper) in enumerate(zip(bounds, bounds[1:]))]
+
+    def parameter_slices(self, parameter):
+        '''
+        Copies of a card or SQL filter parameter, one per slice: date/range values for dates, number/between values for numbers.
+
+        :param parameter: Parameter with type, target and value.
+        :return: A list of parameters.
+        '''
+        param_type = parameter.get('type', '')
+        if parameter['target'][0] == 'variable' or not ('date' in param_type or 'number' in param_type):
+            raise ValueError(f'partition_by needs a date or number field filter, {self.column} is a {param_type} filter.')
+        dates = 'date' in param_type
+
+        if self.range is not None:
+            start, end = self.range
+        else:
+            value = parameter.get('value')
+            if dates and isinstance(value, str) and '~' in value:
+                start, end = value.split('~', 1)
+            elif not dates and isinstance(value, list) and len(value) == 2:
+                start, end = value
+            else:
+                raise ValueError(f'Set partition_range, or a range value for the {self.column} filter such as 2024-01-01~2024-01-31.')
+
+        parameters = []
+        for lower, upper, closed in self.slices(start, end, whole=True):
+            if dates:
+                last = upper - DAY
+                parameters.append(dict(parameter, type='date/range', value=f'{lower.date().isoformat()}~{last.date().isoformat()}'))
+            else:
+                parameters.append(dict(parameter, type='number/between', value=[float(lower), float(upper - 1)]))
+        return parameters
+
+
+def make_partition(partition_by=None, partitions=None, partition_range=None):
+    '''
+    :return: Partition, or None if partition_by is None.
+    '''
+    if partition_by is None:
+        if partitions is not None or partition_range is not None:
+            raise ValueError('partitions and partition_range need partition_by.')
+        return None
+    if partitions is None:
+        raise ValueError("partition_by needs partitions, a number of slices or an interval like '1d'.")
+    return Partition(column=partition_by, partitions=partitions, range=partition_range)
+
+
+def range_clauses(field, lower, upper, closed):
+    '''
+    MBQL filter clauses of one slice.
+    '''
+    return [['>=', field, format_bound(lower)], ['<=' if closed else '<', field, format_bound(upper)]]
+
+
+def add_filter(query, clauses):
+    '''
+    Add clauses to the filter of an MBQL query with and.
+    '''
+    existing = query.get('filter')
+    if not existing:
+        existing = []
+    elif existing[0] == 'and':
+        existing = existing[1:]
+    else:
+        existing = [existing]
+    query['filter'] = ['and'] + clauses + existing
+
+
+def find_range(query, field_id):
+    '''
+    (start, end) of a between filter on a field in an MBQL query, or None.
+    '''
+    existing = query.get('filter') or []
+    clauses = existing[1:] if existing and existing[0] == 'and' else [existing]
+    for clause in clauses:
+        if len(clause) == 4 and clause[0] == 'between' and isinstance(clause[1], list) and clause[1][:2] == ['field', field_id]:
+            return clause[2], clause[3]
+    return None
+
+
+class PartitionPlan:
+    def __init__(self, plans):
+        '''
+        Export requests of one URL split into slices of a column: one ChunkPlan per slice, requests in slice order.
+
+        :param plans: A list of ChunkPlan.
+        '''
+        self.plans = plans
+
+    @property
+    def request(self):
+        return self.plans[0].request
+
+    @property
+    def is_bulk(self):
+        return len(self.plans) > 1 or self.plans[0].is_bulk
+
+    @property
+    def split_keys(self):
+        # Adaptive chunk sizes do not apply across slices.
+        return []
+
+    def requests(self):
+        return [r for plan in self.plans for r in plan.requests()]
+
+
+def partition_plan(plans, format):
+    '''
+    :param plans: ChunkPlan of each slice.
+    :param format: Export format.
+    :return: PartitionPlan, or the plan of the only slice.
+    '''
+    if len(plans) == 1:
+        return plans[0]
+    if format not in ['json', 'csv']:
+        raise ValueError('Package only supports JSON and CSV formats with partitions due to data combining limitations.')
+    return PartitionPlan(plans)
@@ -0,0 +1,185 @@
+import asyncio
+import contextvars
+import random
+import re
+import time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+
+import aiohttp
+from tenacity import stop_after_attempt
+
+# HTTP statuses worth retrying: timeout, too early, rate limit and server errors.
+RETRY_STATUSES = [408, 425, 429, 500, 502, 503, 504]
+
+# Metabase error_type values in failed query responses.
+RETRY_ERROR_TYPES = ['timed-out', 'out-of-memory', 'db', 'server', 'driver']
+NO_RETRY_ERROR_TYPES = ['invalid-query', 'invalid-parameter', 'missing-required-parameter', 'missing-required-permissions', 'unsupported-feature', 'bad-configuration', 'qp']
+
+retry_budget = contextvars.ContextVar('retry_budget', default=None)
+
+
+class MetabaseError(Exception):
+    def __init__(self, message, status=None, error_type=None, retryable=False, retry_after=None):
+        '''
+        Error returned by Metabase for a query.
+
+        :param message: Error message.
+        :param status: HTTP status.
+        :param error_type: Metabase error_type, e.g. timed-out, invalid-query.
+        :param retryable: Retry or not.
+        :param retry_after: Seconds to wait from the Retry-After header.
+        '''
+        super().__init__(message)
+        self.status = status
+        self.error_type = error_type
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+class RetryBudget:
+    def __init__(self, retries):
+        '''
+        Retries shared by all requests of one query() or sql() call.
+
+        :param retries: Number of retries.
+        '''
+        self.remaining = retries
+
+    def spend(self):
+        if self.remaining <= 0:
+            return False
+        self.remaining -= 1
+        return True
+
+
+@contextmanager
+def use_retry_budget(retries):
+    '''
+    Share a RetryBudget with every request started inside this block, None for no budget.
+
+    :param retries: Number of retries for a new budget, or a RetryBudget to keep sharing.
+    '''
+    if retries is not None and not isinstance(retries, RetryBudget):
+        retries = RetryBudget(retries)
+    token = retry_budget.set(retries)
+    try:
+        yield
+    finally:
+        retry_budget.reset(token)
+
+
+def parse_retry_after(value):
+    '''
+    Parse a Retry-After header, seconds or an HTTP date.
+
+    :return: Seconds to wait, or None.
+    '''
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def match_retry_errors(message, retry_errors):
+    # None to retry with any error, or a list of errors to match.
+    if not retry_errors:
+        return True
+    return bool(re.search(pattern='|'.join(retry_errors), string=message, flags=re.IGNORECASE))
+
+
+def metabase_error(data, status=None, retry_errors=None, retry_after=None):
+    '''
+    Build a MetabaseError from a failed query response.
+
+    :param data: Response JSON with error and optionally error_type.
+    :param status: HTTP status.
+    :param retry_errors: Errors to retry when error_type does not decide, see Metabase.
+    :param retry_after: Retry-After header of the response.
+    :return: MetabaseError.
+    '''
+    message = str(data.get('error', data))
+    error_type = data.get('error_type')
+
+    if error_type in RETRY_ERROR_TYPES:
+        retryable = True
+    elif error_type in NO_RETRY_ERROR_TYPES:
+        retryable = bool(retry_errors) and match_retry_errors(message, retry_errors)
+    else:
+        retryable = match_retry_errors(message, retry_errors)
+
+    return MetabaseError(message, status=status, error_type=error_type, retryable=retryable, retry_after=parse_retry_after(retry_after))
+
+
+def is_retryable(error):
+    '''
+    Classify an error by type and HTTP status.
+    '''
+    if isinstance(error, MetabaseError):
+        return error.retryable
+    elif isinstance(error, aiohttp.ClientResponseError):
+        return error.status in RETRY_STATUSES
+    elif isinstance(error, (asyncio.TimeoutError, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError)):
+        return True
+    return False
+
+
+def should_retry(error):
+    '''
+    Retry predicate for tenacity, the shared retry budget is spent by stop_retrying.
+    '''
+    return is_retryable(error)
+
+
+class stop_retrying:
+    def __init__(self, attempts):
+        '''
+        Stop condition for tenacity: the attempt limit, or the shared retry budget is spent.
+        tenacity checks it after the retry predicate, so the budget is only spent on retries that happen.
+
+        :param attempts: Attempts per request, the first one included.
+        '''
+        self.after_attempt = stop_after_attempt(attempts)
+
+    def __call__(self, retry_state):
+        if self.after_attempt(retry_state):
+            return True
+        budget = retry_budget.get()
+        return budget is not None and not budget.spend()
+
+
+def get_retry_after(error):
+    if isinstance(error, MetabaseError):
+        return error.retry_after
+    elif isinstance(error, aiohttp.ClientResponseError) and error.headers:
+        return parse_retry_after(error.headers.get('Retry-After'))
+    return None
+
+
+class wait_backoff:
+    def __init__(self, initial=1, max=60, jitter=1):
+        '''
+        Exponential backoff with jitter for tenacity, a Retry-After header wins when the server sends one.
+
+        :param initial: First wait in seconds.
+        :param max: Longest wait in seconds.
+        :param jitter: Random seconds added to each wait.
+        '''
+        self.initial = initial
+        self.max = max
+        self.jitter = jitter
+
+    def __call__(self, retry_state):
+        error = retry_state.outcome.exception() if retry_state.outcome else None
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            return min(retry_after, self.max)
+        # initial, 2 * initial, 4 * initial... plus jitter, up to max.
+        wait = self.initial * 2 ** min(retry_state.attempt_number - 1, 64)
+        return max(0, min(wait + random.uniform(0, self.jitter), self.max))
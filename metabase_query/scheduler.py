@@ -0,0 +1,220 @@
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from urllib import parse
+
+
+class Scheduler:
+    def __init__(self, max_in_flight=20, limit_per_domain=5):
+        '''
+        Limit requests in flight across all URLs, chunks and retries of a Metabase object.
+        Waiting requests are served round-robin by group (one group per URL), so a big bulk query does not starve the others.
+        Calls of one object may run on different event loops in different threads, e.g. sync query() calls without open(),
+        so the state is guarded by a lock and waiters are woken on their own loop.
+
+        :param max_in_flight: The limit of requests in flight for all domains.
+        :param limit_per_domain: The limit of requests in flight per domain.
+        '''
+        self.max_in_flight = max_in_flight
+        self.limit_per_domain = limit_per_domain
+
+        self.in_flight = 0
+        self._domain_in_flight = {}
+        self._waiters = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def domain_of(url):
+        return parse.urlparse(url).netloc
+
+    def _has_capacity(self, domain):
+        return self.in_flight < self.max_in_flight and self._domain_in_flight.get(domain, 0) < self.limit_per_domain
+
+    def _take(self, domain):
+        self.in_flight += 1
+        self._domain_in_flight[domain] = self._domain_in_flight.get(domain, 0) + 1
+
+    def _release(self, domain):
+        with self._lock:
+            self._give_back(domain)
+
+    def _give_back(self, domain):
+        # Called with the lock held.
+        self._untake(domain)
+        self._dispatch()
+
+    def _untake(self, domain):
+        self.in_flight -= 1
+        self._domain_in_flight[domain] -= 1
+        if not self._domain_in_flight[domain]:
+            del self._domain_in_flight[domain]
+
+    def _wake(self, domain, future):
+        # Runs on the loop of the waiter. A waiter cancelled after it was served gives its slot back.
+        if future.cancelled():
+            self._release(domain)
+        elif not future.done():
+            future.set_result(None)
+
+    def _dispatch(self):
+        # Called with the lock held. Serve one waiter per group in turn until no waiter fits.
+        served = True
+        while served and self._waiters and self.in_flight < self.max_in_flight:
+            served = False
+            for group in list(self._waiters):
+                queue = self._waiters[group]
+                while queue and queue[0][1].done():
+                    queue.popleft()
+                if not queue:
+                    del self._waiters[group]
+                    continue
+
+                domain, future = queue[0]
+                if not self._has_capacity(domain):
+                    continue
+
+                queue.popleft()
+                self._take(domain)
+                try:
+                    # Futures are not thread-safe, the waiter may belong to the loop of another thread.
+                    future.get_loop().call_soon_threadsafe(self._wake, domain, future)
+                except RuntimeError:
+                    # The loop of the waiter is closed.
+                    self._untake(domain)
+                served = True
+
+                # Move the served group to the end of the line.
+                if queue:
+                    self._waiters.move_to_end(group)
+                else:
+                    del self._waiters[group]
+                break
+
+    @asynccontextmanager
+    async def slot(self, domain, group=None):
+        '''
+        Wait for a free slot, hold it while the request is sent and read.
+
+        :param domain: Domain of the request, see domain_of().
+        :param group: Any hashable to share fairly with other groups, e.g. one per URL.
+        '''
+        future = None
+        with self._lock:
+            if not self._waiters and self._has_capacity(domain):
+                self._take(domain)
+            else:
+                future = asyncio.get_running_loop().create_future()
+                self._waiters.setdefault(group, deque()).append((domain, future))
+                self._dispatch()
+
+        if future is not None:
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    self._release(domain)
+                else:
+                    # If it was served meanwhile, _wake() gives the slot back.
+                    future.cancel()
+                raise
+
+        try:
+            yield
+        finally:
+            self._release(domain)
+
+
+@asynccontextmanager
+async def hold_in(stack, context):
+    '''
+    Enter context into an AsyncExitStack: it stays entered after this context manager exits, until the stack is closed.
+    '''
+    await stack.enter_async_context(context)
+    yield
+
+
+async def gather_bounded(function, items, workers):
+    '''
+    Like asyncio.gather(*[function(item) for item in items], return_exceptions=True),
+    but only a fixed number of workers run at a time and each coroutine is created when a worker picks its item.
+
+    :param function: Async function called with one item.
+    :param items: A list of items.
+    :param workers: Number of workers.
+    :return: A list of results or exceptions, in the order of items.
+    '''
+    results = [None] * len(items)
+    queue = iter(enumerate(items))
+
+    async def worker():
+        for i, item in queue:
+            try:
+                results[i] = await function(item)
+            except Exception as e:
+                results[i] = e
+
+    await asyncio.gather(*[worker() for _ in range(max(1, min(workers, len(items))))])
+    return results
+
+
+class SingleFlight:
+    def __init__(self):
+        '''
+        Coalesce identical calls in flight: callers with the same key share one call and one result.
+        Results are shared between callers, treat them as read-only.
+        Only calls on the same event loop are coalesced, a task can not be awaited from another loop.
+        '''
+        self._calls = {}
+
+        # Counters
+        self.calls = 0
+        self.shared = 0
+
+    @staticmethod
+    def make_key(url, body, column_sort=None):
+        '''
+        Hash of the export URL, the raw request body and the column order.
+        Cheaper than ResultCache.make_key(), the payload is not parsed, so only byte-identical requests are coalesced.
+
+        :param body: Request body bytes.
+        '''
+        digest = hashlib.sha256(url.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(body)
+        digest.update(b'\0')
+        digest.update(repr(column_sort).encode('utf-8'))
+        return digest.hexdigest()
+
+    async def do(self, key, function):
+        '''
+        Call function, or wait for the call of the same key already in flight.
+
+        :param key: Any hashable, e.g. a hash of the request payload.
+        :param function: Async function without arguments.
+        :return: Result of the call.
+        '''
+        key = (asyncio.get_running_loop(), key)
+        call = self._calls.get(key)
+        if call is None:
+            self.calls += 1
+            call = [asyncio.ensure_future(function()), 0]
+            self._calls[key] = call
+            call[0].add_done_callback(lambda task: self._calls.pop(key, None) if self._calls.get(key) is call else None)
+        else:
+            self.shared += 1
+
+        call[1] += 1
+        try:
+            # A cancelled caller does not cancel the call of the others.
+            return await asyncio.shield(call[0])
+        except asyncio.CancelledError:
+            if call[1] == 1 and not call[0].done():
+                call[0].cancel()
+            raise
+        finally:
+            call[1] -= 1
+
+    def stats(self):
+        return {'calls': self.calls, 'shared': self.shared, 'in_flight': len(self._calls)}
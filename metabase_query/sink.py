@@ -0,0 +1,157 @@
+import os
+import shutil
+import tempfile
+
+from . import codec
+from .columnar import decode_arrow, import_optional
+
+SINK_FORMATS = ['csv', 'jsonl', 'parquet']
+
+
+class FileSink:
+    # Metabase export format of the chunks.
+    export_format = 'csv'
+    part_suffix = '.part'
+
+    def __init__(self, path):
+        '''
+        Write export chunks to a file as soon as they finish.
+        Each chunk goes to its own part file, finish() joins the parts in chunk order and renames the result to path,
+        so memory holds about one chunk per request in flight.
+
+        :param path: Output file path.
+        '''
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.parts_dir = tempfile.mkdtemp(prefix=f'.{os.path.basename(path)}.', suffix='.parts', dir=directory)
+        self.parts = {}
+        self.rows = 0
+
+    def _part_path(self, index):
+        return os.path.join(self.parts_dir, f'{index}{self.part_suffix}')
+
+    def write_part(self, index, data, column_types=None):
+        '''
+        Write one chunk to its part file.
+
+        :param index: Chunk index, parts are joined in this order.
+        :param data: Export data of the chunk.
+        :param column_types: Map column display name to Metabase base type.
+        '''
+        path = self._part_path(index)
+        self._write_part(path, data, column_types)
+        self.parts[index] = path
+
+    def _write_part(self, path, data, column_types):
+        raise NotImplementedError
+
+    def _join(self, file):
+        raise NotImplementedError
+
+    def finish(self):
+        '''
+        Join the parts in order into path.
+
+        :return: path.
+        '''
+        tmp_path = f'{self.parts_dir}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                self._join(f)
+            os.replace(tmp_path, self.path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            self.abort()
+        return self.path
+
+    def abort(self):
+        shutil.rmtree(self.parts_dir, ignore_errors=True)
+
+
+class CSVSink(FileSink):
+    export_format = 'csv'
+    part_suffix = '.csv'
+
+    def _write_part(self, path, data, column_types):
+        with open(path, 'wb') as f:
+            f.write(data)
+        self.rows += max(0, data.count(b'\n') - 1)
+
+    def _join(self, file):
+        last = b'\n'
+        for i, index in enumerate(sorted(self.parts)):
+            with open(self.parts[index], 'rb') as part:
+                # Keep the header of the first part only.
+                if i > 0:
+                    part.readline()
+                block = part.read(2 ** 20)
+                if block and last != b'\n':
+                    file.write(b'\n')
+                while block:
+                    file.write(block)
+                    last = block[-1:]
+                    block = part.read(2 ** 20)
+
+
+class JSONLSink(FileSink):
+    export_format = 'json'
+    part_suffix = '.jsonl'
+
+    def _write_part(self, path, data, column_types):
+        with open(path, 'w', encoding='utf-8') as f:
+            for record in data:
+                f.write(codec.dumps(record))
+                f.write('\n')
+        self.rows += len(data)
+
+    def _join(self, file):
+        for index in sorted(self.parts):
+            with open(self.parts[index], 'rb') as part:
+                shutil.copyfileobj(part, file)
+
+
+class ParquetSink(FileSink):
+    export_format = 'csv'
+    part_suffix = '.parquet'
+
+    def __init__(self, path):
+        import_optional('pyarrow.parquet', 'parquet')
+        super().__init__(path)
+
+    def _write_part(self, path, data, column_types):
+        pq = import_optional('pyarrow.parquet', 'parquet')
+        table = decode_arrow(data, column_types=column_types)
+        pq.write_table(table, path)
+        self.rows += table.num_rows
+
+    def _join(self, file):
+        pq = import_optional('pyarrow.parquet', 'parquet')
+        writer = None
+        try:
+            for index in sorted(self.parts):
+                table = pq.read_table(self.parts[index])
+                if writer is None:
+                    writer = pq.ParquetWriter(file, table.schema)
+                elif table.schema != writer.schema:
+                    # Columns without values may be read with another type.
+                    table = table.cast(writer.schema)
+                writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
+
+
+SINKS = {'csv': CSVSink, 'jsonl': JSONLSink, 'parquet': ParquetSink}
+
+
+def open_sink(path, format):
+    '''
+    :param path: Output file path.
+    :param format: csv, jsonl, parquet.
+    :return: FileSink.
+    '''
+    if format not in SINKS:
+        raise ValueError(f'format must be one of {", ".join(SINK_FORMATS)}.')
+    return SINKS[format](path)
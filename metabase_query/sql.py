@@ -3,9 +3,12 @@ from urllib import parse
 import json
 import base64
 import re
-import aiohttp
-import asyncio
-from .utils import split_list, combine_results, parse_filters
+from .utils import parse_filters
+from . import codec
+from .chunking import ChunkPlan, placeholder, template_builder
+from .partition import partition_plan
+from .pagination import check_pagination_args, page_sql, range_sql, value_key_kind
+from .scheduler import gather_bounded
 
 class SQL:
     def __init__(self, metabase):
@@ -51,55 +54,97 @@ class SQL:
         return data
 
 
-    async def export_url(self, session, url_data, format='json'):
+    def url_request(self, url_data, format='json'):
         url = f"{url_data['domain']}/api/dataset/{format}"
-        form_data = {'query': json.dumps(url_data['dataset_query'])}
-        return await self.metabase.export(session=session, url=url, form_data=form_data, format=format)
+        form_data = {'query': codec.dumps(url_data['dataset_query'])}
+        return {'url': url, 'form_data': form_data}
+
+
+    async def export_url(self, session, url_data, format='json'):
+        return await self.metabase.export(session=session, format=format, **self.url_request(url_data=url_data, format=format))
 
 
-    async def query_url(self, session, url, format='json', filters=None, filter_chunk_size=5000):
+    async def prepare_url(self, session, url, format='json', filters=None, filter_chunk_size=5000, partition=None):
         '''
-        Export data for SQL URL.
+        Parse a SQL URL and build one export request, or one export request per chunk for a bulk filter.
 
         :param session: aiohttp.ClientSession.
         :param url: SQL URL.
         :param format: json, csv, xlsx.
-        :return: One data.
+        :param filters: A dict.
+        :param filter_chunk_size: If you have a bulk value filter, the package will splits your values into chunks to send the requests, and then concat the results into a single data.
+        :param partition: Partition to split the query into slices of a date or number filter.
+        :return: ChunkPlan, or PartitionPlan with one ChunkPlan per slice, of requests for Metabase.export.
         '''
 
         filters, max_filter_key, max_filter_value_count = parse_filters(filters)
 
         url_data = await self.parse_url(url=url, filters=filters)
 
-        # Send one request if there are no filter has values > filter_chunk_size
-        if max_filter_value_count <= filter_chunk_size:
-            return await self.export_url(session=session, url_data=url_data, format=format)
-
-        else:
-            if format not in ['json', 'csv']:
-                raise ValueError(f'Package only supports JSON and CSV formats with bulk filter values due to data combining limitations. Your {max_filter_key} filter is over filter_chunk_size {max_filter_value_count}/{filter_chunk_size}.')
+        bulk_filters = filters
+        if partition is not None:
+            bulk_filters = {k: v for k, v in (filters or {}).items() if k != partition.column}
 
-            # Slit values to chunks > Create a list of card_data
-            value_list = split_list(input_list=filters[max_filter_key], chunk_size=filter_chunk_size)
+        def chunk_plan(url_data):
+            request = self.url_request(url_data=url_data, format=format)
 
-            url_data_list = []
-            for value in value_list:
+            # Payload template of url_data, the values of chunked filters are filled per chunk
+            def template_request(keys):
                 new_url_data = copy.deepcopy(url_data)
                 for parameter in new_url_data['dataset_query']['parameters']:
-                    if parameter['target'][-1][-1] == max_filter_key:
-                        parameter['value'] = value
-                url_data_list.append(new_url_data)
+                    if parameter['target'][-1][-1] in keys:
+                        parameter['value'] = [placeholder(parameter['target'][-1][-1])]
+                return self.url_request(url_data=new_url_data, format=format)
+
+            # One request if no filter needs splitting
+            plan = ChunkPlan(request=request, build=template_builder(request=request, template_request=template_request), values=bulk_filters, chunk_size=filter_chunk_size, max_values=self.metabase.max_filter_values, max_body_size=self.metabase.max_body_size)
+
+            if plan.is_bulk and format not in ['json', 'csv']:
+                raise ValueError(f'Package only supports JSON and CSV formats with bulk filter values due to data combining limitations. Your {", ".join(plan.split_keys)} {"filters are" if len(plan.split_keys) > 1 else "filter is"} over filter_chunk_size, max_filter_values or max_body_size.')
+
+            return plan
+
+        if partition is None:
+            return chunk_plan(url_data)
+
+        # One plan per slice of the partition filter
+        parameters = url_data['dataset_query']['parameters']
+        slugs = [p['slug'] for p in parameters]
+        if partition.column not in slugs:
+            raise ValueError(f"The {partition.column} filter is not available for this query. These are the available filters: {', '.join(slugs)}.")
+        index = slugs.index(partition.column)
+        plans = []
+        for parameter in partition.parameter_slices(parameters[index]):
+            dataset_query = dict(url_data['dataset_query'], parameters=parameters[:index] + [parameter] + parameters[index + 1:])
+            plans.append(chunk_plan(dict(url_data, dataset_query=dataset_query)))
+        self.metabase.print_if_verbose(f'Partitioning {partition.column} into {len(plans)} slices')
+        return partition_plan(plans=plans, format=format)
+
+
+    async def query_url(self, session, url, format='json', filters=None, filter_chunk_size=5000, output=None, checkpoint=None, partition=None, pagination=None):
+        '''
+        Export data for SQL URL.
 
-            tasks = []
-            for u in url_data_list:
-                task = asyncio.create_task(self.export_url(session=session, url_data=u, format=format))
-                tasks.append(task)
+        :param session: aiohttp.ClientSession.
+        :param url: SQL URL.
+        :param format: json, csv, xlsx.
+        :param output: None, arrow, pandas, numpy. Columnar outputs need format csv.
+        :param checkpoint: Checkpoint to save completed chunks to and resume from.
+        :param partition: Partition to split the query into slices of a date or number filter.
+        :param pagination: Pagination to read the query in keyset pages.
+        :return: One data.
+        '''
+        if pagination is not None:
+            filters, max_filter_key, max_filter_value_count = parse_filters(filters)
+            check_pagination_args(format=format, filters=filters, filter_chunk_size=filter_chunk_size)
+            url_data = await self.parse_url(url=url, filters=filters)
+            return await self.paginate_native(session=session, domain=url_data['domain'], dataset_query=url_data['dataset_query'], format=format, output=output, pagination=pagination)
 
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-            return combine_results(results=results, format=format, verbose=self.metabase.verbose)
+        plan = await self.prepare_url(session=session, url=url, format=format, filters=filters, filter_chunk_size=filter_chunk_size, partition=partition)
+        return await self.metabase.export_plan(session=session, plan=plan, format=format, output=output, checkpoint=checkpoint)
 
 
-    async def export_sql(self, session, sql, database, format='json'):
+    async def export_sql(self, session, sql, database, format='json', pagination=None):
         '''
         Export data for SQL query.
 
@@ -107,6 +152,7 @@ class SQL:
         :param sql: SQL query.
         :param database: One database ID. Look at the slug on the browser.
         :param format: json, csv, xlsx.
+        :param pagination: Pagination to read the query in keyset pages.
         :return: One data.
         '''
 
@@ -132,27 +178,64 @@ class SQL:
             "native": {"query": sql},
             "type": "native",
         }
-        form_data = {'query': json.dumps(query)}
+        form_data = {'query': codec.dumps(query)}
 
         url = f"{domain}/api/dataset/{format}"
 
+        if pagination is not None:
+            check_pagination_args(format=format, filters=None, filter_chunk_size=1)
+            return await self.paginate_native(session=session, domain=domain, dataset_query=query, format=format, pagination=pagination)
+
         return await self.metabase.export(session=session, url=url, form_data=form_data, format=format)
 
 
-    async def query_sql(self, sqls, databases, format='json'):
+    async def paginate_native(self, session, domain, dataset_query, format='json', output=None, pagination=None):
+        '''
+        Read a native query in pages ordered by a unique key column, past the export row limit.
+        The SQL is wrapped as a subquery with a key range, ORDER BY and LIMIT; the row count, min and max key are fetched first to read key ranges in parallel.
+
+        :param session: aiohttp.ClientSession.
+        :param domain: Metabase domain with scheme.
+        :param dataset_query: Native dataset query, its parameters are kept.
+        :param format: json, csv.
+        :param output: None, arrow, pandas, numpy.
+        :param pagination: Pagination.
+        :return: Combined data.
+        '''
+        sql = dataset_query['native']['query']
+
+        def native_request(sql, format):
+            native = dict(dataset_query['native'], query=sql)
+            return {'url': f"{domain}/api/dataset/{format}", 'form_data': {'query': codec.dumps(dict(dataset_query, native=native))}}
+
+        limit = pagination.limit(self.metabase.export_row_limit)
+        data = await self.metabase.export(session=session, format='json', **native_request(sql=range_sql(sql=sql, column=pagination.column), format='json'))
+        count, start, end = list(data[0].values()) if data else [0, None, None]
+        ranges = pagination.ranges(count=count, start=start, end=end, limit=limit)
+
+        def page_request(lower=None, after=None, upper=None, closed=False):
+            return native_request(sql=page_sql(sql=sql, column=pagination.column, limit=limit, lower=lower, after=after, upper=upper, closed=closed), format=format)
+
+        # The column name in the result, without a table prefix. The key type comes from the JSON range query.
+        key_names = [pagination.column, pagination.column.split('.')[-1].strip('"`[]')]
+        return await self.metabase.export_pages(session=session, page_request=page_request, key_names=key_names, limit=limit, ranges=ranges, format=format, output=output, key_kind=value_key_kind(start))
+
+
+    async def query_sql(self, sqls, databases, format='json', pagination=None):
         '''
         Send one request or multiple requests with SQL to get data from Metabase.
 
         :param sqls: A SQL string or list of SQL.
         :param databases: One database ID or a list or database IDs follow SQL list. Look at the database slug on the browser.
         :param format: json, csv, xlsx.
+        :param pagination: None or a Pagination to read each query in keyset pages.
         :return: One data or a list of data.
         '''
-        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit_per_host=self.metabase.limit_per_host), timeout=aiohttp.ClientTimeout(total=self.metabase.timeout)) as session:
+        async with self.metabase.call_context() as session:
 
             # 1 SQL, 1 database
             if not isinstance(sqls, list) and not isinstance(databases, list):
-                return await self.export_sql(session=session, sql=sqls, database=databases, format=format)
+                return await self.export_sql(session=session, sql=sqls, database=databases, format=format, pagination=pagination)
 
             else:
                 # 1 SQL, n database > Raise
@@ -165,12 +248,16 @@ class SQL:
                 elif len(sqls) != len(databases):
                     raise ValueError('Database list and SQL list must be the same length. Supported 1 SQL - 1 database, n SQL - 1 database, and n SQL - n database')
 
-                tasks = []
-                for sql, db in zip(sqls, databases):
-                    task = asyncio.create_task(self.export_sql(session=session, sql=sql, database=db, format=format))
-                    task.sql = sql
-                    task.database = db
-                    tasks.append(task)
-                await asyncio.gather(*tasks, return_exceptions=True)
-                record_results = [{'sql': task.sql, 'database': task.database, 'data': task.result()} for task in tasks]
-                return record_results
\ No newline at end of file
+                async def export(pair):
+                    sql, db = pair
+                    return await self.export_sql(session=session, sql=sql, database=db, format=format, pagination=pagination)
+
+                pairs = list(zip(sqls, databases))
+                results = await gather_bounded(function=export, items=pairs, workers=self.metabase.scheduler.max_in_flight)
+
+                record_results = []
+                for (sql, db), result in zip(pairs, results):
+                    if isinstance(result, Exception):
+                        raise result
+                    record_results.append({'sql': sql, 'database': db, 'data': result})
+                return record_results
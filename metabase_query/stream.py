@@ -0,0 +1,102 @@
+import codecs
+import csv
+import json
+
+
+class CSVRowParser:
+    '''
+    Incremental CSV parser, feed it bytes as they arrive and get back complete rows.
+    A row is only parsed once all of its lines are received, so quoted values may contain new lines.
+    '''
+    def __init__(self):
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._tail = ''
+        self._record = []
+        self._quotes = 0
+
+    def feed(self, data, final=False):
+        text = self._tail + self._decoder.decode(data, final=final)
+        lines = text.split('\n')
+
+        # The last piece has no new line yet, keep it for the next chunk.
+        self._tail = lines.pop()
+        lines = [f'{line}\n' for line in lines]
+        if final and self._tail:
+            lines.append(self._tail)
+            self._tail = ''
+
+        complete_lines = []
+        for line in lines:
+            self._record.append(line)
+            self._quotes += line.count('"')
+            # An even number of quotes means the record is not inside a quoted value.
+            if self._quotes % 2 == 0:
+                complete_lines.extend(self._record)
+                self._record = []
+                self._quotes = 0
+
+        rows = [row for row in csv.reader(complete_lines) if row]
+        if final and self._record:
+            raise ValueError('CSV data ended inside a quoted value.')
+        return rows
+
+    def close(self):
+        return self.feed(b'', final=True)
+
+
+class JSONArrayParser:
+    '''
+    Incremental parser for a JSON array of objects, feed it bytes as they arrive and get back complete items.
+    '''
+    def __init__(self):
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._json_decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._started = False
+        self._done = False
+
+    def _skip(self, pos, chars):
+        while pos < len(self._buffer) and self._buffer[pos] in chars:
+            pos += 1
+        return pos
+
+    def feed(self, data, final=False):
+        self._buffer += self._decoder.decode(data, final=final)
+        items = []
+        pos = 0
+
+        while not self._done:
+            pos = self._skip(pos, ' \t\r\n')
+            if pos >= len(self._buffer):
+                break
+
+            if not self._started:
+                if self._buffer[pos] != '[':
+                    raise ValueError('Expected a JSON array.')
+                self._started = True
+                pos += 1
+                continue
+
+            pos = self._skip(pos, ' \t\r\n,')
+            if pos >= len(self._buffer):
+                break
+            if self._buffer[pos] == ']':
+                self._done = True
+                pos += 1
+                break
+
+            try:
+                item, pos = self._json_decoder.raw_decode(self._buffer, pos)
+            except json.JSONDecodeError:
+                # The item is not complete yet.
+                break
+            items.append(item)
+
+        self._buffer = self._buffer[pos:]
+
+        if final and not self._done:
+            raise ValueError('JSON array ended before it was complete.')
+        return items
+
+    def close(self):
+        return self.feed(b'', final=True)
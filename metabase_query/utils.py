@@ -2,45 +2,98 @@ import re
 from urllib import parse
 import json
 import base64
+from itertools import chain
+from .columnar import OUTPUTS, concat
+from .sink import SINK_FORMATS
 
-def raise_retry_errors(error, retry_errors):
-    if not retry_errors:
-        raise Exception(f"Any error: {error}")
-    elif re.search(pattern='|'.join(retry_errors), string=error, flags=re.IGNORECASE):
-        raise Exception(f"Retry error: {error}")
-    else:
-        return Exception(error)
+
+def check_query_args(format, filter_chunk_size, output=None):
+    if filter_chunk_size < 1:
+        raise ValueError('filter_chunk_size must be positive.')
+
+    if format.lower() not in ['json', 'csv', 'xlsx']:
+        raise ValueError('Metabase only supports JSON, CSV and XLSX formats.')
+
+    if output is not None and output not in OUTPUTS:
+        raise ValueError(f'output must be None or one of {", ".join(OUTPUTS)}.')
+
+
+def check_iter_args(url, format, filter, filter_chunk_size):
+    check_query_args(format=format, filter_chunk_size=filter_chunk_size)
+
+    if format.lower() not in ['json', 'csv']:
+        raise ValueError('Streaming only supports JSON and CSV formats.')
+
+    if isinstance(url, list) or isinstance(filter, list):
+        raise ValueError('Streaming supports one URL and one filter dict, call it once per URL.')
 
 
-def split_list(input_list, chunk_size):
-    return [input_list[i:i + chunk_size] for i in range(0, len(input_list), chunk_size)]
+def check_file_args(url, format, filter, filter_chunk_size):
+    check_query_args(format='csv', filter_chunk_size=filter_chunk_size)
 
+    if format.lower() not in SINK_FORMATS:
+        raise ValueError(f'Writing to a file supports {", ".join(SINK_FORMATS)} formats.')
 
-def combine_results(results, format='json', verbose=True):
+    if isinstance(url, list) or isinstance(filter, list):
+        raise ValueError('Writing to a file supports one URL and one filter dict, call it once per URL.')
+
+
+def combine_results(results, format='json', verbose=True, file=None):
     format = format.lower()
-    if format not in ['json', 'csv']:
-        raise ValueError('This function supports JSON and CSV due to data combining limitations.')
+    if format not in ['json', 'csv'] + OUTPUTS:
+        raise ValueError('This function supports JSON, CSV and columnar outputs due to data combining limitations.')
 
-    if [r for r in results if isinstance(r, Exception)] and verbose:
-        print('Some requests failed because the retry count was exceeded. However, you still received data from successful requests.')
+    failed = [i for i, r in enumerate(results) if isinstance(r, Exception)]
+    if failed and verbose:
+        print(f'{len(failed)} of {len(results)} requests failed because the retry count was exceeded: chunks {failed}. However, you still received data from successful requests. Use checkpoint to resume the failed chunks.')
 
     success_results = [r for r in results if not isinstance(r, Exception)]
 
     if format == 'json':
-        combined_data = sum(success_results, [])
+        # Linear in the number of chunks, sum() would copy the list built so far on every chunk.
+        combined_data = list(chain.from_iterable(success_results))
     elif format == 'csv':
-        combined_data = []
-        for i, data in enumerate(success_results):
-            lines = data.decode('utf-8').splitlines()
-            if i == 0:
-                combined_data.extend(lines)
-            else:
-                combined_data.extend(lines[1:])
-        combined_data = "\n".join(combined_data).encode('utf-8')
+        combined_data = combine_csv(results=success_results, file=file)
+    else:
+        combined_data = concat(results=success_results, output=format)
 
     return combined_data
 
 
+def combine_csv(results, file=None):
+    '''
+    Concatenate CSV chunks as bytes, keep the header of the first chunk only.
+
+    :param results: A list of CSV bytes.
+    :param file: A binary file object to write to instead of returning bytes. Default is None.
+    :return: Combined bytes, or the number of bytes written if file is given.
+    '''
+    pieces = []
+    for i, data in enumerate(results):
+        view = memoryview(data)
+        if i > 0:
+            header_end = data.find(b'\n')
+            # Header only, no rows.
+            if header_end == -1:
+                continue
+            view = view[header_end + 1:]
+        if not view:
+            continue
+        # The previous chunk may end without a new line.
+        if pieces and pieces[-1][-1] != 10:
+            pieces.append(memoryview(b'\n'))
+        pieces.append(view)
+
+    if file is None:
+        # Join allocates the output once and copies each chunk into it.
+        return b''.join(pieces)
+
+    size = 0
+    for piece in pieces:
+        size += file.write(piece)
+    return size
+
+
 def define_url(url):
     parse_result = parse.urlparse(url=url)
     if re.search(pattern='^/question/(\d*)(\-.*)?', string=parse_result.path):
@@ -58,10 +111,15 @@ def parse_filters(filters):
     if filters:
         # Rename keys
         filters = {str(f).lower().replace(' ', '_'): filters[f] for f in filters}
-        # Convert value to list
+        # Convert value to list, drop duplicate values and keep the order.
         for filter in filters:
             if not isinstance(filters[filter], list):
                 filters[filter] = [filters[filter]]
+            try:
+                filters[filter] = list(dict.fromkeys(filters[filter]))
+            except TypeError:
+                # Unhashable values
+                pass
         # Find max key, value count
         max_filter_key = max(filters, key=lambda k: len(filters[k]))
         max_filter_value_count = len(filters[max_filter_key])
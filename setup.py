@@ -14,9 +14,20 @@ setup(
     author_email='tnmhieu@gmail.com',
     packages=find_packages(),
     install_requires=[
-        'tenacity',
+        'tenacity>=8.0',
         'nest-asyncio',
-        'aiohttp',
+        'aiohttp>=3.9',
         'asyncio'
-    ]
+    ],
+    extras_require={
+        'arrow': ['pyarrow'],
+        'parquet': ['pyarrow'],
+        'pandas': ['pandas'],
+        'numpy': ['numpy'],
+        'prometheus': ['prometheus_client'],
+        'opentelemetry': ['opentelemetry-api'],
+        'orjson': ['orjson'],
+        'brotli': ['brotli'],
+        'zstd': ['zstandard'],
+    }
 )
\ No newline at end of file
@@ -0,0 +1,20 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from mock_server import MockMetabase, MockServer
+
+
+@pytest.fixture
+def mock():
+    return MockMetabase()
+
+
+@pytest.fixture
+def server(mock):
+    with MockServer(mock) as url:
+        yield url
@@ -0,0 +1,124 @@
+import asyncio
+
+import aiohttp
+import pytest
+
+from metabase_query.breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitBreakers
+
+
+def new_breaker(**settings):
+    changes = []
+    breaker = CircuitBreaker(domain='a.com', window=10, min_requests=4, error_rate=0.5, open_seconds=0.01, recovery_requests=3, on_state_change=lambda domain, state: changes.append(state), **settings)
+    return breaker, changes
+
+
+def test_trips_on_error_rate():
+    breaker, changes = new_breaker()
+    for ok in [True, False, True]:
+        breaker.record(ok=ok, seconds=0.1)
+    assert breaker.state == CLOSED
+    breaker.record(ok=False, seconds=0.1)
+    assert breaker.state == OPEN
+    assert changes == [OPEN]
+    assert breaker.stats()['trips'] == 1
+
+
+def test_trips_on_latency():
+    breaker, changes = new_breaker(latency_threshold=1)
+    for _ in range(4):
+        breaker.record(ok=True, seconds=2)
+    assert breaker.state == OPEN
+
+
+def test_half_open_probes_then_close():
+    breaker, changes = new_breaker()
+    for _ in range(4):
+        breaker.record(ok=False, seconds=0.1)
+
+    async def main():
+        assert await breaker.wait()
+        assert breaker.state == HALF_OPEN
+        # One probe at a time at first.
+        assert breaker.probes_in_flight == 1
+        breaker.record(ok=True, seconds=0.1, probe=True)
+        assert breaker.probe_limit == 2
+        for _ in range(2):
+            assert await breaker.wait()
+            breaker.record(ok=True, seconds=0.1, probe=True)
+        assert not await breaker.wait()
+
+    asyncio.run(main())
+    assert changes == [OPEN, HALF_OPEN, CLOSED]
+
+
+def test_failed_probe_opens_again():
+    breaker, changes = new_breaker()
+    for _ in range(4):
+        breaker.record(ok=False, seconds=0.1)
+
+    async def main():
+        probe = await breaker.wait()
+        breaker.record(ok=False, seconds=0.1, probe=probe)
+
+    asyncio.run(main())
+    assert changes == [OPEN, HALF_OPEN, OPEN]
+    assert breaker.probes_in_flight == 0
+    assert breaker.trips == 2
+
+
+def test_half_open_ignores_requests_sent_before():
+    breaker, changes = new_breaker()
+    for _ in range(4):
+        breaker.record(ok=False, seconds=0.1)
+
+    async def main():
+        probe = await breaker.wait()
+        # Late results of requests sent before the breaker opened.
+        breaker.record(ok=False, seconds=0.1)
+        assert breaker.state == HALF_OPEN
+        for _ in range(3):
+            breaker.record(ok=True, seconds=0.1)
+        assert breaker.state == HALF_OPEN
+        assert breaker.probe_successes == 0
+        breaker.record(ok=True, seconds=0.1, probe=probe)
+        assert breaker.probe_successes == 1
+
+    asyncio.run(main())
+    assert changes == [OPEN, HALF_OPEN]
+
+
+def test_guard_records_results():
+    breaker, changes = new_breaker()
+
+    class Slot:
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *args):
+            return False
+
+    async def request(error=None):
+        async with breaker.guard(Slot()):
+            if error is not None:
+                raise error
+
+    async def main():
+        await request()
+        # Not a server error: the request was answered.
+        with pytest.raises(ValueError):
+            await request(ValueError('bad'))
+        for _ in range(2):
+            with pytest.raises(aiohttp.ClientConnectionError):
+                await request(aiohttp.ClientConnectionError())
+
+    # 2 errors in 4 requests.
+    asyncio.run(main())
+    assert changes == [OPEN]
+
+
+def test_breakers_per_domain():
+    breakers = CircuitBreakers(error_rate=0.9)
+    assert breakers.get('a.com') is breakers.get('a.com')
+    assert breakers.get('a.com') is not breakers.get('b.com')
+    assert breakers.get('b.com').error_rate == 0.9
+    assert set(breakers.stats()) == {'a.com', 'b.com'}
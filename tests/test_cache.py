@@ -0,0 +1,69 @@
+import pytest
+from aiohttp import web
+from mock_server import CARD_ID, MockMetabase, MockServer
+
+from metabase_query import Metabase, MetadataCache, ResultCache
+
+
+class SessionMockMetabase(MockMetabase):
+    # Only the session 'allowed' may read the card.
+    async def handle_card(self, request):
+        if request.headers.get('X-Metabase-Session') != 'allowed':
+            return web.Response(status=401)
+        return await super().handle_card(request)
+
+
+def test_metadata_cache_key_per_session():
+    key = MetadataCache.make_key('https://your-domain.com/', 'card', 1, 'session')
+    assert key[:3] == ('https://your-domain.com', 'card', '1')
+    assert key == MetadataCache.make_key('https://your-domain.com', 'card', '1', 'session')
+    assert key != MetadataCache.make_key('https://your-domain.com', 'card', 1, 'other session')
+    assert 'session' not in key
+
+
+def test_metadata_cache_is_not_shared_between_sessions():
+    mock = SessionMockMetabase()
+    cache = MetadataCache()
+    with MockServer(mock) as server:
+        url = f'{server}/question/{CARD_ID}'
+        allowed = Metabase(metabase_session='allowed', verbose=False, metadata_cache=cache)
+        assert len(allowed.query(url, filter={'order_id': [1, 2]})) == 2
+        assert len(allowed.query(url, filter={'order_id': [3]})) == 1
+        assert mock.stats['metadata'] == 1
+
+        denied = Metabase(metabase_session='denied', verbose=False, metadata_cache=cache)
+        with pytest.raises(PermissionError):
+            denied.query(url, filter={'order_id': [1, 2]})
+
+
+def test_metadata_cache_invalidate():
+    cache = MetadataCache()
+    cache.set(MetadataCache.make_key('https://a.com', 'card', 1, 's1'), {'id': 1})
+    cache.set(MetadataCache.make_key('https://a.com', 'card', 1, 's2'), {'id': 1})
+    cache.set(MetadataCache.make_key('https://a.com', 'table', 2, 's1'), {'id': 2})
+    assert cache.invalidate(domain='https://a.com', kind='card', object_id=1) == 2
+    assert len(cache) == 1
+
+
+def test_result_cache_is_not_shared_between_sessions(mock, server):
+    cache = ResultCache()
+    url = f'{server}/question/{CARD_ID}'
+    first = Metabase(metabase_session='session-A', verbose=False, result_cache=cache)
+    second = Metabase(metabase_session='session-B', verbose=False, result_cache=cache)
+
+    first.query(url, filter={'order_id': [1, 2]})
+    first.query(url, filter={'order_id': [1, 2]})
+    assert mock.stats['export'] == 1
+
+    # Another session asks the server, which checks its permissions.
+    records, summary = second.query(url, filter={'order_id': [1, 2]}, with_summary=True)
+    assert [r['ID'] for r in records] == [1, 2]
+    assert summary['cached'] == 0
+    assert mock.stats['export'] == 2
+
+
+def test_result_cache_key_per_session():
+    form_data = {'parameters': '[{"value": [1]}]'}
+    key = ResultCache.make_key(url='https://a.com/api/card/1/query/json', form_data=form_data, metabase_session='session-A')
+    assert key == ResultCache.make_key(url='https://a.com/api/card/1/query/json', form_data={'parameters': '[{"value":[1]}]'}, metabase_session='session-A')
+    assert key != ResultCache.make_key(url='https://a.com/api/card/1/query/json', form_data=form_data, metabase_session='session-B')
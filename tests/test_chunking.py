@@ -0,0 +1,133 @@
+from urllib import parse
+
+from metabase_query import codec
+from metabase_query.chunking import AdaptiveChunker, ChunkPlan, PayloadTemplate, body_size, byte_caps, count_rows, placeholder, plan_parts, split_parts, template_builder, value_size
+
+
+def card_request(values):
+    parameters = [
+        {'type': 'category', 'value': values['order_id'], 'target': ['dimension', ['template-tag', 'order_id']]},
+        {'type': 'category', 'value': values['status'], 'target': ['dimension', ['template-tag', 'status']]}
+    ]
+    return {'url': 'https://your-domain.com/api/card/1/query/json', 'form_data': {'parameters': codec.dumps(parameters)}}
+
+
+def card_plan(values, chunk_size, max_values=None, max_body_size=None):
+    def template_request(keys):
+        return card_request({key: [placeholder(key)] if key in keys else v for key, v in values.items()})
+
+    build = template_builder(request=card_request(values), template_request=template_request)
+    return ChunkPlan(request=card_request(values), build=build, values=values, chunk_size=chunk_size, max_values=max_values, max_body_size=max_body_size)
+
+
+def request_values(request):
+    parameters = codec.loads(parse.parse_qs(request['form_data'].decode('utf-8'))['parameters'][0])
+    return {p['target'][-1][-1]: p['value'] for p in parameters}
+
+
+def test_split_parts():
+    assert split_parts(list(range(7)), 3) == [[0, 1, 2], [3, 4], [5, 6]]
+    assert split_parts([1], 1) == [[1]]
+
+
+def test_plan_parts():
+    assert plan_parts({'a': 1000, 'b': 10}, chunk_size=500) == {'a': 2, 'b': 1}
+    # 250 + 10 values over max_values: a is split further.
+    parts = plan_parts({'a': 1000, 'b': 10}, chunk_size=500, max_values=200)
+    assert parts['b'] == 1
+    assert -(-1000 // parts['a']) + 10 <= 200
+
+
+def test_plan_parts_splits_the_cheapest_key():
+    parts = plan_parts({'a': 100, 'b': 100}, chunk_size=100, max_values=100)
+    assert sum(-(-100 // n) for n in parts.values()) <= 100
+
+
+def test_chunk_plan_single_request():
+    plan = card_plan({'order_id': [1, 2, 3], 'status': ['done']}, chunk_size=5)
+    assert not plan.is_bulk
+    assert plan.requests() == [card_request({'order_id': [1, 2, 3], 'status': ['done']})]
+
+
+def test_chunk_plan_cartesian_chunks():
+    values = {'order_id': list(range(10)), 'status': ['a', 'b', 'c']}
+    plan = card_plan(values, chunk_size=4)
+    assert plan.parts == {'order_id': 3}
+    requests = plan.requests()
+    assert [request_values(r) for r in requests] == [
+        {'order_id': [0, 1, 2, 3], 'status': ['a', 'b', 'c']},
+        {'order_id': [4, 5, 6], 'status': ['a', 'b', 'c']},
+        {'order_id': [7, 8, 9], 'status': ['a', 'b', 'c']}
+    ]
+
+    plan = card_plan(values, chunk_size=2)
+    assert plan.parts == {'order_id': 5, 'status': 2}
+    assert len(plan.requests()) == 10
+    pairs = [(o, s) for r in plan.requests() for o in request_values(r)['order_id'] for s in request_values(r)['status']]
+    assert sorted(pairs) == sorted((o, s) for o in values['order_id'] for s in values['status'])
+
+
+def test_chunk_plan_max_values():
+    plan = card_plan({'order_id': list(range(100)), 'status': list(range(100))}, chunk_size=100, max_values=100)
+    for request in plan.requests():
+        values = request_values(request)
+        assert len(values['order_id']) + len(values['status']) <= 100
+
+
+def test_byte_caps():
+    assert byte_caps({'a': 100, 'b': 1000}, budget=600) == {'a': 100, 'b': 500}
+    assert byte_caps({'a': 400, 'b': 400}, budget=600) == {'a': 300, 'b': 300}
+
+
+def test_chunk_plan_max_body_size():
+    values = {'order_id': [f'order-{i:05d}' for i in range(1000)], 'status': ['done']}
+    plan = card_plan(values, chunk_size=1000, max_body_size=4000)
+    requests = plan.requests()
+    assert len(requests) > 1
+    assert all(body_size(r['form_data']) <= 4000 for r in requests)
+    assert [v for r in requests for v in request_values(r)['order_id']] == values['order_id']
+
+
+def test_payload_template_render():
+    form_data = {'parameters': codec.dumps([{'value': [placeholder('a')]}, {'value': [placeholder('b')]}, {'value': [placeholder('a')]}])}
+    template = PayloadTemplate(form_data=form_data, keys=['a', 'b'])
+    body = template.render({'a': [1, 'x y'], 'b': ['é']})
+    expected = parse.urlencode({'parameters': codec.dumps([{'value': [1, 'x y']}, {'value': ['é']}, {'value': [1, 'x y']}])}).encode('utf-8')
+    assert body == expected
+
+
+def test_payload_template_empty_values():
+    template = PayloadTemplate(form_data={'parameters': codec.dumps([{'value': [placeholder('a')]}])}, keys=['a'])
+    assert template.render({'a': []}) == parse.urlencode({'parameters': '[{"value":[]}]'}).encode('utf-8')
+
+
+def test_adaptive_chunker_max_bytes():
+    values = [f'{i}' for i in range(10)] + [f'{i:0>100}' for i in range(10)]
+    sizes = [value_size(v) for v in values]
+    chunker = AdaptiveChunker(values=values, chunk_size=50, sizes=sizes, max_bytes=300)
+
+    chunks = []
+    chunk = chunker.next_chunk()
+    while chunk is not None:
+        chunks.append(chunk)
+        chunk = chunker.next_chunk()
+
+    assert [v for _, chunk in chunks for v in chunk] == values
+    assert all(sum(value_size(v) for v in chunk) <= 300 for _, chunk in chunks)
+    # Short values share a chunk with a long one, long ones fit 2 per chunk.
+    assert [len(chunk) for _, chunk in chunks] == [11, 2, 2, 2, 2, 1]
+
+
+def test_adaptive_chunker_value_over_max_bytes():
+    chunker = AdaptiveChunker(values=['x' * 50, 'y'], chunk_size=10, sizes=[value_size('x' * 50), value_size('y')], max_bytes=20)
+    assert chunker.next_chunk() == (0, ['x' * 50])
+    assert chunker.next_chunk() == (1, ['y'])
+    assert chunker.next_chunk() is None
+
+
+def test_count_rows():
+    assert count_rows([{'ID': 1}, {'ID': 2}], format='json') == 2
+    assert count_rows(b'ID\n1\n2\n', format='csv') == 2
+    assert count_rows(b'ID\n', format='csv') == 0
+    # Excel files have no row count, not their byte length.
+    assert count_rows(b'PK\x03\x04' + b'x' * 100, format='xlsx') is None
@@ -0,0 +1,21 @@
+import pickle
+
+import pytest
+
+from metabase_query.codec import OrjsonCodec
+
+
+def test_orjson_codec():
+    pytest.importorskip('orjson')
+    codec = OrjsonCodec()
+    assert codec.loads(b'[{"ID":1,"Name":"\xc3\xa9"}]') == [{'ID': 1, 'Name': 'é'}]
+    assert codec.dumps({'value': [1, 'é']}) == '{"value":[1,"é"]}'
+    # Integers over 64 bits fall back to the standard library.
+    assert codec.dumps([2 ** 70]) == f'[{2 ** 70}]'
+
+
+def test_orjson_codec_pickle():
+    pytest.importorskip('orjson')
+    codec = pickle.loads(pickle.dumps(OrjsonCodec()))
+    assert codec.loads(b'[1,2]') == [1, 2]
+    assert codec.dumps([1]) == '[1]'
@@ -0,0 +1,27 @@
+import gzip
+
+import pytest
+
+from metabase_query.compression import make_decompressor, zstd_module
+
+
+def decompress(encoding, data, chunk_size):
+    decompressor = make_decompressor(encoding)
+    chunks = [decompressor.feed(data[i:i + chunk_size]) for i in range(0, len(data), chunk_size)]
+    return b''.join(chunks) + decompressor.flush()
+
+
+def test_gzip_members():
+    data = gzip.compress(b'ID\n1\n') + gzip.compress(b'2\n3\n')
+    for chunk_size in [1, 7, len(data)]:
+        assert decompress('gzip', data, chunk_size) == b'ID\n1\n2\n3\n'
+
+
+def test_zstd_frames():
+    module = pytest.importorskip(zstd_module() or 'zstandard')
+    compress = module.compress if module.__name__ == 'compression.zstd' else module.ZstdCompressor().compress
+    first = compress(b'ID\n1\n')
+    data = first + compress(b'2\n3\n') + compress(b'4\n')
+    # Frames end inside chunks and on chunk boundaries.
+    for chunk_size in [1, 5, len(first), len(data)]:
+        assert decompress('zstd', data, chunk_size) == b'ID\n1\n2\n3\n4\n'
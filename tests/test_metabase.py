@@ -0,0 +1,227 @@
+import asyncio
+import threading
+
+import aiohttp
+import pytest
+from aiohttp import web
+from mock_server import CARD_ID, MockMetabase, MockServer
+
+from metabase_query import AsyncMetabase, Checkpoint, IncompleteResultError, Metabase
+from metabase_query.codec import JSONCodec
+from metabase_query.retries import MetabaseError
+from metabase_query.scheduler import Scheduler
+
+
+def query_threads(mb, url, threads):
+    results = {}
+
+    def run(i):
+        values = list(range(i * 1000, i * 1000 + 600))
+        results[i] = mb.query(url, filter={'order_id': values}, filter_chunk_size=100)
+
+    workers = [threading.Thread(target=run, args=(i,)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(timeout=60)
+    return results
+
+
+def test_sync_queries_from_many_threads(mock, server):
+    # One object, each sync call runs its own event loop.
+    mb = Metabase(metabase_session='test', verbose=False, max_in_flight=2, limit_per_host=2)
+    results = query_threads(mb, f'{server}/question/{CARD_ID}', threads=8)
+
+    assert sorted(results) == list(range(8))
+    for i, records in results.items():
+        assert [r['ID'] for r in records] == list(range(i * 1000, i * 1000 + 600))
+    assert mock.stats['max_in_flight'] <= 2
+
+
+class TimeoutMockMetabase(MockMetabase):
+    # Chunks of more than 50 values time out.
+    async def export(self, request, values):
+        if values is not None and len(values) > 50:
+            self.stats['export'] += 1
+            self.stats['errors'] += 1
+            return web.json_response({'error': 'Query timed out', 'error_type': 'timed-out'}, status=202)
+        return await super().export(request, values)
+
+
+def test_adaptive_chunking_splits_without_retrying():
+    mock = TimeoutMockMetabase()
+    events = []
+    with MockServer(mock) as server:
+        mb = Metabase(metabase_session='test', verbose=False, adaptive_chunking=True, retry_attempts=3, retry_backoff=0, retry_jitter=0, on_request=events.append)
+        records = mb.query(f'{server}/question/{CARD_ID}', filter={'order_id': list(range(400))}, filter_chunk_size=100)
+
+    assert sorted(r['ID'] for r in records) == list(range(400))
+    assert mock.stats['errors'] > 0
+    # Failed chunks were split, not retried at the same size.
+    assert all(e['retries'] == 0 for e in events if e['kind'] == 'export')
+
+
+def test_query_iter_shares_the_retry_budget():
+    mock = MockMetabase(error_rate=1.0, error_status=503)
+    with MockServer(mock) as server:
+        mb = Metabase(metabase_session='test', verbose=False, retry_attempts=5, retry_backoff=0, retry_jitter=0, retry_budget=1, circuit_breaker=False)
+        with pytest.raises(aiohttp.ClientResponseError):
+            list(mb.query_iter(f'{server}/question/{CARD_ID}', filter={'order_id': [1, 2]}))
+
+    # The first attempt and the one retry of the budget.
+    assert mock.stats['export'] == 2
+
+
+class CountingCodec(JSONCodec):
+    # Counts the error bodies it decodes.
+    def __init__(self):
+        self.errors = 0
+
+    def loads(self, data):
+        text = data.decode('utf-8') if isinstance(data, bytes) else data
+        if 'timed out' in text:
+            self.errors += 1
+        return super().loads(data)
+
+
+def test_query_iter_error_uses_the_json_codec():
+    mock = TimeoutMockMetabase()
+    codec = CountingCodec()
+    with MockServer(mock) as server:
+        mb = Metabase(metabase_session='test', verbose=False, retry_attempts=1, json_codec=codec)
+        with pytest.raises(MetabaseError, match='timed out'):
+            list(mb.query_iter(f'{server}/question/{CARD_ID}', filter={'order_id': list(range(100))}))
+
+    assert codec.errors == 1
+
+
+def test_sync_round_trip(mock, server):
+    mb = Metabase(metabase_session='test', verbose=False)
+    url = f'{server}/question/{CARD_ID}'
+
+    records, summary = mb.query(url, filter={'order_id': list(range(25))}, filter_chunk_size=10, with_summary=True)
+    assert [r['ID'] for r in records] == list(range(25))
+    assert summary['requests'] == 3
+    assert summary['rows'] == 25
+
+    data = mb.query(url, format='csv', filter={'order_id': list(range(25))}, filter_chunk_size=10)
+    lines = data.decode('utf-8').splitlines()
+    assert lines[0] == 'ID,Text 0,Text 1'
+    assert [int(line.split(',')[0]) for line in lines[1:]] == list(range(25))
+
+    rows = list(mb.query_iter(url, filter={'order_id': list(range(25))}, filter_chunk_size=10))
+    assert rows[0] == ['ID', 'Text 0', 'Text 1']
+    assert [int(row[0]) for row in rows[1:]] == list(range(25))
+
+
+def test_open_client_round_trip(mock, server):
+    url = f'{server}/question/{CARD_ID}'
+    with Metabase(metabase_session='test', verbose=False) as mb:
+        assert mb.session is not None
+        assert [r['ID'] for r in mb.query(url, filter={'order_id': [1, 2]})] == [1, 2]
+        # Calls from other threads run on the client's loop.
+        results = query_threads(mb, url, threads=4)
+        assert [len(results[i]) for i in range(4)] == [600] * 4
+    assert mb.session is None
+    # One metadata request for all calls.
+    assert mock.stats['metadata'] == 1
+
+
+def test_async_round_trip(mock, server):
+    url = f'{server}/question/{CARD_ID}'
+
+    async def main():
+        async with AsyncMetabase(metabase_session='test', verbose=False) as mb:
+            first, second = await asyncio.gather(
+                mb.query(url, filter={'order_id': list(range(20))}, filter_chunk_size=5),
+                mb.query(url, filter={'order_id': list(range(100, 110))})
+            )
+            rows = [row async for row in mb.query_iter(url, format='json', filter={'order_id': [7, 8]})]
+        return first, second, rows, mb.session
+
+    first, second, rows, session = asyncio.run(main())
+    assert [r['ID'] for r in first] == list(range(20))
+    assert [r['ID'] for r in second] == list(range(100, 110))
+    assert [r['ID'] for r in rows] == [7, 8]
+    assert session is None
+
+
+class FlakyMockMetabase(MockMetabase):
+    # Chunks holding a failing value fail until failing is cleared.
+    def __init__(self, failing, **kwargs):
+        super().__init__(**kwargs)
+        self.failing = set(failing)
+        self.requested = []
+
+    async def export(self, request, values):
+        self.requested.append(values[0])
+        if self.failing.intersection(values):
+            return web.Response(status=500)
+        return await super().export(request, values)
+
+
+def test_query_iter_slot_per_attempt():
+    mock = FlakyMockMetabase(failing=[7])
+    with MockServer(mock) as server:
+        url = f'{server}/question/{CARD_ID}'
+
+        async def main():
+            async with AsyncMetabase(metabase_session='test', verbose=False, retry_backoff=0.5, retry_jitter=0) as mb:
+                rows = []
+
+                async def consume():
+                    async for row in mb.query_iter(url, format='json', filter={'order_id': [7, 8]}):
+                        rows.append(row)
+                        # A slow consumer is not response time.
+                        await asyncio.sleep(0.3)
+
+                task = asyncio.create_task(consume())
+                while not mock.requested:
+                    await asyncio.sleep(0.01)
+                await asyncio.sleep(0.1)
+                # Waiting to retry does not hold a slot.
+                in_flight = mb.scheduler.in_flight
+                mock.failing.clear()
+                await task
+                return rows, in_flight, mb.circuit_breakers.get(Scheduler.domain_of(url)).stats()
+
+        rows, in_flight, stats = asyncio.run(main())
+
+    assert [r['ID'] for r in rows] == [7, 8]
+    assert in_flight == 0
+    assert stats['requests'] == 2
+    assert stats['p95'] < 0.3
+
+
+def test_checkpoint_resume(tmp_path):
+    mock = FlakyMockMetabase(failing=[25, 45])
+    url_values = {'order_id': list(range(50))}
+    with MockServer(mock) as server:
+        url = f'{server}/question/{CARD_ID}'
+        mb = Metabase(metabase_session='test', verbose=False, retry_attempts=1, circuit_breaker=False)
+        with pytest.raises(IncompleteResultError) as error:
+            mb.query(url, filter=url_values, filter_chunk_size=10, checkpoint=str(tmp_path))
+        assert error.value.failed == [2, 4]
+
+        job = list(Checkpoint(str(tmp_path)).jobs().values())[0]
+        assert sorted(job['done']) == [0, 1, 3]
+
+        mock.failing.clear()
+        mock.requested.clear()
+        records = mb.query(url, filter=url_values, filter_chunk_size=10, checkpoint=str(tmp_path))
+
+    # Only the failed chunks were fetched again.
+    assert sorted(mock.requested) == [20, 40]
+    assert [r['ID'] for r in records] == list(range(50))
+
+
+def test_adaptive_chunking_keeps_max_body_size(mock, server):
+    events = []
+    values = [f'{i}' for i in range(300)] + [f'{i:0>200}' for i in range(300)]
+    mb = Metabase(metabase_session='test', verbose=False, adaptive_chunking=True, max_body_size=4000, on_request=events.append)
+    records = mb.query(f'{server}/question/{CARD_ID}', filter={'order_id': values}, filter_chunk_size=1000)
+
+    assert sorted(r['ID'] for r in records) == sorted(values)
+    exports = [e for e in events if e['kind'] == 'export']
+    assert len(exports) > 1
+    assert max(e['request_bytes'] for e in exports) <= 4000
@@ -0,0 +1,103 @@
+import asyncio
+import datetime
+
+import pytest
+
+from metabase_query import IncompleteResultError, Metabase
+from metabase_query.pagination import Pagination, field_key_kind, last_key, page_query, page_sql, value_key_kind
+
+
+def test_last_key_csv_text_key_keeps_leading_zeros():
+    data = b'Code,Name\n00122,a\n00123,b\n'
+    assert last_key(data, format='csv', names=['Code']) == '00123'
+
+
+def test_last_key_csv_number_keys():
+    data = b'ID,Name\n1,a\n12,b\n'
+    assert last_key(data, format='csv', names=['id'], kind='int') == 12
+    assert last_key(data, format='csv', names=['ID'], kind='float') == 12.0
+
+
+def test_key_kind():
+    assert field_key_kind({'base_type': 'type/BigInteger'}) == 'int'
+    assert field_key_kind({'base_type': 'type/Decimal'}) == 'float'
+    assert field_key_kind({'base_type': 'type/Text'}) is None
+    assert field_key_kind({'base_type': 'type/Boolean'}) is None
+    assert value_key_kind(10) == 'int'
+    assert value_key_kind(1.5) == 'float'
+    assert value_key_kind('00123') is None
+    assert value_key_kind(True) is None
+
+
+def test_page_query():
+    query = {'source-table': 5, 'filter': ['=', ['field', 11, None], 'done']}
+    field = ['field', 10, None]
+    page = page_query(query=query, field=field, limit=100, lower=1, upper=50)
+    assert page['filter'] == ['and', ['>=', field, 1], ['<', field, 50], ['=', ['field', 11, None], 'done']]
+    assert page['order-by'] == [['asc', field]]
+    assert page['limit'] == 100
+    # The query is not changed.
+    assert query == {'source-table': 5, 'filter': ['=', ['field', 11, None], 'done']}
+
+    page = page_query(query={'source-table': 5}, field=field, limit=10, lower=1, after=20, upper=50, closed=True)
+    assert page['filter'] == ['and', ['>', field, 20], ['<=', field, 50]]
+    assert 'filter' not in page_query(query={'source-table': 5}, field=field, limit=10)
+
+
+def test_page_query_dates():
+    field = ['field', 10, None]
+    page = page_query(query={}, field=field, limit=10, lower=datetime.datetime(2024, 1, 1), upper=datetime.datetime(2024, 1, 2, 12))
+    assert page['filter'] == ['and', ['>=', field, '2024-01-01'], ['<', field, '2024-01-02T12:00:00']]
+
+
+def test_page_sql():
+    sql = page_sql(sql='SELECT * FROM orders;\n', column='id', limit=100, lower=1, upper=50)
+    assert sql == 'SELECT * FROM (SELECT * FROM orders) metabase_query_page WHERE id >= 1 AND id < 50 ORDER BY id LIMIT 100'
+    sql = page_sql(sql='SELECT * FROM orders', column='code', limit=10, after="O'1", upper='O9', closed=True)
+    assert sql == "SELECT * FROM (SELECT * FROM orders) metabase_query_page WHERE code > 'O''1' AND code <= 'O9' ORDER BY code LIMIT 10"
+    assert page_sql(sql='SELECT 1', column='id', limit=5) == 'SELECT * FROM (SELECT 1) metabase_query_page ORDER BY id LIMIT 5'
+
+
+def test_last_key_json():
+    assert last_key([{'ID': 1}, {'ID': 2}], format='json', names=['id']) == 2
+    assert last_key([], format='json', names=['ID']) is None
+    with pytest.raises(LookupError):
+        last_key([{'ID': 1}], format='json', names=['code'])
+
+
+def test_last_key_csv_quoted_new_lines():
+    data = b'ID,Note\n1,a\n2,"line\nbreak"\n'
+    assert last_key(data, format='csv', names=['ID'], kind='int') == 2
+    assert last_key(b'ID,Note\n', format='csv', names=['ID']) is None
+
+
+def test_pagination_limit_and_ranges():
+    pagination = Pagination(column='id')
+    assert pagination.limit(export_row_limit=1000) == 999
+    assert Pagination(column='id', page_size=100).limit(export_row_limit=1000) == 100
+    assert pagination.ranges(count=10, start=1, end=10, limit=100) == [(None, None, False)]
+    assert pagination.ranges(count=300, start=1, end=300, limit=100) == [(1, 100, False), (100, 200, False), (200, 300, True)]
+    assert pagination.ranges(count=300, start='a', end='z', limit=100) == [(None, None, False)]
+
+
+def test_export_pages_failed_range():
+    mb = Metabase(metabase_session='test', verbose=False)
+
+    async def export(session, format, output, group, chunk, lower, after):
+        if lower == 100:
+            raise RuntimeError('Query failed')
+        return [{'ID': lower}]
+
+    def page_request(lower, after, upper, closed):
+        return {'lower': lower, 'after': after}
+
+    mb.export = export
+    ranges = [(1, 100, False), (100, 200, False), (200, 300, True)]
+    with pytest.raises(IncompleteResultError) as error:
+        asyncio.run(mb.export_pages(session=None, page_request=page_request, key_names=['ID'], limit=10, ranges=ranges))
+    assert error.value.failed == [(100, 200, False)]
+    assert list(error.value.errors) == [1]
+
+    # A range that fails alone raises its own error.
+    with pytest.raises(RuntimeError):
+        asyncio.run(mb.export_pages(session=None, page_request=page_request, key_names=['ID'], limit=10, ranges=ranges[1:2]))
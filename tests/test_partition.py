@@ -0,0 +1,79 @@
+import datetime
+
+import pytest
+
+from metabase_query.partition import Partition, make_partition
+
+
+def test_number_slices():
+    assert Partition('id', 4).slices(0, 100) == [(0, 25, False), (25, 50, False), (50, 75, False), (75, 100, True)]
+
+
+def test_whole_number_slices():
+    # Filters take two included integers: the stop is one after the end.
+    assert Partition('id', 3).slices(1, 9, whole=True) == [(1, 4, False), (4, 7, False), (7, 10, False)]
+
+
+def test_short_range_gives_fewer_slices():
+    assert Partition('id', 10).slices(1, 3, whole=True) == [(1, 2, False), (2, 3, False), (3, 4, False)]
+    assert Partition('id', 4).slices(5, 5) == [(5, 5, True)]
+
+
+def test_date_interval_slices():
+    slices = Partition('created_at', '1w').slices('2024-01-01', '2024-01-10')
+    day = datetime.datetime
+    assert slices == [(day(2024, 1, 1), day(2024, 1, 8), False), (day(2024, 1, 8), day(2024, 1, 11), False)]
+
+
+def test_datetime_slices_include_the_end():
+    slices = Partition('created_at', 2).slices('2024-01-01T00:00:00', '2024-01-01T12:00:00')
+    assert slices[-1] == (datetime.datetime(2024, 1, 1, 6), datetime.datetime(2024, 1, 1, 12), True)
+
+
+def test_slices_errors():
+    with pytest.raises(ValueError):
+        Partition('id', '1d').slices(1, 10)
+    with pytest.raises(ValueError):
+        Partition('id', 2).slices(10, 1)
+    with pytest.raises(ValueError):
+        Partition('id', 2).slices(1, '2024-01-01')
+    with pytest.raises(ValueError):
+        Partition('created_at', '12h').slices('2024-01-01', '2024-01-02', whole=True)
+
+
+def test_parameter_slices_dates():
+    parameter = {'type': 'date/all-options', 'value': '2024-01-01~2024-01-06', 'target': ['dimension', ['template-tag', 'created_at']]}
+    slices = Partition('created_at', 3).parameter_slices(parameter)
+    assert [p['value'] for p in slices] == ['2024-01-01~2024-01-02', '2024-01-03~2024-01-04', '2024-01-05~2024-01-06']
+    assert all(p['type'] == 'date/range' and p['target'] == parameter['target'] for p in slices)
+
+
+def test_parameter_slices_numbers():
+    parameter = {'type': 'number/=', 'target': ['dimension', ['template-tag', 'id']]}
+    slices = Partition('id', 2, range=(1, 10)).parameter_slices(parameter)
+    assert [p['value'] for p in slices] == [[1.0, 5.0], [6.0, 10.0]]
+    assert all(p['type'] == 'number/between' for p in slices)
+
+
+def test_parameter_slices_range_wins_over_the_filter_value():
+    parameter = {'type': 'date/all-options', 'value': '2023-01-01~2023-12-31', 'target': ['dimension', ['template-tag', 'created_at']]}
+    slices = Partition('created_at', 2, range=('2024-01-01', '2024-01-04')).parameter_slices(parameter)
+    assert [p['value'] for p in slices] == ['2024-01-01~2024-01-02', '2024-01-03~2024-01-04']
+
+
+def test_parameter_slices_errors():
+    with pytest.raises(ValueError):
+        Partition('status', 2).parameter_slices({'type': 'category', 'value': ['a'], 'target': ['dimension', ['template-tag', 'status']]})
+    with pytest.raises(ValueError):
+        Partition('id', 2).parameter_slices({'type': 'number/=', 'value': [5], 'target': ['dimension', ['template-tag', 'id']]})
+
+
+def test_make_partition():
+    assert make_partition() is None
+    assert make_partition('Created At', '1d').column == 'created_at'
+    with pytest.raises(ValueError):
+        make_partition(partitions=2)
+    with pytest.raises(ValueError):
+        make_partition('id')
+    with pytest.raises(ValueError):
+        make_partition('id', 0)
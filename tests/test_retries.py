@@ -0,0 +1,87 @@
+import asyncio
+
+import pytest
+from tenacity import Future, RetryCallState, retry, retry_if_exception, wait_none
+
+from metabase_query.retries import MetabaseError, RetryBudget, metabase_error, retry_budget, should_retry, stop_retrying, use_retry_budget, wait_backoff
+
+
+def failing_request(attempts, error):
+    calls = []
+
+    @retry(stop=stop_retrying(attempts), wait=wait_none(), retry=retry_if_exception(should_retry), reraise=True)
+    async def request():
+        calls.append(1)
+        raise error
+
+    return request, calls
+
+
+def test_budget_is_spent_only_on_retries():
+    async def main():
+        with use_retry_budget(3):
+            request, calls = failing_request(attempts=2, error=MetabaseError('timed out', retryable=True))
+            with pytest.raises(MetabaseError):
+                await request()
+            # 2 attempts, 1 retry: the last failure does not spend the budget.
+            assert len(calls) == 2
+            assert retry_budget.get().remaining == 2
+
+    asyncio.run(main())
+
+
+def test_budget_stops_retries():
+    async def main():
+        with use_retry_budget(1):
+            request, calls = failing_request(attempts=5, error=MetabaseError('timed out', retryable=True))
+            with pytest.raises(MetabaseError):
+                await request()
+            assert len(calls) == 2
+            assert retry_budget.get().remaining == 0
+
+    asyncio.run(main())
+
+
+def test_errors_not_retried_keep_the_budget():
+    async def main():
+        with use_retry_budget(3):
+            request, calls = failing_request(attempts=3, error=MetabaseError('invalid', retryable=False))
+            with pytest.raises(MetabaseError):
+                await request()
+            assert len(calls) == 1
+            assert retry_budget.get().remaining == 3
+
+    asyncio.run(main())
+
+
+def test_retry_budget_spend():
+    budget = RetryBudget(1)
+    assert budget.spend()
+    assert not budget.spend()
+    assert budget.remaining == 0
+
+
+def test_metabase_error_retry_after():
+    error = metabase_error({'error': 'Too many queries', 'error_type': 'server'}, status=202, retry_after='3')
+    assert error.retryable
+    assert error.retry_after == 3.0
+    assert metabase_error({'error': 'Invalid', 'error_type': 'invalid-query'}).retry_after is None
+
+
+def retry_state(attempt_number, error):
+    state = RetryCallState(retry_object=None, fn=None, args=(), kwargs={})
+    state.attempt_number = attempt_number
+    state.outcome = Future.construct(attempt_number, error, True)
+    return state
+
+
+def test_wait_backoff():
+    wait = wait_backoff(initial=1, max=10, jitter=0.5)
+    error = MetabaseError('Server error', retryable=True)
+    assert 1 <= wait(retry_state(1, error)) <= 1.5
+    assert 4 <= wait(retry_state(3, error)) <= 4.5
+    assert wait(retry_state(5, error)) == 10
+    assert wait(retry_state(5000, error)) == 10
+    # Retry-After wins, up to max.
+    assert wait(retry_state(1, MetabaseError('Busy', retryable=True, retry_after=3))) == 3
+    assert wait(retry_state(1, MetabaseError('Busy', retryable=True, retry_after=60))) == 10
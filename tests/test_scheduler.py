@@ -0,0 +1,189 @@
+import asyncio
+import threading
+
+import pytest
+
+from metabase_query.scheduler import Scheduler, SingleFlight, gather_bounded
+
+
+def test_slots_shared_by_loops_of_many_threads():
+    # Sync calls without open() run their own event loop in each thread, on one scheduler.
+    scheduler = Scheduler(max_in_flight=2, limit_per_domain=2)
+    peak = []
+    done = []
+
+    async def request():
+        async with scheduler.slot(domain='metabase.example.com', group=threading.get_ident()):
+            peak.append(scheduler.in_flight)
+            await asyncio.sleep(0.001)
+
+    async def bulk():
+        await asyncio.gather(*[request() for _ in range(6)])
+
+    def run():
+        asyncio.run(asyncio.wait_for(bulk(), timeout=10))
+        done.append(True)
+
+    threads = [threading.Thread(target=run) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=20)
+
+    assert len(done) == 8
+    assert max(peak) <= 2
+    assert scheduler.in_flight == 0
+
+
+def test_groups_take_turns():
+    scheduler = Scheduler(max_in_flight=1, limit_per_domain=1)
+    order = []
+
+    async def request(group, i):
+        async with scheduler.slot(domain='metabase.example.com', group=group):
+            order.append((group, i))
+            await asyncio.sleep(0)
+
+    async def main():
+        release = asyncio.Event()
+
+        async def holder():
+            async with scheduler.slot(domain='metabase.example.com', group='holder'):
+                await release.wait()
+
+        first = asyncio.ensure_future(holder())
+        await asyncio.sleep(0)
+        # A big bulk query first, then a small one: the small one is not served last.
+        bulk = [asyncio.ensure_future(request('bulk', i)) for i in range(5)]
+        small = [asyncio.ensure_future(request('small', i)) for i in range(2)]
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(first, *bulk, *small)
+
+    asyncio.run(main())
+    assert order == [('bulk', 0), ('small', 0), ('bulk', 1), ('small', 1), ('bulk', 2), ('bulk', 3), ('bulk', 4)]
+    assert scheduler.in_flight == 0
+
+
+def test_limit_per_domain():
+    scheduler = Scheduler(max_in_flight=3, limit_per_domain=1)
+    peak = {}
+
+    async def request(domain):
+        async with scheduler.slot(domain=domain, group=domain):
+            peak[domain] = max(peak.get(domain, 0), scheduler._domain_in_flight[domain])
+            peak['all'] = max(peak.get('all', 0), scheduler.in_flight)
+            await asyncio.sleep(0.001)
+
+    async def main():
+        await asyncio.gather(*[request(domain) for domain in ['a', 'b', 'a', 'b', 'a']])
+
+    asyncio.run(main())
+    assert peak == {'a': 1, 'b': 1, 'all': 2}
+
+
+def test_cancelled_waiter_frees_its_place():
+    scheduler = Scheduler(max_in_flight=1, limit_per_domain=1)
+
+    async def main():
+        release = asyncio.Event()
+
+        async def holder():
+            async with scheduler.slot(domain='a'):
+                await release.wait()
+
+        async def waiter():
+            async with scheduler.slot(domain='a'):
+                return True
+
+        first = asyncio.ensure_future(holder())
+        await asyncio.sleep(0)
+        cancelled = asyncio.ensure_future(waiter())
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        second = asyncio.ensure_future(waiter())
+        await asyncio.sleep(0)
+
+        release.set()
+        await first
+        assert await asyncio.wait_for(second, timeout=5)
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+
+    asyncio.run(main())
+    assert scheduler.in_flight == 0
+    assert not scheduler._waiters
+
+
+def test_waiter_cancelled_after_it_was_served():
+    scheduler = Scheduler(max_in_flight=1, limit_per_domain=1)
+
+    async def main():
+        release = asyncio.Event()
+
+        async def holder():
+            async with scheduler.slot(domain='a'):
+                await release.wait()
+
+        async def waiter():
+            async with scheduler.slot(domain='a'):
+                await asyncio.sleep(1)
+
+        first = asyncio.ensure_future(holder())
+        await asyncio.sleep(0)
+        second = asyncio.ensure_future(waiter())
+        await asyncio.sleep(0)
+
+        # Served on release, then cancelled before it runs: the slot goes back.
+        release.set()
+        await first
+        second.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await second
+        await asyncio.sleep(0)
+
+    asyncio.run(main())
+    assert scheduler.in_flight == 0
+
+
+def test_gather_bounded():
+    running = []
+    peak = []
+
+    async def work(item):
+        running.append(item)
+        peak.append(len(running))
+        await asyncio.sleep(0)
+        running.remove(item)
+        if item == 3:
+            raise ValueError(item)
+        return item * 2
+
+    results = asyncio.run(gather_bounded(function=work, items=list(range(6)), workers=2))
+    assert results[:3] == [0, 2, 4] and isinstance(results[3], ValueError) and results[4:] == [8, 10]
+    assert max(peak) == 2
+
+
+def test_single_flight_shares_one_call():
+    flight = SingleFlight()
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {'rows': 1}
+
+    async def main():
+        return await asyncio.gather(*[flight.do(key='k', function=fetch) for _ in range(3)])
+
+    results = asyncio.run(main())
+    assert len(calls) == 1
+    assert results[0] is results[1] is results[2]
+    assert flight.stats() == {'calls': 1, 'shared': 2, 'in_flight': 0}
+
+
+def test_single_flight_key():
+    key = SingleFlight.make_key(url='https://a.com/api/card/1/query/json', body=b'parameters=%5B%5D')
+    assert key == SingleFlight.make_key(url='https://a.com/api/card/1/query/json', body=b'parameters=%5B%5D')
+    assert key != SingleFlight.make_key(url='https://a.com/api/card/1/query/csv', body=b'parameters=%5B%5D')
+    assert key != SingleFlight.make_key(url='https://a.com/api/card/1/query/json', body=b'parameters=%5B%5D', column_sort=['ID'])
@@ -0,0 +1,74 @@
+import json
+
+import pytest
+
+from metabase_query.stream import CSVRowParser, JSONArrayParser
+from metabase_query.utils import combine_csv
+
+
+def feed_all(parser, data, size):
+    rows = []
+    for i in range(0, len(data), size):
+        rows.extend(parser.feed(data[i:i + size]))
+    rows.extend(parser.close())
+    return rows
+
+
+CSV = 'ID,Name,Note\n1,é,"a, b"\n2,"two\nlines","say ""hi"""\n3,x,\n'.encode('utf-8')
+
+
+CSV_ROWS = [['ID', 'Name', 'Note'], ['1', 'é', 'a, b'], ['2', 'two\nlines', 'say "hi"'], ['3', 'x', '']]
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7, len(CSV)])
+def test_csv_rows_across_chunks(size):
+    assert feed_all(CSVRowParser(), CSV, size) == CSV_ROWS
+
+
+def test_csv_without_final_new_line():
+    assert feed_all(CSVRowParser(), b'ID\n1\n2', 3) == [['ID'], ['1'], ['2']]
+
+
+def test_csv_ends_inside_quotes():
+    parser = CSVRowParser()
+    parser.feed(b'ID\n"1\n')
+    with pytest.raises(ValueError):
+        parser.close()
+
+
+ITEMS = [{'ID': 1, 'Name': 'é'}, {'ID': 2, 'Name': 'a ] } , b', 'Tags': [1, {'x': None}]}, {'ID': 3, 'Name': '"quoted"'}]
+
+
+JSON = json.dumps(ITEMS, ensure_ascii=False, indent=1).encode('utf-8')
+
+
+@pytest.mark.parametrize('size', [1, 2, 5, 16, len(JSON)])
+def test_json_items_across_chunks(size):
+    assert feed_all(JSONArrayParser(), JSON, size) == ITEMS
+
+
+def test_json_empty_array():
+    assert feed_all(JSONArrayParser(), b' [ ] ', 1) == []
+
+
+def test_json_errors():
+    with pytest.raises(ValueError):
+        JSONArrayParser().feed(b'{"error": "x"}')
+    parser = JSONArrayParser()
+    parser.feed(b'[{"ID": 1},')
+    with pytest.raises(ValueError):
+        parser.close()
+
+
+def test_combine_csv():
+    chunks = [b'ID,Name\n1,a\n', b'ID,Name\n2,b', b'ID,Name\n', b'ID,Name', b'ID,Name\n3,c\n']
+    assert combine_csv(chunks) == b'ID,Name\n1,a\n2,b\n3,c\n'
+    assert combine_csv([b'ID,Name\n']) == b'ID,Name\n'
+
+
+def test_combine_csv_to_file(tmp_path):
+    path = tmp_path / 'out.csv'
+    with open(path, 'wb') as f:
+        size = combine_csv([b'ID\n1\n', b'ID\n2\n'], file=f)
+    assert path.read_bytes() == b'ID\n1\n2\n'
+    assert size == 7